@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+Measures metric log inserts and latest log reads per second with several
+processes sharing the database, for each of settings.DB_PROFILES.
+
+Run from the repository root:
+`PYTHONPATH=. python benchmarks/db_profiles.py`
+"""
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+from uuid import uuid4
+
+import peewee
+
+from gardnr import constants, metrics, models, settings
+
+METRIC_NAME = 'benchmark-metric'
+
+
+def _connect(db_path: str, profile: str) -> None:
+    settings.LOCAL_DB = db_path
+    settings.DB_PROFILE = profile
+    models.initialize_db()
+
+
+def _write(db_path: str, profile: str, duration: float, results) -> None:
+    _connect(db_path, profile)
+    metric = models.Metric.get(models.Metric.name == METRIC_NAME)
+
+    done = locked = 0
+    end = time.monotonic() + duration
+
+    while time.monotonic() < end:
+        try:
+            metrics.create_metric_log(metric, 0)
+            done += 1
+        except peewee.OperationalError:
+            locked += 1
+
+    results.put(('write', done, locked))
+
+
+def _read(db_path: str, profile: str, duration: float, results) -> None:
+    _connect(db_path, profile)
+    metric = models.Metric.get(models.Metric.name == METRIC_NAME)
+
+    done = locked = 0
+    end = time.monotonic() + duration
+
+    while time.monotonic() < end:
+        try:
+            metric.get_latest_log()
+            done += 1
+        except peewee.OperationalError:
+            locked += 1
+
+    results.put(('read', done, locked))
+
+
+def run_profile(profile: str, writers: int, readers: int,
+                duration: float) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, 'benchmark.db')
+
+        _connect(db_path, profile)
+        models.Metric.create(id=uuid4(),
+                             name=METRIC_NAME,
+                             topic=constants.AIR,
+                             type=constants.T9E)
+        models.close_db()
+
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(target=target,
+                                    args=(db_path, profile, duration,
+                                          results))
+            for target, count in ((_write, writers), (_read, readers))
+            for _ in range(count)
+        ]
+
+        for process in processes:
+            process.start()
+
+        totals = {'write': [0, 0], 'read': [0, 0]}
+        for _ in processes:
+            kind, done, locked = results.get()
+            totals[kind][0] += done
+            totals[kind][1] += locked
+
+        for process in processes:
+            process.join()
+
+    print('{profile}: {writes:.0f} writes/s, {reads:.0f} reads/s, '
+          '{locked} locked errors'.format(
+              profile=profile,
+              writes=totals['write'][0] / duration,
+              reads=totals['read'][0] / duration,
+              locked=totals['write'][1] + totals['read'][1]))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', '--writers', type=int, default=4)
+    parser.add_argument('-r', '--readers', type=int, default=4)
+    parser.add_argument('-d', '--duration', type=float, default=5)
+    args = parser.parse_args()
+
+    for profile in sorted(settings.DB_PROFILES):
+        run_profile(profile, args.writers, args.readers, args.duration)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Measures how many export logs per second are recorded after an export,
+comparing one autocommitted ExportLog.create per log against batched
+inserts in a single transaction.
+
+Run from the repository root:
+`PYTHONPATH=. python benchmarks/export_bookkeeping.py`
+"""
+import argparse
+import os
+import tempfile
+import time
+from uuid import uuid4
+
+from gardnr import constants, models, settings
+from gardnr.tasks.write import _create_export_logs
+
+
+def _create_logs(count: int) -> models.Driver:
+    metric = models.Metric.create(id=uuid4(),
+                                  name='benchmark-metric',
+                                  topic=constants.AIR,
+                                  type=constants.T9E)
+
+    with models.atomic():
+        for _ in range(count):
+            models.MetricLog.create(uuid=uuid4(), metric=metric, value=0)
+
+    return models.Driver.create(name='benchmark-exporter',
+                                type=constants.EXPORTER,
+                                fully_qualname='benchmark:Exporter')
+
+
+def per_row(driver: models.Driver, logs: list) -> None:
+    for log in logs:
+        models.ExportLog.create(metric_log=log, driver=driver)
+
+
+def batched(driver: models.Driver, logs: list) -> None:
+    _create_export_logs(driver, logs, [])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--logs', type=int, default=5000)
+    args = parser.parse_args()
+
+    for name, bookkeeping in (('per row', per_row), ('batched', batched)):
+        with tempfile.TemporaryDirectory() as directory:
+            settings.LOCAL_DB = os.path.join(directory, 'benchmark.db')
+            models.initialize_db()
+
+            driver = _create_logs(args.logs)
+            logs = list(models.MetricLog.select())
+
+            start = time.perf_counter()
+            bookkeeping(driver, logs)
+            elapsed = time.perf_counter() - start
+
+        print('{name}: {rate:.0f} rows/s ({count} rows in {elapsed:.2f}s)'
+              .format(name=name, rate=args.logs / elapsed,
+                      count=args.logs, elapsed=elapsed))
+
+
+if __name__ == '__main__':
+    main()
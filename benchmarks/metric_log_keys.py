@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Compares metric logs keyed by UUID, as in older versions, with metric logs
+keyed by an integer: insert rate and database file size, with every log
+also recorded as exported.
+
+Run from the repository root:
+`PYTHONPATH=. python benchmarks/metric_log_keys.py`
+"""
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime
+from uuid import uuid4
+
+import peewee
+
+from gardnr import constants, models, settings
+
+# the metric log and export log tables of older versions
+UUID_KEY_TABLES = (
+    'DROP TABLE exportlog',
+    'DROP TABLE metriclog',
+    'CREATE TABLE metriclog (id VARCHAR(40) NOT NULL PRIMARY KEY, '
+    'timestamp DATETIME NOT NULL, longitude REAL, latitude REAL, '
+    'elevation REAL, number REAL, text TEXT, path TEXT, '
+    'metric_id VARCHAR(40) NOT NULL)',
+    'CREATE INDEX metriclog_metric_id_timestamp '
+    'ON metriclog (metric_id, timestamp)',
+    'CREATE TABLE exportlog (id INTEGER NOT NULL PRIMARY KEY, '
+    'metric_log_id VARCHAR(40) NOT NULL, driver_id INTEGER NOT NULL)',
+    'CREATE INDEX exportlog_metric_log_id ON exportlog (metric_log_id)',
+    'CREATE INDEX exportlog_driver_id ON exportlog (driver_id)',
+)
+
+BATCH_SIZE = 100
+
+
+def _insert_logs(database: peewee.Database, uuid_key: bool,
+                 count: int, metric_id: str, driver_id: int) -> None:
+    for start in range(0, count, BATCH_SIZE):
+        logs = [(uuid4().hex, datetime.utcnow(), 0, metric_id)
+                for _ in range(min(BATCH_SIZE, count - start))]
+
+        with database.atomic():
+            cursor = database.cursor()
+
+            if uuid_key:
+                cursor.executemany(
+                    'INSERT INTO metriclog (id, timestamp, number, '
+                    'metric_id) VALUES (?, ?, ?, ?)', logs)
+                keys = [log[0] for log in logs]
+            else:
+                cursor.executemany(
+                    'INSERT INTO metriclog (uuid, timestamp, number, '
+                    'metric_id) VALUES (?, ?, ?, ?)', logs)
+                last_id = cursor.execute(
+                    'SELECT last_insert_rowid()').fetchone()[0]
+                keys = range(last_id - len(logs) + 1, last_id + 1)
+
+            cursor.executemany(
+                'INSERT INTO exportlog (metric_log_id, driver_id) '
+                'VALUES (?, ?)', [(key, driver_id) for key in keys])
+
+
+def run(uuid_key: bool, count: int) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, 'benchmark.db')
+        settings.LOCAL_DB = db_path
+        models.initialize_db()
+
+        # pylint: disable=protected-access
+        database = models.BaseModel._meta.database
+
+        if uuid_key:
+            for sql in UUID_KEY_TABLES:
+                database.execute_sql(sql)
+
+        metric = models.Metric.create(id=uuid4(),
+                                      name='benchmark-metric',
+                                      topic=constants.AIR,
+                                      type=constants.T9E)
+        driver = models.Driver.create(name='benchmark-exporter',
+                                      type=constants.EXPORTER,
+                                      fully_qualname='benchmark:Exporter')
+
+        start = time.perf_counter()
+        _insert_logs(database, uuid_key, count, metric.id.hex, driver.id)
+        elapsed = time.perf_counter() - start
+
+        database.execute_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+        size = os.path.getsize(db_path)
+        models.close_db()
+
+    print('{key} key: {rate:.0f} logs/s, {size:.1f} MB for {count} logs'
+          .format(key='UUID' if uuid_key else 'integer',
+                  rate=count / elapsed,
+                  size=size / 1024 / 1024,
+                  count=count))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--logs', type=int, default=200000)
+    args = parser.parse_args()
+
+    run(True, args.logs)
+    run(False, args.logs)
+
+
+if __name__ == '__main__':
+    main()
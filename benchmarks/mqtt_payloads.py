@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Measures MQTT messages decoded per second for each payload format, and
+messages decoded and inserted per second by the consumer's writer.
+
+Run from the repository root:
+`PYTHONPATH=. python benchmarks/mqtt_payloads.py`
+"""
+import argparse
+import json
+import os
+import struct
+import tempfile
+import time
+from datetime import datetime
+from types import SimpleNamespace
+from uuid import uuid4
+
+from gardnr import constants, models, mqtt, settings
+
+PAYLOADS = {
+    'number': b'21.5',
+    'JSON': json.dumps({'value': 21.5, 'timestamp': time.time()}).encode(),
+    'binary': mqtt.BINARY_MARKER + struct.pack('<dd', 21.5, time.time()),
+}
+
+BATCH_SIZE = 500
+
+
+def _create_metric() -> models.Metric:
+    return models.Metric.create(id=uuid4(),
+                                name='benchmark-metric',
+                                topic=constants.AIR,
+                                type=constants.T9E)
+
+
+def run_decode(name: str, count: int) -> None:
+    metric = models.Metric(id=uuid4(), name='benchmark-metric',
+                           topic=constants.AIR, type=constants.T9E)
+    messages = [(metric, PAYLOADS[name], datetime.utcnow())] * BATCH_SIZE
+
+    start = time.perf_counter()
+    for _ in range(count // BATCH_SIZE):
+        mqtt.decode_messages(messages)
+    elapsed = time.perf_counter() - start
+
+    print('decode {name}: {rate:.0f} messages/s'.format(
+        name=name, rate=count // BATCH_SIZE * BATCH_SIZE / elapsed))
+
+
+def run_consumer(name: str, count: int) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        settings.LOCAL_DB = os.path.join(directory, 'benchmark.db')
+        models.initialize_db()
+        metric = _create_metric()
+
+        consumer = mqtt.MQTTConsumer(count, BATCH_SIZE, 0)
+        consumer.load_metrics()
+
+        message = SimpleNamespace(topic=metric.name, payload=PAYLOADS[name])
+        for _ in range(count):
+            consumer.on_message(None, None, message)
+
+        start = time.perf_counter()
+        while consumer.write_batch(0):
+            pass
+        elapsed = time.perf_counter() - start
+
+        models.close_db()
+
+    print('decode and insert {name}: {rate:.0f} messages/s'.format(
+        name=name, rate=count / elapsed))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--messages', type=int, default=100000)
+    args = parser.parse_args()
+
+    for name in PAYLOADS:
+        run_decode(name, args.messages)
+
+    for name in PAYLOADS:
+        run_consumer(name, args.messages)
+
+
+if __name__ == '__main__':
+    main()
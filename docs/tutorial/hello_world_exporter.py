@@ -9,6 +9,14 @@ class Exporter(drivers.Exporter):
     # whitelist = [constants.IMAGE]
     # blacklist = [constants.IMAGE]
 
+    # Uncomment to only keep track of the last exported log instead of
+    # every exported log, recommended when there are many logs.
+    # export_tracking = constants.EXPORT_WATERMARK
+
+    # Uncomment to export the logs in batches of at most this many logs,
+    # export is then called once per batch.
+    # batch_size = 100
+
     def setup(self):
         """
         Add configuration here
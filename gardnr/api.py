@@ -0,0 +1,296 @@
+"""
+Read-only JSON API over the metric logs, served by gardnr.server under
+/api. Pages of logs are streamed as they are read, continue with the
+cursor in "next" until it is null. New logs are streamed live as
+server-sent events.
+"""
+import base64
+import binascii
+import json
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import peewee
+from flask import Blueprint, Response, jsonify, request, stream_with_context
+
+from gardnr import metrics, models, settings
+from gardnr.publisher import LogPublisher
+
+api = Blueprint('api', __name__, url_prefix='/api')
+
+# started by the first client of the live stream
+publisher = LogPublisher(settings.LIVE_BUFFER_SIZE,
+                         settings.LIVE_POLL_INTERVAL)
+
+# accepted for the start and end of a range, in UTC
+TIMESTAMP_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d')
+
+
+class APIError(Exception):
+
+    def __init__(self, message: str, status: int = 400) -> None:
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+@api.errorhandler(APIError)
+def handle_api_error(error: APIError) -> Tuple[Response, int]:
+    return jsonify(error=error.message), error.status
+
+
+def parse_timestamp(text: str) -> datetime:
+    for timestamp_format in TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(text, timestamp_format)
+        except ValueError:
+            pass
+
+    raise APIError('invalid timestamp "{text}"'.format(text=text))
+
+
+def encode_cursor(timestamp: datetime, log_id: Optional[int] = None) -> str:
+    """Opaque cursor to continue after the log or rollup"""
+
+    position = json.dumps([timestamp.isoformat(), log_id])
+
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, Optional[int]]:
+    try:
+        timestamp, log_id = json.loads(
+            base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+        raise APIError('invalid cursor')
+
+    if not isinstance(timestamp, str) or not (
+            log_id is None or
+            (isinstance(log_id, int) and not isinstance(log_id, bool))):
+        raise APIError('invalid cursor')
+
+    return parse_timestamp(timestamp), log_id
+
+
+def _get_timestamp_arg(name: str) -> Optional[datetime]:
+    text = request.args.get(name)
+
+    return parse_timestamp(text) if text else None
+
+
+def _get_limit() -> int:
+    try:
+        limit = int(request.args.get('limit', settings.API_PAGE_SIZE))
+    except ValueError:
+        raise APIError('invalid limit')
+
+    if limit < 1:
+        raise APIError('invalid limit')
+
+    return min(limit, settings.API_MAX_PAGE_SIZE)
+
+
+def _get_metric(name: str) -> models.Metric:
+    metric = metrics.find_metric(name)
+
+    if not metric:
+        raise APIError('unknown metric "{name}"'.format(name=name), 404)
+
+    return metric
+
+
+def _stream_page(
+        key: str,
+        rows: Iterable[Any],
+        limit: int,
+        to_json: Callable[[Any], Dict],
+        to_cursor: Callable[[Any], str]
+) -> Response:
+    """
+    Streams up to limit of rows as a JSON object, along with the cursor of
+    the next page if there are more. rows should hold one more than limit.
+    """
+
+    def generate() -> Iterable[str]:
+        yield '{{"{key}": ['.format(key=key)
+
+        next_cursor = None
+        previous = None
+
+        for index, row in enumerate(rows):
+            if index == limit:
+                next_cursor = to_cursor(previous)
+                break
+
+            yield (', ' if index else '') + json.dumps(to_json(row))
+            previous = row
+
+        yield '], "next": {cursor}}}'.format(cursor=json.dumps(next_cursor))
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
+
+
+def _log_to_json(log: models.MetricLog) -> Dict:
+    return {
+        'timestamp': log.timestamp.isoformat(),
+        'value': log.value,
+    }
+
+
+def _rollup_to_json(rollup: models.MetricRollup) -> Dict:
+    return {
+        'timestamp': rollup.bucket.isoformat(),
+        'count': rollup.count,
+        'mean': rollup.mean,
+        'min': rollup.min,
+        'max': rollup.max,
+        'last': rollup.last,
+    }
+
+
+def get_logs(
+        metric: models.Metric,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        after: Optional[Tuple[datetime, int]] = None
+) -> peewee.ModelSelect:
+    """
+    Logs of metric from start up to before end in the order they were
+    taken, after the (timestamp, id) of a log when given
+    """
+
+    # searches the (metric, timestamp) index, which also orders by rowid
+    logs = models.MetricLog.select(models.MetricLog.id,
+                                   models.MetricLog.timestamp,
+                                   models.MetricLog.number,
+                                   models.MetricLog.text,
+                                   models.MetricLog.path)\
+        .where(models.MetricLog.metric == metric)\
+        .order_by(models.MetricLog.timestamp, models.MetricLog.id)
+
+    if start:
+        logs = logs.where(models.MetricLog.timestamp >= start)
+
+    if end:
+        logs = logs.where(models.MetricLog.timestamp < end)
+
+    if after:
+        timestamp, log_id = after
+
+        # the first condition keeps the index range
+        logs = logs.where(
+            (models.MetricLog.timestamp >= timestamp) &
+            ((models.MetricLog.timestamp > timestamp) |
+             (models.MetricLog.id > log_id)))
+
+    return logs
+
+
+@api.route('/metrics/latest')
+def latest_logs() -> Response:
+    """The latest log of every enabled metric"""
+
+    latest = []  # type: List[Dict]
+
+    # pylint: disable=singleton-comparison
+    enabled_metrics = models.Metric.select()\
+        .where(models.Metric.disabled == False)\
+        .order_by(models.Metric.name)  # noqa: E712
+
+    for metric in enabled_metrics:
+        # uses the (metric, timestamp) index to only read one log
+        log = metric.get_latest_log()
+
+        latest.append({
+            'metric': metric.name,
+            'topic': metric.topic,
+            'type': metric.type,
+            'timestamp': log.timestamp.isoformat() if log else None,
+            'value': log.value if log else None,
+        })
+
+    return jsonify(metrics=latest)
+
+
+@api.route('/metrics/<name>/logs')
+def metric_logs(name: str) -> Response:
+    """
+    Logs of a metric in the order they were taken, optionally from start up
+    to before end. With a resolution the rollups of the logs are returned
+    instead, one per bucket of that size.
+    """
+
+    metric = _get_metric(name)
+    start = _get_timestamp_arg('start')
+    end = _get_timestamp_arg('end')
+    limit = _get_limit()
+    cursor = request.args.get('cursor')
+    resolution = request.args.get('resolution')
+
+    if resolution:
+        if resolution not in settings.METRIC_ROLLUP_RESOLUTIONS:
+            raise APIError('unknown resolution "{resolution}"'.format(
+                resolution=resolution))
+
+        rollups = metrics.get_rollups(metric, resolution, start, end)
+
+        if cursor:
+            bucket, _ = decode_cursor(cursor)
+            rollups = rollups.where(models.MetricRollup.bucket > bucket)
+
+        return _stream_page('rollups',
+                            rollups.limit(limit + 1).iterator(),
+                            limit,
+                            _rollup_to_json,
+                            lambda rollup: encode_cursor(rollup.bucket))
+
+    after = None  # type: Optional[Tuple[datetime, int]]
+
+    if cursor:
+        timestamp, log_id = decode_cursor(cursor)
+
+        if log_id is None:
+            raise APIError('invalid cursor')
+
+        after = (timestamp, log_id)
+
+    logs = get_logs(metric, start, end, after)
+
+    return _stream_page('logs',
+                        logs.limit(limit + 1).iterator(),
+                        limit,
+                        _log_to_json,
+                        lambda log: encode_cursor(log.timestamp, log.id))
+
+
+@api.route('/stream')
+def live_logs() -> Response:
+    """
+    New logs as server-sent events, only those of the metrics given by
+    name when there are any
+    """
+
+    metric_ids = {_get_metric(name).id
+                  for name in request.args.getlist('metric')}
+    subscription = publisher.subscribe(metric_ids or None)
+
+    def generate() -> Iterable[str]:
+        try:
+            # how long to wait before reconnecting, in milliseconds
+            yield 'retry: {retry}\n\n'.format(
+                retry=int(settings.LIVE_POLL_INTERVAL * 1000))
+
+            while not subscription.closed:
+                event = subscription.get(settings.LIVE_KEEPALIVE_INTERVAL)
+
+                # a comment keeps idle connections from being closed
+                yield event if event is not None else ': keepalive\n\n'
+        finally:
+            publisher.unsubscribe(subscription)
+
+    return Response(generate(),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             # sent right away by proxies such as nginx
+                             'X-Accel-Buffering': 'no'})
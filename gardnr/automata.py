@@ -2,16 +2,26 @@
 """
 Runs the scheduler and workers of scheduled tasks for drivers
 """
-from datetime import timedelta
-from typing import List, TextIO, Tuple
+import threading
+from datetime import timedelta, timezone
+from typing import List, Optional, Tuple
 
+from apscheduler.schedulers.base import BaseScheduler
 from apscheduler.schedulers.blocking import BlockingScheduler
 
-from gardnr import constants, drivers, grow, logger, models, reflection, tasks, settings
+from gardnr import (constants, drivers, grow, logger, metrics, models,
+                    reflection, tasks, settings)
 
 
 trigger_bounds = []  # List[TriggerBound]
 active_trigger_bounds = []  # List[TriggerBound]
+# logs are checked from the thread which created them
+_trigger_bounds_lock = threading.RLock()
+# the recipe and stage the trigger bounds were built for
+_trigger_bounds_recipe = None  # type: Optional[grow.CompiledRecipe]
+_trigger_bounds_stage = None  # type: Optional[str]
+
+STAGE_CHANGE_JOB_ID = 'stage_change'
 
 
 def main() -> None:
@@ -21,6 +31,7 @@ def main() -> None:
     logger.info('Starting automata')
 
     models.initialize_db()
+    metrics.setup_log_buffer()
 
     reflection.add_driver_path(settings.DRIVER_PATH)
 
@@ -43,11 +54,28 @@ def main() -> None:
             day_of_week=schedule.day_of_week,
         )
 
+    # also removes unreferenced blobs, so it runs without retention too
+    scheduler.add_job(
+        tasks.purge,
+        'interval',
+        hours=settings.RETENTION_FREQUENCY
+    )
+
     tracked_grow = grow.get_tracked_grow()
 
     if tracked_grow:
-        with open(settings.GROW_RECIPE) as recipe:
-            _build_trigger_bounds(tracked_grow, recipe)
+        _build_trigger_bounds(tracked_grow)
+        _schedule_stage_change(scheduler, tracked_grow)
+
+        metrics.load_latest_logs()
+        metrics.add_log_listener(trigger_listener)
+
+        # picks up the logs created by other processes
+        scheduler.add_job(
+            metrics.load_latest_logs,
+            'interval',
+            seconds=settings.TRIGGER_POLL_INTERVAL
+        )
 
         scheduler.add_job(
             bound_checker,
@@ -55,7 +83,18 @@ def main() -> None:
             minutes=settings.BOUND_CHECK_FREQUENCY
         )
 
-    scheduler.start()
+        # picks up changes made to the recipe file
+        scheduler.add_job(
+            refresh_trigger_bounds,
+            'interval',
+            [scheduler, tracked_grow],
+            minutes=settings.BOUND_CHECK_FREQUENCY
+        )
+
+    try:
+        scheduler.start()
+    finally:
+        reflection.unload_drivers()
 
 
 def _build_driver_dict(
@@ -136,92 +175,238 @@ class TriggerBound:
         self.trigger = trigger
         self.bound = bound
         self.power_driver = power_driver
+        # number of logs in a row the trigger condition held for
+        self.debounce_count = 0
+        # a log is only checked once, by the listener or the bound checker
+        self.last_log_uuid = None
+
+
+def _build_trigger_bounds(tracked_grow: models.Grow) -> None:
+    """
+    Links the enabled triggers with their bound in the current stage of the
+    grow. Trigger bounds built before keep their state, only their bound
+    changes. Active ones without a bound anymore are still reversed.
+    """
+
+    # pylint: disable=global-statement
+    global _trigger_bounds_recipe, _trigger_bounds_stage
+
+    # joined so the metric and power driver are not each queried later
+    active_triggers = models.Trigger\
+        .select(models.Trigger, models.Metric, models.Driver)\
+        .join(models.Metric)\
+        .switch(models.Trigger)\
+        .join(models.Driver)\
+        .where(models.Trigger.disabled == False)
+
+    with _trigger_bounds_lock:
+        built_trigger_bounds = {tb.trigger.id: tb
+                                for tb in _get_trigger_bounds()}
+        new_trigger_bounds = []
 
+        _trigger_bounds_recipe = grow.get_compiled_recipe()
+        _trigger_bounds_stage = grow.get_current_stage(tracked_grow)
 
-def _build_trigger_bounds(
-        tracked_grow: models.Grow,
-        recipe: TextIO
+        for trigger in active_triggers:
+            metric_bound = grow.get_metric_bound(
+                tracked_grow, trigger.metric.topic, trigger.metric.type)
+
+            if not metric_bound:
+                continue
+
+            if trigger.upper_bound:
+                bound = metric_bound.max
+            else:
+                bound = metric_bound.min
+
+            if bound is None:
+                continue
+
+            tb = built_trigger_bounds.get(trigger.id)
+
+            if tb:
+                tb.bound = bound
+            else:
+                power_driver = reflection.load_driver(trigger.power_driver)
+                tb = TriggerBound(trigger, bound, power_driver)
+
+            new_trigger_bounds.append(tb)
+
+        trigger_bounds[:] = new_trigger_bounds
+
+
+def _schedule_stage_change(
+        scheduler: BaseScheduler,
+        tracked_grow: models.Grow
 ) -> None:
+    """Refreshes the trigger bounds when the next stage of the grow starts"""
 
-    active_triggers = models.Trigger.select().where(
-        models.Trigger.disabled == False)
+    next_stage_change = grow.get_next_stage_change(tracked_grow)
 
-    for trigger in active_triggers:
-        metric_bound = grow.get_metric_bound(
-            recipe, tracked_grow, trigger.metric.topic, trigger.metric.type)
+    if next_stage_change:
+        scheduler.add_job(
+            refresh_trigger_bounds,
+            'date',
+            [scheduler, tracked_grow],
+            id=STAGE_CHANGE_JOB_ID,
+            replace_existing=True,
+            run_date=next_stage_change.replace(tzinfo=timezone.utc)
+        )
 
-        if metric_bound:
-            power_driver = reflection.load_driver(trigger.power_driver)
 
-            if metric_bound.min is not None and not trigger.upper_bound:
-                trigger_bounds.append(TriggerBound(
-                    trigger, metric_bound.min, power_driver))
-            elif metric_bound.max is not None and trigger.upper_bound:
-                trigger_bounds.append(TriggerBound(
-                    trigger, metric_bound.max, power_driver))
+def refresh_trigger_bounds(
+        scheduler: BaseScheduler,
+        tracked_grow: models.Grow
+) -> None:
+    """
+    Builds the trigger bounds again if the grow entered a new stage or the
+    recipe changed since they were built
+    """
 
+    stage = grow.get_current_stage(tracked_grow)
 
-def bound_checker() -> None:
+    if (grow.get_compiled_recipe() is _trigger_bounds_recipe and
+            stage == _trigger_bounds_stage):
+        return
 
-    def _is_out_of_bound(tb: TriggerBound, log: models.MetricLog) -> bool:
+    logger.info('Updating trigger bounds for grow stage {stage}'.format(
+        stage=stage or constants.DEFAULT))
 
-        if tb.trigger.upper_bound and\
-           log.value > tb.bound:
-            return True
+    _build_trigger_bounds(tracked_grow)
+    _schedule_stage_change(scheduler, tracked_grow)
 
-        elif not tb.trigger.upper_bound and\
-                log.value < tb.bound:
-            return True
 
-        return False
+def _is_out_of_bound(tb: TriggerBound, value: float) -> bool:
 
-    # check to reverse the trigger action
-    for tb in active_trigger_bounds:
-        # check since the last run
-        latest_log = tb.trigger.metric.get_latest_log(
-            timedelta(minutes=settings.BOUND_CHECK_FREQUENCY))
+    if tb.trigger.upper_bound:
+        return value > tb.bound
 
-        if latest_log and not _is_out_of_bound(tb, latest_log):
-            log_str = ('Turning {{on_off}} {power_driver_name} to reverse '
-                       'the action for {metric_name} being too '
-                       '{low_high}').format(
-                           power_driver_name=tb.trigger.power_driver.name,
-                           metric_name=tb.trigger.metric.name,
-                           low_high=('high' if tb.trigger.upper_bound
-                                     else 'low'))
+    return value < tb.bound
 
-            reflection.load_driver(tb.trigger.power_driver)
 
-            if tb.trigger.power_on:
-                logger.info(log_str.format(on_off='off'))
-                tb.power_driver.off()
-            else:
-                logger.info(log_str.format(on_off='on'))
-                tb.power_driver.on()
+def _is_back_within_bound(tb: TriggerBound, value: float) -> bool:
+    """Whether value is within the bound by the hysteresis margin"""
 
-            active_trigger_bounds.remove(tb)
+    if tb.trigger.upper_bound:
+        return value <= tb.bound - settings.TRIGGER_HYSTERESIS
 
-    for tb in trigger_bounds:
-        latest_log = tb.trigger.metric.get_latest_log(
-            timedelta(minutes=settings.BOUND_CHECK_FREQUENCY))
-
-        if latest_log and _is_out_of_bound(tb, latest_log):
-            log_str = ('Turning {{on_off}} {power_driver_name} because '
-                       '{metric_name} is too {low_high}').format(
-                           power_driver_name=tb.trigger.power_driver.name,
-                           metric_name=tb.trigger.metric.name,
-                           low_high=('high' if tb.trigger.upper_bound
-                                     else 'low'))
-
-            if tb.trigger.power_on:
-                logger.info(log_str.format(on_off='on'))
-                tb.power_driver.on()
-            else:
-                logger.info(log_str.format(on_off='off'))
-                tb.power_driver.off()
+    return value >= tb.bound + settings.TRIGGER_HYSTERESIS
+
+
+def _trigger_action(tb: TriggerBound) -> None:
+    log_str = ('Turning {{on_off}} {power_driver_name} because '
+               '{metric_name} is too {low_high}').format(
+                   power_driver_name=tb.trigger.power_driver.name,
+                   metric_name=tb.trigger.metric.name,
+                   low_high=('high' if tb.trigger.upper_bound
+                             else 'low'))
+
+    if tb.trigger.power_on:
+        logger.info(log_str.format(on_off='on'))
+        tb.power_driver.on()
+    else:
+        logger.info(log_str.format(on_off='off'))
+        tb.power_driver.off()
+
+
+def _reverse_action(tb: TriggerBound) -> None:
+    log_str = ('Turning {{on_off}} {power_driver_name} to reverse '
+               'the action for {metric_name} being too '
+               '{low_high}').format(
+                   power_driver_name=tb.trigger.power_driver.name,
+                   metric_name=tb.trigger.metric.name,
+                   low_high=('high' if tb.trigger.upper_bound
+                             else 'low'))
+
+    if tb.trigger.power_on:
+        logger.info(log_str.format(on_off='off'))
+        tb.power_driver.off()
+    else:
+        logger.info(log_str.format(on_off='on'))
+        tb.power_driver.on()
+
+
+def check_trigger_bound(tb: TriggerBound, log: models.MetricLog) -> None:
+    """
+    Triggers the action once the log is out of bound, or reverses it once
+    the log is back within the bound, for TRIGGER_DEBOUNCE logs in a row
+    """
+
+    with _trigger_bounds_lock:
+        if log.uuid == tb.last_log_uuid:
+            return
+
+        tb.last_log_uuid = log.uuid
+
+        try:
+            value = float(log.value)
+        except (TypeError, ValueError):
+            logger.warning('Unable to check {metric_name} trigger with '
+                           'value {value}'.format(
+                               metric_name=tb.trigger.metric.name,
+                               value=log.value))
+            return
+
+        active = tb in active_trigger_bounds
+
+        if active:
+            held = _is_back_within_bound(tb, value)
+        else:
+            held = _is_out_of_bound(tb, value)
+
+        if not held:
+            tb.debounce_count = 0
+            return
 
+        tb.debounce_count += 1
+
+        if tb.debounce_count < settings.TRIGGER_DEBOUNCE:
+            return
+
+        tb.debounce_count = 0
+
+        if active:
+            _reverse_action(tb)
+            active_trigger_bounds.remove(tb)
+        else:
+            _trigger_action(tb)
             active_trigger_bounds.append(tb)
 
 
+def _get_trigger_bounds() -> List[TriggerBound]:
+    """Active trigger bounds first, then the rest"""
+
+    return active_trigger_bounds + [tb for tb in trigger_bounds
+                                    if tb not in active_trigger_bounds]
+
+
+def trigger_listener(log: models.MetricLog) -> None:
+    """Checks a new log against the trigger bounds of its metric"""
+
+    with _trigger_bounds_lock:
+        for tb in _get_trigger_bounds():
+            if tb.trigger.metric_id == log.metric_id:
+                check_trigger_bound(tb, log)
+
+
+def bound_checker() -> None:
+    """
+    Fallback for trigger_listener, checks the latest log of each trigger
+    since the last run
+    """
+
+    # only reads the logs created by other processes since the last check
+    metrics.load_latest_logs()
+
+    with _trigger_bounds_lock:
+        for tb in _get_trigger_bounds():
+            latest_log = metrics.get_latest_log(
+                tb.trigger.metric_id,
+                timedelta(minutes=settings.BOUND_CHECK_FREQUENCY))
+
+            if latest_log:
+                check_trigger_bound(tb, latest_log)
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,164 @@
+"""
+Content-addressed store for uploaded files. Files are stored once by the
+hash of their contents, sharded into directories by the first characters
+of the hash, and counted by the metric logs referencing them.
+"""
+import hashlib
+import os
+import tempfile
+from collections import Counter
+from typing import BinaryIO, Iterable, List, Tuple
+
+from gardnr import logger, models, settings
+
+# files are copied in chunks of this many bytes, so the memory used by an
+# upload does not grow with its size
+CHUNK_SIZE = 64 * 1024
+
+# read once, setting it is the only way to read it and not thread-safe
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# number of directory levels, and hash characters per level
+SHARD_DEPTH = 2
+SHARD_WIDTH = 2
+
+
+def get_blob_path(digest: str, extension: str) -> str:
+    """Path of a blob relative to settings.UPLOAD_PATH"""
+
+    shards = [digest[level * SHARD_WIDTH:(level + 1) * SHARD_WIDTH]
+              for level in range(SHARD_DEPTH)]
+
+    return os.path.join(*shards, digest + extension)
+
+
+def write_temp_file(file: BinaryIO) -> Tuple[str, str, int]:
+    """
+    Copies file in chunks to a temporary file in settings.UPLOAD_PATH,
+    hashing it in the same pass. Returns the path of the temporary file,
+    the SHA-256 hex digest and the size of the contents.
+    """
+
+    digest = hashlib.sha256()
+    size = 0
+
+    file_descriptor, temp_path = tempfile.mkstemp(
+        dir=settings.UPLOAD_PATH, prefix='.', suffix='.part')
+
+    try:
+        with os.fdopen(file_descriptor, 'wb') as temp_file:
+            # mkstemp makes the file owner-only, stored files get the
+            # default mode of new files like any other
+            os.fchmod(temp_file.fileno(), 0o666 & ~_UMASK)
+
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                size += len(chunk)
+                temp_file.write(chunk)
+
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+    except BaseException:
+        _remove(temp_path)
+        raise
+
+    return temp_path, digest.hexdigest(), size
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def store(file: BinaryIO, extension: str) -> models.Blob:
+    """
+    Stores the contents of file, unless a blob with the same contents is
+    already stored, and adds a reference to the blob. The path of the blob
+    has extension, e.g. '.jpg', when it is first stored.
+    """
+
+    temp_path, digest, size = write_temp_file(file)
+
+    try:
+        # the file is moved into place while holding the write lock, so
+        # garbage collection can never remove it once it is referenced
+        with models.atomic():
+            updated = models.Blob\
+                .update(refs=models.Blob.refs + 1)\
+                .where(models.Blob.hash == digest)\
+                .execute()
+
+            if updated:
+                blob = models.Blob.get(models.Blob.hash == digest)
+            else:
+                blob = models.Blob.create(
+                    hash=digest,
+                    path=get_blob_path(digest, extension),
+                    size=size,
+                    refs=1)
+
+            full_path = os.path.join(settings.UPLOAD_PATH, blob.path)
+
+            if not updated or not os.path.exists(full_path):
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                os.replace(temp_path, full_path)
+    finally:
+        _remove(temp_path)
+
+    return blob
+
+
+def release(paths: Iterable[str]) -> List[str]:
+    """
+    Drops a reference to the blob at each of paths, the blobs are removed
+    by collect_garbage once they are no longer referenced. Returns the
+    paths which are not blobs, i.e. files uploaded by older versions.
+    """
+
+    not_blobs = []
+
+    for path, count in Counter(paths).items():
+        updated = models.Blob\
+            .update(refs=models.Blob.refs - count)\
+            .where(models.Blob.path == path)\
+            .execute()
+
+        if not updated:
+            not_blobs.append(path)
+
+    return not_blobs
+
+
+def collect_garbage() -> int:
+    """
+    Removes the blobs which are no longer referenced along with their
+    files. Returns the number of blobs removed.
+    """
+
+    unreferenced = models.Blob\
+        .select(models.Blob.id, models.Blob.path)\
+        .where(models.Blob.refs <= 0)\
+        .tuples()
+
+    removed = 0
+
+    for blob_id, path in list(unreferenced):
+        try:
+            # only if it was not referenced again in the meantime, the file
+            # is removed while holding the write lock like in store
+            with models.atomic():
+                deleted = models.Blob.delete()\
+                    .where((models.Blob.id == blob_id) &
+                           (models.Blob.refs <= 0))\
+                    .execute()
+
+                if deleted:
+                    _remove(os.path.join(settings.UPLOAD_PATH, path))
+                    removed += 1
+        except OSError:
+            logger.exception('Error removing blob {path}'.format(path=path))
+
+    return removed
@@ -11,7 +11,7 @@ import shutil
 from datetime import datetime
 from typing import List, Optional, Tuple
 
-from gardnr import (constants, grow, logger, models,
+from gardnr import (blobs, constants, grow, logger, metrics, models,
                     reflection, settings, tasks)
 
 LOGO = (r"""
@@ -41,6 +41,7 @@ def main() -> None:
 
     # wait to see if in test mode to initialize the database
     models.initialize_db()
+    metrics.setup_log_buffer()
 
     reflection.add_driver_path(settings.DRIVER_PATH)
 
@@ -213,9 +214,20 @@ def remove_metric(args: argparse.Namespace) -> None:
     models.ExportLog.delete().where(
         models.ExportLog.metric_log.in_(metric_logs)).execute()
 
+    # the files are removed with the next purge, unless other logs have
+    # the same contents
+    blobs.release(path for path, in models.MetricLog
+                  .select(models.MetricLog.path)
+                  .where((models.MetricLog.metric == metric) &
+                         models.MetricLog.path.is_null(False))
+                  .tuples())
+
     models.MetricLog.delete().where(
         models.MetricLog.metric == metric).execute()
 
+    models.MetricRollup.delete().where(
+        models.MetricRollup.metric == metric).execute()
+
     metric.delete_instance()
 
     print('{name} metric removed'.format(name=metric.name))
@@ -227,6 +239,8 @@ def remove_driver(args: argparse.Namespace) -> None:
     if driver.type == constants.EXPORTER:
         models.ExportLog.delete().where(
             models.ExportLog.driver == driver).execute()
+        models.ExportWatermark.delete().where(
+            models.ExportWatermark.driver == driver).execute()
 
     driver.delete_instance()
 
@@ -523,6 +537,14 @@ def manual_actions(args: argparse.Namespace) -> None:
                 metric_name=metric.name))
 
 
+def rollup_actions(args: argparse.Namespace) -> None:
+    del args  # backfill is the only action
+
+    print('Rolling up existing metric logs')
+    metrics.backfill_rollups()
+    print('Metric log rollups backfilled')
+
+
 def read(args: argparse.Namespace) -> None:
 
     sensors = reflection.load_active_drivers(
@@ -879,6 +901,12 @@ def create_parser() -> argparse.ArgumentParser:
                                help='name of the metric')
     manual_parser.set_defaults(func=manual_actions)
 
+    rollup_parser = subparsers.add_parser('rollup',
+                                          help='Manages the minute, hour '
+                                          'and day rollups of metric logs')
+    rollup_parser.add_argument('action', choices=['backfill'])
+    rollup_parser.set_defaults(func=rollup_actions)
+
     drivers_include_help = 'Optional list of specific driver to include.'
     drivers_exclude_help = 'Optional list of specific driver to exclude.'
 
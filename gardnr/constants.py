@@ -6,6 +6,11 @@ POWER = 'power'
 GARDNR_METRICS = {NOTES, IMAGE, POWER}
 metrics = metrics.union(GARDNR_METRICS)
 
+# metric types whose values are stored as text, or as the path of a file in
+# settings.UPLOAD_PATH, the values of every other metric type are numbers
+TEXT_METRICS = {NOTES}
+FILE_METRICS = {IMAGE}
+
 MANUAL_OVERRIDE_CONFIG = 'manual'
 
 
@@ -18,3 +23,19 @@ drivers = {SENSOR, POWER, EXPORTER}
 CELSIUS = 'c'
 FAHRENHEIT = 'f'
 t9e_untis = {CELSIUS, FAHRENHEIT}
+
+
+# how exporters keep track of which metric logs they have exported
+EXPORT_LOG = 'log'
+EXPORT_WATERMARK = 'watermark'
+export_tracking = {EXPORT_LOG, EXPORT_WATERMARK}
+
+
+# time buckets metric logs are rolled up into
+ROLLUP_MINUTE = 'minute'
+ROLLUP_HOUR = 'hour'
+ROLLUP_DAY = 'day'
+rollup_resolutions = {ROLLUP_MINUTE, ROLLUP_HOUR, ROLLUP_DAY}
+
+# retention of the metric logs themselves, next to the rollup resolutions
+RETENTION_RAW = 'raw'
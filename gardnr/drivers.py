@@ -4,7 +4,7 @@ drivers must inhereit at least one of these. Drivers hold the code
 that interacts with the connected hardware.
 """
 from abc import ABCMeta, abstractmethod
-from typing import List
+from typing import List, Optional
 
 from gardnr import constants, logger, models
 
@@ -36,6 +36,13 @@ class Driver(metaclass=ABCMeta):
         """Do not override __init__, override setup instead."""
         pass
 
+    def teardown(self) -> None:
+        """
+        Drivers are reused between runs, override to release what was
+        acquired in setup when the driver is unloaded.
+        """
+        pass
+
     @property
     @staticmethod
     @abstractmethod
@@ -68,6 +75,14 @@ class Sensor(Driver, metaclass=ABCMeta):
     def type() -> str:
         return constants.SENSOR
 
+    # when sensors are read concurrently, sensors in the same concurrency
+    # group are still read one at a time, e.g. sensors sharing a bus
+    concurrency_group = None  # type: Optional[str]
+
+    # seconds to wait for a read when sensors are read concurrently,
+    # overrides settings.READ_TIMEOUT
+    timeout = None  # type: Optional[float]
+
     def read(self) -> None:
         """get the readings of the sensor"""
         raise NotImplementedError()
@@ -79,6 +94,20 @@ class Exporter(Driver, metaclass=ABCMeta):
     whitelist = None
     blacklist = None
 
+    # either constants.EXPORT_LOG to record every exported log in ExportLog
+    # or constants.EXPORT_WATERMARK to only store the position of the last
+    # exported log, which keeps finding new logs fast as history grows
+    export_tracking = constants.EXPORT_LOG
+
+    # when set, export is called once for every batch_size logs instead of
+    # once with all of them, which bounds the memory used by large backlogs.
+    # Each batch is recorded as exported before the next one is queried.
+    batch_size = None  # type: Optional[int]
+
+    # seconds to wait for the exporter when exporters run concurrently,
+    # overrides settings.EXPORT_TIMEOUT
+    timeout = None  # type: Optional[float]
+
     @property
     @staticmethod
     def type() -> str:
@@ -1,10 +1,15 @@
-from datetime import datetime
-from typing import Optional, TextIO
+import os
+import threading
+from bisect import bisect_right
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
 from uuid import uuid4
+from xml.etree import ElementTree
 
 import grow_recipe
+from grow_recipe.query.find_metric_value import Metric
 
-from gardnr import models, settings
+from gardnr import constants, models, settings
 
 
 class GrowAlreadyActiveError(Exception):
@@ -34,23 +39,187 @@ def get_tracked_grow() -> Optional[models.Grow]:
     return None
 
 
-def get_current_stage(active_grow: models.Grow) -> Optional[str]:
+class CompiledRecipe:
+    """
+    A grow recipe parsed once into a timeline of its stages, with the bound
+    of every metric in each of them
+    """
+
+    def __init__(self, recipe_path: str) -> None:
+        with open(recipe_path) as recipe:
+            # raise schema errors if they exist
+            grow_recipe.check_for_error(recipe)
+
+            recipe.seek(0)
+            root = ElementTree.parse(recipe).getroot()
+
+        # seconds since the start of the grow when each stage starts, the
+        # last one is when the recipe ends and only the default applies
+        self.stage_starts = []  # type: List[float]
+        self.stages = []  # type: List[Optional[str]]
+        stage_bounds = []  # type: List[Dict[Tuple[str, str], Metric]]
+        default_bounds = {}  # type: Dict[Tuple[str, str], Metric]
+
+        stage_start = 0
+        for stage in root:
+            if stage.tag == constants.DEFAULT:
+                default_bounds = self._parse_bounds(stage)
+                continue
+
+            duration = stage.attrib.get('duration')
+            if duration is None:
+                continue
+
+            self.stage_starts.append(stage_start)
+            self.stages.append(stage.tag)
+            stage_bounds.append(self._parse_bounds(stage))
+
+            stage_start += int(duration)
+
+        self.stage_starts.append(stage_start)
+        self.stages.append(None)
+        stage_bounds.append({})
+
+        # the bound of a (topic, metric type) in every stage, falling back
+        # on the default stage
+        self.bounds = {
+            key: [bounds.get(key, default_bounds.get(key))
+                  for bounds in stage_bounds]
+            for key in set(default_bounds).union(*stage_bounds)
+        }  # type: Dict[Tuple[str, str], List[Optional[Metric]]]
+
+    @staticmethod
+    def _parse_bounds(stage: ElementTree.Element) -> Dict[Tuple[str, str],
+                                                          Metric]:
+        bounds = {}
+
+        for topic in stage:
+            for metric in topic:
+                min_value = metric.attrib.get('min')
+                max_value = metric.attrib.get('max')
+
+                if min_value is None and max_value is None:
+                    continue
+
+                bounds[(topic.tag, metric.tag)] = Metric(
+                    float(min_value) if min_value is not None else None,
+                    float(max_value) if max_value is not None else None)
+
+        return bounds
+
+    def _stage_index(self, elapsed: float) -> int:
+        # the first stage also covers the time before the grow started
+        return max(0, bisect_right(self.stage_starts, elapsed) - 1)
+
+    def get_stage(self, elapsed: float) -> Optional[str]:
+        """The stage elapsed seconds into the grow"""
+
+        return self.stages[self._stage_index(elapsed)]
+
+    def get_metric_bound(
+            self,
+            metric_topic: str,
+            metric_type: str,
+            elapsed: float
+    ) -> Optional[Metric]:
+        """The bound of a metric elapsed seconds into the grow"""
+
+        bounds = self.bounds.get((metric_topic, metric_type))
+
+        if not bounds:
+            return None
+
+        return bounds[self._stage_index(elapsed)]
+
+    def get_next_stage_start(self, elapsed: float) -> Optional[float]:
+        """Seconds into the grow when the stage after elapsed starts"""
+
+        index = bisect_right(self.stage_starts, elapsed)
+
+        if index == len(self.stage_starts):
+            return None
+
+        return self.stage_starts[index]
 
-    if settings.GROW_RECIPE:
-        with open(settings.GROW_RECIPE) as recipe:
-            return grow_recipe.get_grow_stage(recipe, active_grow.start)
+
+# compiled from settings.GROW_RECIPE, compiled again when the file changes
+_compiled_recipe = None  # type: Optional[CompiledRecipe]
+_compiled_recipe_key = None  # type: Optional[Tuple[str, int]]
+_compiled_recipe_lock = threading.Lock()
+
+
+def get_compiled_recipe() -> Optional[CompiledRecipe]:
+    """The compiled grow recipe, None when there is no recipe set"""
+
+    # pylint: disable=global-statement
+    global _compiled_recipe, _compiled_recipe_key
+
+    if not settings.GROW_RECIPE:
+        return None
+
+    key = (settings.GROW_RECIPE, os.stat(settings.GROW_RECIPE).st_mtime_ns)
+
+    with _compiled_recipe_lock:
+        if key != _compiled_recipe_key:
+            _compiled_recipe = CompiledRecipe(settings.GROW_RECIPE)
+            _compiled_recipe_key = key
+
+        return _compiled_recipe
+
+
+def _elapsed(active_grow: models.Grow,
+             query_time: Optional[datetime] = None) -> float:
+    """Seconds since the start of the grow"""
+
+    return ((query_time or datetime.utcnow()) -
+            active_grow.start).total_seconds()
+
+
+def get_current_stage(
+        active_grow: models.Grow,
+        query_time: Optional[datetime] = None
+) -> Optional[str]:
+
+    recipe = get_compiled_recipe()
+
+    if recipe:
+        return recipe.get_stage(_elapsed(active_grow, query_time))
 
     return None
 
 
 def get_metric_bound(
-        recipe: TextIO,
         tracked_grow: models.Grow,
         metric_topic: str,
-        metric_type: str
-) -> Optional[grow_recipe.query.find_metric_value.Metric]:
-    return grow_recipe.get_metric(
-        recipe, metric_topic, metric_type, tracked_grow.start)
+        metric_type: str,
+        query_time: Optional[datetime] = None
+) -> Optional[Metric]:
+
+    recipe = get_compiled_recipe()
+
+    if recipe:
+        return recipe.get_metric_bound(metric_topic, metric_type,
+                                       _elapsed(tracked_grow, query_time))
+
+    return None
+
+
+def get_next_stage_change(
+        tracked_grow: models.Grow,
+        query_time: Optional[datetime] = None
+) -> Optional[datetime]:
+    """When the next stage of the grow starts, in UTC"""
+
+    recipe = get_compiled_recipe()
+
+    if recipe:
+        next_start = recipe.get_next_stage_start(
+            _elapsed(tracked_grow, query_time))
+
+        if next_start is not None:
+            return tracked_grow.start + timedelta(seconds=next_start)
+
+    return None
 
 
 def start() -> None:
@@ -1,48 +1,723 @@
-import os
-from typing import Any
-from uuid import uuid4
+import atexit
+import io
+import signal
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import (Any, BinaryIO, Callable, Dict, Iterable, List, Optional,
+                    Set, Tuple, Type, Union)
+from uuid import UUID, uuid4
 
-from gardnr import constants, models, settings
+import peewee
 
+from gardnr import blobs, constants, logger, models, settings
 
-def create_metric_log(metric_name: str, value: Any) -> models.MetricLog:
-    """sets up common metric log fields"""
+# metrics by name, dropped when the metrics change
+_metrics = {}  # type: Dict[str, models.Metric]
+_metrics_revision = None  # type: Optional[int]
+_metrics_local_bumps = None  # type: Optional[int]
+_metrics_checked = 0.0
+_metrics_lock = threading.Lock()
 
-    metric = models.Metric.get(models.Metric.name == metric_name)
 
-    return models.MetricLog.create(id=uuid4(), metric=metric, value=value)
+def invalidate_metric_cache() -> None:
+    """Forgets every cached metric"""
 
+    # pylint: disable=global-statement
+    global _metrics_revision, _metrics_local_bumps
 
-def create_file_log(metric_name: str,
-                    blob: bytes,
+    with _metrics_lock:
+        _metrics.clear()
+        _metrics_revision = None
+        _metrics_local_bumps = None
+
+
+def _check_metric_cache() -> None:
+    """
+    Drops the cached metrics if the metrics have changed. Changes made by
+    this process are noticed right away, changes from other processes
+    (e.g. the CLI) after at most settings.METRIC_CACHE_CHECK_INTERVAL
+    seconds.
+    """
+
+    # pylint: disable=global-statement
+    global _metrics_revision, _metrics_local_bumps, _metrics_checked
+
+    local_bumps = models.Revision.get_local_bumps(models.Metric)
+    now = time.monotonic()
+
+    if (local_bumps == _metrics_local_bumps and
+            now - _metrics_checked < settings.METRIC_CACHE_CHECK_INTERVAL):
+        return
+
+    revision = models.Revision.get_revision(models.Metric)
+
+    with _metrics_lock:
+        if revision != _metrics_revision:
+            _metrics.clear()
+
+        _metrics_revision = revision
+        _metrics_local_bumps = local_bumps
+        _metrics_checked = now
+
+
+def find_metric(metric_name: str) -> Optional[models.Metric]:
+    """Looks up a metric by name, only queried the first time"""
+
+    _check_metric_cache()
+
+    metric = _metrics.get(metric_name)
+
+    if not metric:
+        metric = models.Metric.get_or_none(models.Metric.name == metric_name)
+
+        if metric:
+            with _metrics_lock:
+                _metrics[metric_name] = metric
+
+    return metric
+
+
+def find_metric_by_id(metric_id: UUID) -> Optional[models.Metric]:
+    """Looks up a metric by ID, only queried the first time"""
+
+    _check_metric_cache()
+
+    for metric in list(_metrics.values()):
+        if metric.id == metric_id:
+            return metric
+
+    metric = models.Metric.get_or_none(models.Metric.id == metric_id)
+
+    if metric:
+        with _metrics_lock:
+            _metrics[metric.name] = metric
+
+    return metric
+
+
+def _resolve_metric(
+        metric: Union[str, UUID, models.Metric]
+) -> models.Metric:
+    """
+    Resolves what a log can reference its metric with. Metrics are used as
+    they are, names and IDs are looked up.
+    """
+
+    if isinstance(metric, models.Metric):
+        return metric
+
+    if isinstance(metric, UUID):
+        found_metric = find_metric_by_id(metric)
+    else:
+        found_metric = find_metric(metric)
+
+    if not found_metric:
+        raise models.Metric.DoesNotExist(
+            'metric "{name}" does not exist'.format(name=metric))
+
+    return found_metric
+
+
+# SQLite limits the number of variables in a statement
+INSERT_BATCH_SIZE = 100
+
+
+def _to_row(log: models.MetricLog) -> Dict:
+    """
+    Every field of log but its id, insert_many takes the columns of all
+    rows from the first one
+    """
+
+    # pylint: disable=protected-access
+    return {field.name: log.__data__.get(field.name)
+            for field in models.MetricLog._meta.sorted_fields
+            if not field.primary_key}
+
+
+def _insert_rows(rows: List[Dict]) -> None:
+    """
+    Inserts metric logs, as dicts of their fields, along with their rollups
+    in a single transaction
+    """
+
+    with models.atomic():
+        for batch in peewee.chunked(rows, INSERT_BATCH_SIZE):
+            models.MetricLog.insert_many(batch).execute()
+
+        update_rollups((row['metric'], row['timestamp'], row.get('number'))
+                       for row in rows)
+
+
+class MetricLogBuffer:
+    """
+    Write-behind buffer for metric logs. Logs are inserted together in a
+    single transaction once size of them are buffered, or every interval
+    seconds from a background thread. Buffered logs only get their id once
+    they are inserted. While inserting them fails at most limit logs are
+    kept, the oldest ones past it are dropped.
+    """
+
+    def __init__(self, size: int, interval: float, limit: int) -> None:
+        self.size = size
+        self.interval = interval
+        self.limit = max(limit, size)
+
+        self._rows = []  # type: List[Dict]
+        self._lock = threading.Lock()
+        self._flusher = None  # type: Optional[threading.Thread]
+        self._closed = threading.Event()
+
+    def add(self, log: models.MetricLog) -> None:
+        with self._lock:
+            self._rows.append(_to_row(log))
+            full = len(self._rows) >= self.size
+
+            # (re)started lazily, threads do not survive forking
+            if not self._flusher or not self._flusher.is_alive():
+                self._flusher = threading.Thread(target=self._flush_forever,
+                                                 daemon=True)
+                self._flusher.start()
+
+        if full:
+            try:
+                self.flush()
+            except Exception:  # pylint: disable=broad-except
+                # log is buffered, it is inserted with the next flush
+                logger.exception('Error flushing metric logs')
+
+    def flush(self) -> None:
+        """Inserts the buffered logs"""
+
+        with self._lock:
+            rows, self._rows = self._rows, []
+
+        if not rows:
+            return
+
+        try:
+            _insert_rows(rows)
+        except Exception:
+            # keep them for the next flush
+            with self._lock:
+                self._rows = rows + self._rows
+                dropped = self._rows[:-self.limit]
+                del self._rows[:-self.limit]
+
+            if dropped:
+                _untrack_created_logs(row['uuid'] for row in dropped)
+                logger.error('Dropped {count} buffered metric logs'.format(
+                    count=len(dropped)))
+            raise
+
+    def _flush_forever(self) -> None:
+        while not self._closed.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Error flushing metric logs')
+
+    def close(self) -> None:
+        """Stops flushing in the background and flushes what is left"""
+
+        self._closed.set()
+
+        if self._flusher and self._flusher is not threading.current_thread():
+            self._flusher.join()
+
+        self.flush()
+
+
+_log_buffer = None  # type: Optional[MetricLogBuffer]
+_log_buffer_lock = threading.Lock()
+
+
+def get_log_buffer() -> Optional[MetricLogBuffer]:
+    """
+    The buffer used by this process for metric logs, None when
+    settings.METRIC_LOG_BUFFER_SIZE is not set
+    """
+
+    # pylint: disable=global-statement
+    global _log_buffer
+
+    if not settings.METRIC_LOG_BUFFER_SIZE:
+        return None
+
+    with _log_buffer_lock:
+        if not _log_buffer:
+            _log_buffer = MetricLogBuffer(
+                settings.METRIC_LOG_BUFFER_SIZE,
+                settings.METRIC_LOG_BUFFER_INTERVAL,
+                settings.METRIC_LOG_BUFFER_LIMIT)
+
+        return _log_buffer
+
+
+def close_log_buffer() -> None:
+    """Flushes the buffered metric logs and stops buffering them"""
+
+    # pylint: disable=global-statement
+    global _log_buffer
+
+    with _log_buffer_lock:
+        log_buffer, _log_buffer = _log_buffer, None
+
+    if log_buffer:
+        log_buffer.close()
+
+
+def _exit_on_sigterm(signum: int, frame: Any) -> None:
+    del signum, frame
+    # unwinds like any other exit, so the buffer is flushed by atexit
+    sys.exit(0)
+
+
+def setup_log_buffer(handle_sigterm: bool = True) -> None:
+    """
+    Makes sure buffered metric logs are flushed when the process exits,
+    including when it is stopped by SIGTERM unless that is handled
+    elsewhere (e.g. by gunicorn)
+    """
+
+    atexit.register(close_log_buffer)
+
+    if (handle_sigterm and
+            threading.current_thread() is threading.main_thread() and
+            signal.getsignal(signal.SIGTERM) == signal.SIG_DFL):
+        signal.signal(signal.SIGTERM, _exit_on_sigterm)
+
+
+# functions called with every new log
+_log_listeners = []  # type: List[Callable[[models.MetricLog], None]]
+
+
+def add_log_listener(listener: Callable[[models.MetricLog], None]) -> None:
+    """
+    Calls listener with every log created by this process and, once
+    load_latest_logs is used, every log it finds from other processes
+    """
+
+    _log_listeners.append(listener)
+
+
+def remove_log_listener(
+        listener: Callable[[models.MetricLog], None]
+) -> None:
+    _log_listeners.remove(listener)
+
+
+def _notify_log_listeners(log: models.MetricLog) -> None:
+    for listener in list(_log_listeners):
+        try:
+            listener(log)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Error in metric log listener')
+
+
+# latest log of each metric by metric id, kept up to date by the logs
+# created in this process and caught up with the logs created by other
+# processes through the rowid of the last log seen, rowids are never reused
+# so logs deleted by other processes never hide the new ones
+_latest_logs = {}  # type: Dict[UUID, models.MetricLog]
+_latest_logs_rowid = None  # type: Optional[int]
+_latest_logs_lock = threading.Lock()
+# only one catch up at a time, so no log is passed to the listeners twice
+_load_latest_logs_lock = threading.Lock()
+# UUIDs of the logs created by this process which have not been caught up
+# with yet, so listeners are not notified about them twice. Buffered logs
+# have no id until they are inserted.
+_created_log_uuids = set()  # type: Set[UUID]
+
+
+def _record_latest_log(log: models.MetricLog) -> None:
+    with _latest_logs_lock:
+        latest_log = _latest_logs.get(log.metric_id)
+
+        if not latest_log or log.timestamp >= latest_log.timestamp:
+            _latest_logs[log.metric_id] = log
+
+
+def reset_latest_logs() -> None:
+    """
+    Forgets the latest logs, they are loaded again when needed. Only needed
+    when the database is replaced, e.g. between tests.
+    """
+
+    # pylint: disable=global-statement
+    global _latest_logs_rowid
+
+    with _latest_logs_lock:
+        _latest_logs.clear()
+        _latest_logs_rowid = None
+        _created_log_uuids.clear()
+
+
+def load_latest_logs() -> None:
+    """
+    Loads the latest log of every metric from the database the first
+    time, after that only the logs added since the last load are read and
+    the ones created by other processes are passed to the log listeners
+    """
+
+    with _load_latest_logs_lock:
+        _load_latest_logs()
+
+
+def _load_latest_logs() -> None:
+    # pylint: disable=global-statement
+    global _latest_logs_rowid
+
+    if _latest_logs_rowid is None:
+        last_rowid = models.MetricLog.select(
+            peewee.fn.MAX(models.METRIC_LOG_ROWID)).scalar() or 0
+
+        for metric in models.Metric.select():
+            latest_log = metric.get_latest_log()
+
+            if latest_log:
+                _record_latest_log(latest_log)
+    else:
+        last_rowid = _latest_logs_rowid
+
+        new_logs = models.MetricLog.select(
+            models.MetricLog,
+            models.METRIC_LOG_ROWID.alias('rowid')
+        ).where(models.METRIC_LOG_ROWID > last_rowid)\
+            .order_by(models.METRIC_LOG_ROWID)
+
+        for log in new_logs.iterator():
+            last_rowid = log.rowid
+
+            with _latest_logs_lock:
+                if log.uuid in _created_log_uuids:
+                    _created_log_uuids.discard(log.uuid)
+                    continue
+
+            _record_latest_log(log)
+            _notify_log_listeners(log)
+
+    _latest_logs_rowid = last_rowid
+
+
+def get_latest_log(
+        metric_id: UUID,
+        cutoff: Optional[timedelta] = None
+) -> Optional[models.MetricLog]:
+    """
+    Like Metric.get_latest_log but from memory, call load_latest_logs
+    first to include the logs created by other processes
+    """
+
+    latest_log = _latest_logs.get(metric_id)
+
+    if (latest_log and cutoff and
+            latest_log.timestamp < datetime.utcnow() - cutoff):
+        return None
+
+    return latest_log
+
+
+class _RollupAggregate:
+    """Aggregate of the values added to a rollup bucket"""
+
+    def __init__(self, timestamp: datetime, value: float) -> None:
+        self.count = 1
+        self.total = value
+        self.min = value
+        self.max = value
+        self.last = value
+        self.last_timestamp = timestamp
+
+    def add(self, timestamp: datetime, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+        if timestamp >= self.last_timestamp:
+            self.last = value
+            self.last_timestamp = timestamp
+
+
+def _rollup_bucket(timestamp: datetime, resolution: str) -> datetime:
+    """When the bucket of resolution which timestamp falls in starts"""
+
+    if resolution == constants.ROLLUP_MINUTE:
+        return timestamp.replace(second=0, microsecond=0)
+    elif resolution == constants.ROLLUP_HOUR:
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+# plain SQL, building these queries with peewee for every log takes longer
+# than running them
+_UPDATE_ROLLUP_SQL = (
+    'UPDATE metricrollup SET '
+    'count = count + ?, '
+    'total = total + ?, '
+    'min = MIN(COALESCE(min, ?), ?), '
+    'max = MAX(COALESCE(max, ?), ?), '
+    'last = CASE WHEN last_timestamp IS NULL OR last_timestamp <= ? '
+    'THEN ? ELSE last END, '
+    'last_timestamp = MAX(COALESCE(last_timestamp, ?), ?) '
+    'WHERE metric_id = ? AND resolution = ? AND bucket = ?')
+_INSERT_ROLLUP_SQL = (
+    'INSERT INTO metricrollup (metric_id, resolution, bucket, count, total, '
+    'min, max, last, last_timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)')
+
+
+def update_rollups(logs: Iterable[Tuple[UUID, datetime, Any]]) -> None:
+    """
+    Adds logs, as (metric id, timestamp, number), to the rollups of their
+    metric. Logs are aggregated in memory first so each bucket is only
+    updated once, logs without a number are skipped.
+    """
+
+    aggregates = {}  # type: Dict[Tuple[UUID, str, datetime], _RollupAggregate]
+
+    for metric_id, timestamp, value in logs:
+        if not isinstance(value, (int, float)):
+            continue
+
+        for resolution in settings.METRIC_ROLLUP_RESOLUTIONS:
+            key = (metric_id, resolution, _rollup_bucket(timestamp,
+                                                         resolution))
+
+            if key in aggregates:
+                aggregates[key].add(timestamp, value)
+            else:
+                aggregates[key] = _RollupAggregate(timestamp, value)
+
+    if not aggregates:
+        return
+
+    with models.atomic():
+        for (metric_id, resolution, bucket), aggregate in aggregates.items():
+            # dates are compared as text, formatted the way they are stored
+            bucket_str = bucket.isoformat(' ')
+            last_timestamp = aggregate.last_timestamp.isoformat(' ')
+            metric_hex = models.MetricRollup.metric.db_value(metric_id)
+
+            cursor = models.execute_sql(_UPDATE_ROLLUP_SQL, (
+                aggregate.count, aggregate.total,
+                aggregate.min, aggregate.min,
+                aggregate.max, aggregate.max,
+                last_timestamp, aggregate.last,
+                last_timestamp, last_timestamp,
+                metric_hex, resolution, bucket_str))
+
+            # the update holds the write lock, so no other process can add
+            # the bucket in between
+            if not cursor.rowcount:
+                models.execute_sql(_INSERT_ROLLUP_SQL, (
+                    metric_hex, resolution, bucket_str,
+                    aggregate.count, aggregate.total,
+                    aggregate.min, aggregate.max,
+                    aggregate.last, last_timestamp))
+
+
+def backfill_rollups(batch_size: int = 1000) -> None:
+    """
+    Rebuilds the rollups from the existing metric logs, in batches of logs
+    so the database is not locked for long. Logs created meanwhile are
+    rolled up as usual.
+    """
+
+    with models.atomic():
+        models.MetricRollup.delete().execute()
+
+        last_rowid = models.MetricLog.select(
+            peewee.fn.MAX(models.METRIC_LOG_ROWID)).scalar() or 0
+
+    position = 0
+
+    while position < last_rowid:
+        logs = list(models.MetricLog.select(
+            models.MetricLog.metric,
+            models.MetricLog.timestamp,
+            models.MetricLog.number,
+            models.METRIC_LOG_ROWID
+        ).where((models.METRIC_LOG_ROWID > position) &
+                (models.METRIC_LOG_ROWID <= last_rowid))
+                    .order_by(models.METRIC_LOG_ROWID)
+                    .limit(batch_size)
+                    .tuples())
+
+        if not logs:
+            break
+
+        update_rollups((metric_id, timestamp, value)
+                       for metric_id, timestamp, value, _ in logs)
+
+        position = logs[-1][3]
+
+
+def get_rollups(
+        metric: Union[str, UUID, models.Metric],
+        resolution: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None
+) -> peewee.ModelSelect:
+    """
+    Rollups of a metric with buckets starting from start up to before end,
+    in the order of their buckets
+    """
+
+    metric = _resolve_metric(metric)
+
+    rollups = models.MetricRollup.select()\
+        .where((models.MetricRollup.metric == metric) &
+               (models.MetricRollup.resolution == resolution))\
+        .order_by(models.MetricRollup.bucket)
+
+    if start:
+        rollups = rollups.where(models.MetricRollup.bucket >= start)
+
+    if end:
+        rollups = rollups.where(models.MetricRollup.bucket < end)
+
+    return rollups
+
+
+def _track_created_logs(logs: List[models.MetricLog]) -> bool:
+    """
+    Remembers logs created by this process so a catch up does not pass
+    them to the listeners again. Only needed once the process catches up
+    with the logs of others, returns whether they were tracked.
+    """
+
+    if _latest_logs_rowid is None:
+        return False
+
+    with _latest_logs_lock:
+        _created_log_uuids.update(log.uuid for log in logs)
+
+    return True
+
+
+def _untrack_created_logs(log_uuids: Iterable[UUID]) -> None:
+    with _latest_logs_lock:
+        _created_log_uuids.difference_update(log_uuids)
+
+
+def _save_log(log: models.MetricLog) -> models.MetricLog:
+    """Inserts the log, or buffers it when buffering is enabled"""
+
+    log_buffer = get_log_buffer()
+
+    # before the insert so a catch up never finds it untracked
+    tracked = _track_created_logs([log])
+
+    try:
+        if log_buffer:
+            log_buffer.add(log)
+        else:
+            with models.atomic():
+                log.save(force_insert=True)
+                update_rollups([(log.metric_id, log.timestamp, log.number)])
+    except Exception:
+        if tracked:
+            _untrack_created_logs([log.uuid])
+        raise
+
+    _record_latest_log(log)
+    _notify_log_listeners(log)
+
+    return log
+
+
+def _new_metric_log(
+        metric: Union[str, UUID, models.Metric],
+        value: Any,
+        timestamp: Optional[datetime] = None
+) -> models.MetricLog:
+    metric = _resolve_metric(metric)
+
+    log = models.MetricLog(uuid=uuid4(), metric=metric)
+    log.set_value(value, metric.type)
+
+    if timestamp:
+        log.timestamp = timestamp
+
+    return log
+
+
+def create_metric_log(
+        metric: Union[str, UUID, models.Metric],
+        value: Any
+) -> models.MetricLog:
+    """
+    sets up common metric log fields, the metric can either be its name,
+    ID or the metric itself
+    """
+
+    return _save_log(_new_metric_log(metric, value))
+
+
+def create_metric_logs(
+        entries: Iterable[Tuple[Union[str, UUID, models.Metric], Any,
+                                Optional[datetime]]]
+) -> List[models.MetricLog]:
+    """
+    Creates many metric logs at once from (metric, value, timestamp)
+    entries, inserted together in a single transaction. Without a
+    timestamp the log is timestamped now.
+    """
+
+    logs = [_new_metric_log(metric, value, timestamp)
+            for metric, value, timestamp in entries]
+
+    if not logs:
+        return logs
+
+    tracked = _track_created_logs(logs)
+
+    try:
+        _insert_rows([_to_row(log) for log in logs])
+    except Exception:
+        if tracked:
+            _untrack_created_logs(log.uuid for log in logs)
+        raise
+
+    for log in logs:
+        _record_latest_log(log)
+        _notify_log_listeners(log)
+
+    return logs
+
+
+def create_file_log(metric: Union[str, UUID, models.Metric],
+                    blob: Union[bytes, BinaryIO],
                     extension: str) -> models.MetricLog:
     """
     Creates a special metric log for blob (bytes) type
     metrics, i.e. images and videos. The value of the metric
-    is the path of the stored file. The blob is then written
-    to disk.
+    is the path of the stored file. The blob, either bytes or
+    a file to read them from, is stored in the blob store where
+    identical files are only kept once.
 
     NOTE: extension should be in the format '.jpg' which includes
     the beginning .
     """
 
-    metric = models.Metric.get(models.Metric.name == metric_name)
-
-    uuid = uuid4()
+    metric = _resolve_metric(metric)
 
-    uploaded_file_name = '{uuid}{extension}'.format(
-        uuid=str(uuid).replace('-', ''),
-        extension=extension
-    )
+    if isinstance(blob, bytes):
+        blob = io.BytesIO(blob)
 
-    full_path = os.path.join(settings.UPLOAD_PATH, uploaded_file_name)
+    stored_blob = blobs.store(blob, extension)
 
-    with open(full_path, 'wb') as file:
-        file.write(blob)
+    log = models.MetricLog(uuid=uuid4(), metric=metric)
+    log.set_value(stored_blob.path, metric.type)
 
-    return models.MetricLog.create(id=uuid,
-                                   metric=metric,
-                                   value=uploaded_file_name)
+    try:
+        return _save_log(log)
+    except Exception:
+        blobs.release([stored_blob.path])
+        raise
 
 
 class MetricBase:
@@ -83,10 +758,25 @@ class HumidityMetric(MetricBase):
         return value >= 0 and value <= 1
 
 
+metric_classes = {
+    constants.T9E: TemperatureMetric,
+    constants.HUMIDITY: HumidityMetric,
+}  # type: Dict[str, Type[MetricBase]]
+
+
+def get_metric_class(metric_type: str) -> Type[MetricBase]:
+    """Standardizes and validates the values of metric_type"""
+
+    return metric_classes.get(metric_type, MetricBase)
+
+
 def standardize_metric(metric_type: str, value: float) -> float:
     """Convert metric value from localized version to standardized one"""
 
-    if metric_type == constants.T9E:
-        value = TemperatureMetric.standardize(value)
+    return get_metric_class(metric_type).standardize(value)
+
+
+def validate_metric(metric_type: str, value: Any) -> bool:
+    """Whether value is valid for metric_type, once standardized"""
 
-    return value
+    return get_metric_class(metric_type).validate(value)
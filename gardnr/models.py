@@ -2,12 +2,15 @@
 import json
 import uuid
 from datetime import datetime, timedelta
-from typing import Dict, Optional, List
+from typing import Any, Dict, Optional, List
 
 import cron_descriptor
-from peewee import (BlobField, BooleanField, DateTimeField, FloatField,
-                    ForeignKeyField, Model, ModelSelect, SqliteDatabase,
-                    TextField, UUIDField)
+from peewee import (BooleanField, Column, DateTimeField, FloatField,
+                    ForeignKeyField, IntegerField, Model, ModelSelect,
+                    SqliteDatabase, TextField, UUIDField, fn)
+
+from playhouse.migrate import SqliteMigrator, migrate
+from playhouse.sqlite_ext import AutoIncrementField
 
 from gardnr import constants, settings
 
@@ -21,17 +24,164 @@ def initialize_db() -> None:
     Creates any missing tables in the database
     """
 
+    pragmas = settings.DB_PROFILES[settings.DB_PROFILE]
+
     if settings.TEST_MODE:
-        _db.init(':memory:')
+        _db.init(':memory:', pragmas=pragmas)
     else:
-        _db.init(settings.LOCAL_DB)
+        _db.init(settings.LOCAL_DB, pragmas=pragmas)
 
     # incase there is a connection issue it will be found here
     # instead of downstream
     _db.connect()
 
+    # databases created by older versions
+    _migrate_metric_log_values()
+    _migrate_metric_log_keys()
+
+    # tables and indexes are created if they do not exist, which also
+    # adds new indexes to databases created by older versions
     _db.create_tables(BaseModel.__subclasses__(), safe=True)
 
+    # replaced by the (metric, timestamp) index
+    _db.execute_sql('DROP INDEX IF EXISTS metriclog_metric_id')
+
+
+def _migrate_metric_log_values() -> None:
+    """
+    Moves the values of metric logs from the untyped value column of older
+    versions into the column for their metric type, in batches. The value
+    column is left for _migrate_metric_log_keys, dropping it would rebuild
+    the table and renumber the rowids.
+    """
+
+    columns = [column.name for column in _db.get_columns('metriclog')]
+
+    if 'value' not in columns:
+        return
+
+    migrator = SqliteMigrator(_db)
+
+    with _db.atomic():
+        migrate(*[migrator.add_column('metriclog', name, field)
+                  for name, field in (('number', MetricLog.number),
+                                      ('text', MetricLog.text),
+                                      ('path', MetricLog.path))
+                  if name not in columns])
+
+        last_rowid = 0
+
+        while True:
+            batch = _db.execute_sql(
+                'SELECT metriclog.rowid, metriclog.value, metric.type '
+                'FROM metriclog JOIN metric '
+                'ON metriclog.metric_id = metric.id '
+                'WHERE metriclog.rowid > ? ORDER BY metriclog.rowid '
+                'LIMIT 1000', (last_rowid,)).fetchall()
+
+            if not batch:
+                break
+
+            updates = []
+            for rowid, value, metric_type in batch:
+                log = MetricLog()
+                log.set_value(value, metric_type)
+                updates.append((log.number, log.text, log.path, rowid))
+
+            _db.cursor().executemany(
+                'UPDATE metriclog SET number = ?, text = ?, path = ? '
+                'WHERE rowid = ?', updates)
+
+            last_rowid = batch[-1][0]
+
+
+def _migrate_metric_log_keys() -> None:
+    """
+    Rebuilds the metric log table of older versions, keyed by UUID or by an
+    integer SQLite could reuse, with an AUTOINCREMENT integer key. Logs keep
+    their rowid as their key, so watermarks stay valid, and export logs are
+    pointed at it. The value column of even older versions is left behind.
+    """
+
+    columns = [column.name for column in _db.get_columns('metriclog')]
+
+    if not columns:
+        return
+
+    if 'uuid' in columns:
+        table_sql = _db.execute_sql(
+            "SELECT sql FROM sqlite_master "
+            "WHERE type = 'table' AND name = 'metriclog'").fetchone()[0]
+
+        if 'AUTOINCREMENT' in table_sql.upper():
+            return
+
+        uuid_column = 'uuid'
+    else:
+        # the UUID was the key
+        uuid_column = 'id'
+
+    with _db.atomic():
+        for table in ('metriclog', 'exportlog'):
+            # the new tables get indexes with the same names
+            for index in _db.get_indexes(table):
+                if not index.name.startswith('sqlite_autoindex'):
+                    _db.execute_sql('DROP INDEX {index}'.format(
+                        index=index.name))
+
+            _db.execute_sql('ALTER TABLE {table} RENAME TO {table}_old'
+                            .format(table=table))
+
+        _db.create_tables([MetricLog, ExportLog])
+
+        _db.execute_sql(
+            'INSERT INTO metriclog (id, uuid, timestamp, longitude, latitude, '
+            'elevation, number, text, path, metric_id) '
+            'SELECT rowid, {uuid_column}, timestamp, longitude, latitude, '
+            'elevation, number, text, path, metric_id FROM metriclog_old'
+            .format(uuid_column=uuid_column))
+
+        # the newest logs may have been deleted, their rowids must not be
+        # handed out again either
+        _db.execute_sql("DELETE FROM sqlite_sequence WHERE name = 'metriclog'")
+        _db.execute_sql(
+            "INSERT INTO sqlite_sequence (name, seq) "
+            "SELECT 'metriclog', COALESCE(MAX(rowid), 0) FROM metriclog_old")
+
+        _db.execute_sql(
+            'INSERT INTO exportlog (id, metric_log_id, driver_id) '
+            'SELECT exportlog_old.id, metriclog_old.rowid, '
+            'exportlog_old.driver_id FROM exportlog_old '
+            'JOIN metriclog_old '
+            'ON exportlog_old.metric_log_id = metriclog_old.id')
+
+        _db.execute_sql('DROP TABLE exportlog_old')
+        _db.execute_sql('DROP TABLE metriclog_old')
+
+
+def close_db() -> None:
+    """
+    Closes the database connection of the current thread, worker threads
+    get their own connection which must be closed when they are done
+    """
+
+    if not _db.is_closed():
+        _db.close()
+
+
+def atomic() -> Any:
+    """
+    Context manager to run the queries inside of it in a single transaction
+    """
+
+    return _db.atomic()
+
+
+def execute_sql(sql: str, params: Optional[tuple] = None) -> Any:
+    """Runs a raw SQL statement, returning its cursor"""
+
+    return _db.execute_sql(sql, params)
+
 
 class BaseModel(Model):
     class Meta:
@@ -49,7 +199,21 @@ class JSONField(TextField):
         return None
 
 
-class Metric(BaseModel):
+class RevisionMixin:
+    """Bumps the revision of the model's table when a row is changed"""
+
+    def save(self, *args: Any, **kwargs: Any) -> int:
+        rows = super().save(*args, **kwargs)  # type: ignore
+        Revision.bump(type(self))
+        return rows
+
+    def delete_instance(self, *args: Any, **kwargs: Any) -> int:
+        rows = super().delete_instance(*args, **kwargs)  # type: ignore
+        Revision.bump(type(self))
+        return rows
+
+
+class Metric(RevisionMixin, BaseModel):
 
     id = UUIDField(primary_key=True)
     name = TextField(unique=True)
@@ -72,9 +236,17 @@ class Metric(BaseModel):
         cutoff date for the latest the log can be from.
         """
 
+        return self.select_latest_log(cutoff).first()
+
+    def select_latest_log(
+            self,
+            cutoff: Optional[timedelta] = None
+    ) -> ModelSelect:
+        """The query of get_latest_log"""
+
+        # uses the (metric, timestamp) index to only read one log
         latest_log = MetricLog.select()\
-            .join(Metric)\
-            .where(Metric.name == self.name)\
+            .where(MetricLog.metric == self)\
             .order_by(MetricLog.timestamp.desc())\
             .limit(1)
 
@@ -82,13 +254,10 @@ class Metric(BaseModel):
             latest_log = latest_log.where(
                 MetricLog.timestamp >= datetime.utcnow() - cutoff)
 
-        if not latest_log:
-            return None
-
-        return latest_log[0]
+        return latest_log
 
 
-class Driver(BaseModel):
+class Driver(RevisionMixin, BaseModel):
     """
     Information about a device.
 
@@ -154,8 +323,28 @@ class DriverSchedule(BaseModel):
     power_on = BooleanField(null=True, default=None)
 
 
+def _to_text(value: Any) -> str:
+    if isinstance(value, bytes):
+        return value.decode()
+
+    return str(value)
+
+
+def _to_number(value: Any) -> Optional[float]:
+    try:
+        # also parses numbers sent as text, e.g. MQTT payloads
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
 class MetricLog(BaseModel):
-    id = UUIDField(primary_key=True)
+    # an integer key keeps the table and its references compact, it is
+    # also the rowid of the log. AUTOINCREMENT keeps SQLite from reusing the
+    # rowids of deleted logs, so rowid cursors never skip a log
+    id = AutoIncrementField()
+    # identifies the log outside of this database
+    uuid = UUIDField(unique=True, default=uuid.uuid4)
 
     timestamp = DateTimeField(default=datetime.utcnow)
 
@@ -163,9 +352,63 @@ class MetricLog(BaseModel):
     latitude = FloatField(null=True)
     elevation = FloatField(null=True)
 
-    value = BlobField()
+    # the value is stored in one of these depending on the metric type, see
+    # set_value
+    number = FloatField(null=True)
+    text = TextField(null=True)
+    path = TextField(null=True)
 
-    metric = ForeignKeyField(Metric)
+    # indexed by the (metric, timestamp) index
+    metric = ForeignKeyField(Metric, index=False)
+
+    class Meta:
+        indexes = (
+            # for the logs of a metric by time, e.g. its latest log
+            (('metric', 'timestamp'), False),
+        )
+
+    @property
+    def value(self) -> Any:
+        """The value of the log, from the column it is stored in"""
+
+        if self.number is not None:
+            return self.number
+        elif self.text is not None:
+            return self.text
+
+        return self.path
+
+    @value.setter
+    def value(self, value: Any) -> None:
+        self.set_value(value)
+
+    def set_value(self, value: Any, metric_type: Optional[str] = None) -> None:
+        """
+        Stores value as the path of an uploaded file or as text for metric
+        types in constants.FILE_METRICS and TEXT_METRICS, and as a number
+        for the others. Values which are not numbers are kept as text.
+        Without a metric type only numbers and text are told apart.
+        """
+
+        self.number = self.text = self.path = None
+
+        if value is None:
+            return
+
+        if metric_type in constants.FILE_METRICS:
+            self.path = _to_text(value)
+        elif metric_type in constants.TEXT_METRICS:
+            self.text = _to_text(value)
+        elif _to_number(value) is not None:
+            self.number = _to_number(value)
+        else:
+            self.text = _to_text(value)
+
+
+# SQLite gives every metric log row an increasing rowid, the same as its
+# id and never reused, which makes it usable as an ordered cursor over the
+# logs
+METRIC_LOG_ROWID = Column(MetricLog, 'rowid')
 
 
 class ExportLog(BaseModel):
@@ -178,6 +421,63 @@ class ExportLog(BaseModel):
     driver = ForeignKeyField(Driver)
 
 
+class ExportWatermark(BaseModel):
+    """
+    The rowid of the last metric log exported by an exporter, used instead
+    of ExportLog by exporters tracking exports with a watermark
+    """
+
+    driver = ForeignKeyField(Driver, unique=True)
+    position = IntegerField(default=0)
+
+
+class MetricRollup(BaseModel):
+    """
+    Aggregates of the numeric logs of a metric over a bucket of time, kept
+    up to date as logs are created
+    """
+
+    # indexed by the (metric, resolution, bucket) index
+    metric = ForeignKeyField(Metric, index=False)
+    resolution = TextField(choices=[(resolution, resolution)
+                                    for resolution
+                                    in constants.rollup_resolutions])
+    # when the bucket starts
+    bucket = DateTimeField()
+
+    count = IntegerField(default=0)
+    total = FloatField(default=0)
+    min = FloatField(null=True)
+    max = FloatField(null=True)
+    last = FloatField(null=True)
+    last_timestamp = DateTimeField(null=True)
+
+    class Meta:
+        indexes = (
+            (('metric', 'resolution', 'bucket'), True),
+        )
+
+    @property
+    def mean(self) -> Optional[float]:
+        return self.total / self.count if self.count else None
+
+
+class Blob(BaseModel):
+    """
+    An uploaded file, stored once however many metric logs have the same
+    contents
+    """
+
+    # SHA-256 hex digest of the contents
+    hash = TextField(unique=True)
+    # relative to settings.UPLOAD_PATH, the path of the metric logs
+    path = TextField(unique=True)
+    size = IntegerField()
+    # number of metric logs with the path, once none are left the blob is
+    # garbage collected
+    refs = IntegerField(default=0)
+
+
 class Trigger(BaseModel):
     """
     A rule for what power device to either turn on or off a when a metric's
@@ -200,3 +500,46 @@ class Grow(BaseModel):
 
     start = DateTimeField(default=datetime.utcnow)
     end = DateTimeField(null=True)
+
+
+class Revision(BaseModel):
+    """
+    Counts the changes made to a table, so processes caching its rows can
+    cheaply check if their copy is stale
+    """
+
+    table_name = TextField(primary_key=True)
+    revision = IntegerField(default=0)
+
+    # number of bumps made by this process for each table, which lets
+    # caches notice changes made in process without querying
+    local_bumps = {}  # type: Dict[str, int]
+
+    @staticmethod
+    def bump(model: type) -> None:
+        # pylint: disable=protected-access
+        table_name = model._meta.table_name  # type: ignore
+
+        Revision.insert(table_name=table_name).on_conflict_ignore().execute()
+
+        Revision.update(revision=Revision.revision + 1)\
+            .where(Revision.table_name == table_name)\
+            .execute()
+
+        Revision.local_bumps[table_name] = \
+            Revision.local_bumps.get(table_name, 0) + 1
+
+    @staticmethod
+    def get_local_bumps(model: type) -> int:
+        # pylint: disable=protected-access
+        return Revision.local_bumps.get(
+            model._meta.table_name, 0)  # type: ignore
+
+    @staticmethod
+    def get_revision(model: type) -> int:
+        # pylint: disable=protected-access
+        table_name = model._meta.table_name  # type: ignore
+
+        revision = Revision.get_or_none(Revision.table_name == table_name)
+
+        return revision.revision if revision else 0
@@ -1,35 +1,434 @@
 #!/usr/bin/env python
+"""
+Subscribes to metric logs over MQTT, the topic is the metric name and the
+message its value. Only the topics of enabled metrics are subscribed to.
 
-from typing import Dict, Optional
+The message is either:
+- the value as text, e.g. `21.5`
+- a JSON object with the value and optionally the time it was measured at,
+  in seconds since the epoch, e.g. `{"value": 21.5, "timestamp": 1546300800}`
+- the compact binary format: a zero byte followed by the value and
+  optionally the timestamp, as little-endian doubles
+"""
+import json
+import math
+import queue
+import struct
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Type
 
-from paho.mqtt import subscribe
 from paho.mqtt.client import Client, MQTTMessage
 
-from gardnr import logger, metrics, models
+from gardnr import constants, logger, metrics, models, settings
+
+# queued to wake the writer up when stopping
+_STOP = object()
+
+# a zero byte never starts a payload sent as text
+BINARY_MARKER = b'\x00'
+_BINARY_VALUE = struct.Struct('<xd')
+_BINARY_VALUE_TIMESTAMP = struct.Struct('<xdd')
+
+Message = Tuple[models.Metric, bytes, datetime]
+LogEntry = Tuple[models.Metric, Any, datetime]
+
+
+def _to_timestamp(seconds: Any) -> datetime:
+    try:
+        return datetime.utcfromtimestamp(float(seconds))
+    except (TypeError, OverflowError, OSError):
+        raise ValueError('invalid timestamp {seconds}'.format(
+            seconds=seconds))
+
+
+def decode_payload(
+        payload: bytes,
+        numeric: bool = True
+) -> Tuple[Any, Optional[datetime]]:
+    """
+    The value of a message and the time it was measured at, if it was sent
+    along. Values of numeric metrics are floats and text otherwise. Raises
+    ValueError when the payload can not be decoded.
+    """
+
+    if numeric:
+        if payload[:1] == BINARY_MARKER:
+            if len(payload) == _BINARY_VALUE.size:
+                value, = _BINARY_VALUE.unpack(payload)
+                return value, None
+            if len(payload) == _BINARY_VALUE_TIMESTAMP.size:
+                value, seconds = _BINARY_VALUE_TIMESTAMP.unpack(payload)
+                return value, _to_timestamp(seconds)
+
+            raise ValueError('binary payload of {size} bytes'.format(
+                size=len(payload)))
+
+        # the most common payload, float parses bytes as they are
+        try:
+            return float(payload), None
+        except ValueError:
+            pass
+
+    # UnicodeDecodeError and JSONDecodeError are ValueErrors too
+    text = payload.decode()
+
+    if not text.lstrip().startswith('{'):
+        if numeric:
+            raise ValueError('payload is not a number')
+
+        return text, None
+
+    fields = json.loads(text)
+
+    if 'value' not in fields:
+        raise ValueError('JSON payload without a value')
+
+    value = fields['value']
+    timestamp = fields.get('timestamp')
+
+    if timestamp is not None:
+        timestamp = _to_timestamp(timestamp)
+
+    if numeric:
+        # raises TypeError for e.g. lists
+        try:
+            value = float(value)
+        except TypeError:
+            raise ValueError('JSON value is not a number')
+    else:
+        value = str(value)
+
+    return value, timestamp
+
+
+def decode_messages(messages: Iterable[Message]) -> Tuple[List[LogEntry], int]:
+    """
+    Decodes a batch of messages into (metric, value, timestamp) entries,
+    numeric values are standardized and validated. Returns the entries
+    along with the number of messages which were invalid.
+    """
+
+    entries = []  # type: List[LogEntry]
+    invalid = 0
+
+    # looked up once per metric type for the whole batch
+    metric_classes = {}  # type: Dict[str, Type[metrics.MetricBase]]
+
+    for metric, payload, received in messages:
+        numeric = metric.type not in constants.TEXT_METRICS and \
+            metric.type not in constants.FILE_METRICS
+
+        try:
+            value, timestamp = decode_payload(payload, numeric)
+        except ValueError:
+            invalid += 1
+            continue
+
+        if numeric:
+            metric_class = metric_classes.get(metric.type)
+
+            if metric_class is None:
+                metric_class = metric_classes[metric.type] = \
+                    metrics.get_metric_class(metric.type)
+
+            value = metric_class.standardize(value)
+
+            if not math.isfinite(value) or not metric_class.validate(value):
+                invalid += 1
+                continue
+
+        entries.append((metric, value, timestamp or received))
+
+    return entries, invalid
+
+
+class MQTTConsumer:
+    """
+    Messages are put on a bounded queue from the network thread and
+    inserted in batches from a writer thread, so a burst of messages never
+    stalls the network loop. Once the queue is full new messages are
+    dropped.
+    """
+
+    def __init__(
+            self,
+            queue_size: int,
+            batch_size: int,
+            batch_interval: float
+    ) -> None:
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+
+        self.queue = queue.Queue(
+            maxsize=queue_size
+        )  # type: queue.Queue[Message]
+
+        # counted by the thread which owns them
+        self.received = 0
+        self.unknown = 0
+        self.dropped = 0
+        self.invalid = 0
+        self.failed = 0
+        self.written = 0
+
+        # enabled metrics by name (their topic), replaced as a whole when
+        # the metrics change so the network thread never has to query
+        self._metrics = {}  # type: Dict[str, models.Metric]
+        self._metrics_revision = None  # type: Optional[int]
+        self._metrics_checked = 0.0
+
+        # the connected client and the topics it is subscribed to
+        self._client = None  # type: Optional[Client]
+        self._subscribed = set()  # type: Set[str]
+        self._subscriptions_lock = threading.Lock()
+
+        # messages by unknown topic since they were last logged
+        self._unknown_topics = {}  # type: Dict[str, int]
+        self._unknown_topics_lock = threading.Lock()
+
+        self._stopped = threading.Event()
+        self._writer = None  # type: Optional[threading.Thread]
+
+    def load_metrics(self) -> None:
+        """
+        Loads the enabled metrics again if they have changed and updates
+        the subscriptions to match
+        """
+
+        revision = models.Revision.get_revision(models.Metric)
+
+        if revision != self._metrics_revision:
+            self._metrics = {
+                metric.name: metric
+                for metric in models.Metric.select()
+                .where(models.Metric.disabled == False)  # noqa: E712
+                if _is_topic(metric.name)
+            }
+            self._metrics_revision = revision
+
+            self._update_subscriptions()
+
+        self._metrics_checked = time.monotonic()
+
+    def _update_subscriptions(self) -> None:
+        """Subscribes to new metrics and unsubscribes from removed ones"""
+
+        with self._subscriptions_lock:
+            if not self._client:
+                return
+
+            topics = set(self._metrics)
+            added = topics - self._subscribed
+            removed = self._subscribed - topics
+
+            if added:
+                self._client.subscribe([(topic, 0) for topic in added])
+            if removed:
+                self._client.unsubscribe(list(removed))
+
+            self._subscribed = topics
+
+    def on_connect(
+            self,
+            client: Client,
+            userdata: Optional[Dict],
+            flags: Dict,
+            rc: int
+    ) -> None:
+        if rc != 0:
+            logger.error('Unable to connect to the MQTT broker, code {rc}'
+                         .format(rc=rc))
+            return
+
+        # subscriptions do not outlive a clean session, start over
+        with self._subscriptions_lock:
+            self._client = client
+            self._subscribed = set()
+
+        self._update_subscriptions()
+
+    def on_message(
+            self,
+            client: Client,
+            userdata: Optional[Dict],
+            message: MQTTMessage
+    ) -> None:
+        self.received += 1
+
+        metric = self._metrics.get(message.topic)
+
+        if not metric:
+            # e.g. a metric disabled before it was unsubscribed from
+            self.unknown += 1
+
+            with self._unknown_topics_lock:
+                self._unknown_topics[message.topic] = \
+                    self._unknown_topics.get(message.topic, 0) + 1
+            return
+
+        try:
+            self.queue.put_nowait((metric, message.payload,
+                                   datetime.utcnow()))
+        except queue.Full:
+            self.dropped += 1
+
+    def write_batch(self, timeout: float) -> int:
+        """
+        Decodes and inserts up to batch_size queued messages, waiting at
+        most timeout seconds for them. Returns the number of messages taken
+        off the queue.
+        """
+
+        messages = []  # type: List[Message]
+        deadline = time.monotonic() + timeout
+
+        while len(messages) < self.batch_size:
+            try:
+                entry = self.queue.get(
+                    timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+
+            if entry is _STOP:
+                break
+
+            messages.append(entry)
+
+        if not messages:
+            return 0
+
+        entries, invalid = decode_messages(messages)
+
+        if invalid:
+            self.invalid += invalid
+            logger.warning('{count} invalid MQTT messages dropped'.format(
+                count=invalid))
+
+        if entries:
+            try:
+                metrics.create_metric_logs(entries)
+            except Exception:
+                # the messages of the failed batch are lost
+                self.failed += len(entries)
+                raise
+
+            self.written += len(entries)
+
+        return len(messages)
+
+    def _write_forever(self) -> None:
+        try:
+            while not self._stopped.is_set():
+                try:
+                    if (time.monotonic() - self._metrics_checked >=
+                            settings.METRIC_CACHE_CHECK_INTERVAL):
+                        self.load_metrics()
+
+                    self.write_batch(self.batch_interval)
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception('Error writing MQTT messages')
+                    # back off instead of failing on every message
+                    self._stopped.wait(self.batch_interval)
+
+            # write what is left
+            while self.write_batch(0):
+                pass
+        finally:
+            models.close_db()
+
+    def start(self) -> None:
+        self.load_metrics()
+
+        self._writer = threading.Thread(target=self._write_forever,
+                                        daemon=True)
+        self._writer.start()
+
+    def stop(self) -> None:
+        """Stops the writer once the queued messages are written"""
+
+        self._stopped.set()
+
+        if self._writer:
+            # the writer keeps draining the queue, so this never blocks
+            # for long
+            self.queue.put(_STOP)
+            self._writer.join()
+
+    def pop_unknown_topics(self) -> Dict[str, int]:
+        """Messages by unknown topic since the last call"""
+
+        with self._unknown_topics_lock:
+            unknown_topics = self._unknown_topics
+            self._unknown_topics = {}
+
+        return unknown_topics
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            'queue_depth': self.queue.qsize(),
+            'subscribed': len(self._subscribed),
+            'received': self.received,
+            'unknown': self.unknown,
+            'dropped': self.dropped,
+            'invalid': self.invalid,
+            'failed': self.failed,
+            'written': self.written,
+        }
+
+
+def _is_topic(name: str) -> bool:
+    """Whether messages can be published with name as their topic"""
+
+    return bool(name) and '+' not in name and '#' not in name
+
+
+def _log_stats_forever(consumer: MQTTConsumer, stopped: threading.Event,
+                       interval: float) -> None:
+    while not stopped.wait(interval):
+        logger.info('MQTT queue depth {queue_depth}, {subscribed} topics, '
+                    '{received} received, {unknown} unknown, {dropped} '
+                    'dropped, {invalid} invalid, {failed} failed, {written} '
+                    'written'
+                    .format(**consumer.get_stats()))
+
+        # a single warning for every unknown topic since the last one
+        unknown_topics = consumer.pop_unknown_topics()
+
+        if unknown_topics:
+            logger.warning('messages for unknown metrics: {topics}'.format(
+                topics=', '.join('"{topic}" ({count})'.format(
+                    topic=topic, count=count)
+                    for topic, count in sorted(unknown_topics.items()))))
 
 
 def main() -> None:
     models.initialize_db()
+    # stops the subscriber cleanly on SIGTERM
+    metrics.setup_log_buffer()
 
-    # check every topic to get any metric name
-    subscribe.callback(consume_message, '#')
-
+    consumer = MQTTConsumer(settings.MQTT_QUEUE_SIZE,
+                            settings.MQTT_BATCH_SIZE,
+                            settings.MQTT_BATCH_INTERVAL)
 
-def consume_message(
-        client: Client,
-        userdata: Optional[Dict],
-        message: MQTTMessage
-) -> None:
-    metric_name = message.topic
+    client = Client()
+    client.on_connect = consumer.on_connect
+    client.on_message = consumer.on_message
 
-    metric = models.Metric.get_or_none(
-        models.Metric.name == metric_name)
+    stopped = threading.Event()
+    threading.Thread(target=_log_stats_forever,
+                     args=(consumer, stopped, settings.MQTT_STATS_INTERVAL),
+                     daemon=True).start()
 
-    if not metric:
-        logger.warning('unknown metric "{}"'.format(metric_name))
-        return
+    consumer.start()
 
-    metrics.create_metric_log(metric_name, message.payload)
+    try:
+        client.connect(settings.MQTT_HOST, settings.MQTT_PORT)
+        client.loop_forever()
+    finally:
+        stopped.set()
+        consumer.stop()
 
 
 if __name__ == '__main__':
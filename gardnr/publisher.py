@@ -0,0 +1,147 @@
+"""
+Publishes new metric logs to the live stream of the server. A single
+thread per process catches up with the logs created by other processes,
+however many clients are subscribed.
+"""
+import json
+import queue
+import threading
+from typing import Optional, Set
+from uuid import UUID
+
+from gardnr import logger, metrics, models
+
+
+class Subscription:
+    """
+    Events for one client, at most size of them are buffered. A client
+    which falls behind further is closed rather than slowing down the
+    publisher.
+    """
+
+    def __init__(self, size: int,
+                 metric_ids: Optional[Set[UUID]] = None) -> None:
+        self.queue = queue.Queue(maxsize=size)  # type: queue.Queue[str]
+        # only the logs of these metrics, None for every metric
+        self.metric_ids = metric_ids
+        self.closed = False
+
+    def get(self, timeout: float) -> Optional[str]:
+        """The next event, None if there is none within timeout seconds"""
+
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class LogPublisher:
+
+    def __init__(self, buffer_size: int, poll_interval: float) -> None:
+        self.buffer_size = buffer_size
+        self.poll_interval = poll_interval
+
+        self._subscriptions = set()  # type: Set[Subscription]
+        self._lock = threading.Lock()
+        self._poller = None  # type: Optional[threading.Thread]
+        self._stopped = threading.Event()
+
+    def subscribe(
+            self,
+            metric_ids: Optional[Set[UUID]] = None
+    ) -> Subscription:
+        """Subscribes to new logs, starting the publisher if needed"""
+
+        subscription = Subscription(self.buffer_size, metric_ids)
+
+        with self._lock:
+            self._subscriptions.add(subscription)
+
+            if not self._poller:
+                self._start()
+
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+        subscription.closed = True
+
+    def publish(self, log: models.MetricLog) -> None:
+        """Log listener, passes log on to every subscription"""
+
+        with self._lock:
+            subscriptions = [
+                subscription for subscription in self._subscriptions
+                if subscription.metric_ids is None or
+                log.metric_id in subscription.metric_ids
+            ]
+
+        if not subscriptions:
+            return
+
+        # formatted once for every client
+        event = format_event(log)
+
+        for subscription in subscriptions:
+            try:
+                subscription.queue.put_nowait(event)
+            except queue.Full:
+                logger.warning('Dropped a live stream client which fell '
+                               'behind')
+                self.unsubscribe(subscription)
+
+    def _start(self) -> None:
+        metrics.add_log_listener(self.publish)
+
+        self._stopped.clear()
+        self._poller = threading.Thread(target=self._poll_forever,
+                                        daemon=True)
+        self._poller.start()
+
+    def _poll_forever(self) -> None:
+        try:
+            while True:
+                try:
+                    # passes the logs of other processes to the listeners
+                    metrics.load_latest_logs()
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception('Error loading the latest logs')
+
+                if self._stopped.wait(self.poll_interval):
+                    break
+        finally:
+            models.close_db()
+
+    def stop(self) -> None:
+        """Stops the publisher and closes every subscription"""
+
+        with self._lock:
+            poller = self._poller
+            self._poller = None
+
+            subscriptions = list(self._subscriptions)
+            self._subscriptions.clear()
+
+        if poller:
+            metrics.remove_log_listener(self.publish)
+            self._stopped.set()
+            poller.join()
+
+        for subscription in subscriptions:
+            subscription.closed = True
+
+
+def format_event(log: models.MetricLog) -> str:
+    """A log as a server-sent event"""
+
+    metric = metrics.find_metric_by_id(log.metric_id)
+
+    data = json.dumps({
+        'metric': metric.name if metric else None,
+        'timestamp': log.timestamp.isoformat(),
+        'value': log.value,
+    })
+
+    return 'data: {data}\n\n'.format(data=data)
@@ -1,8 +1,19 @@
 import importlib
+import json
 import sys
-from typing import List, Optional
+import threading
+from typing import Dict, List, Optional, Tuple
 
-from gardnr import constants, drivers, models
+from gardnr import constants, drivers, logger, models
+
+
+# Loaded drivers are kept around so their setup only runs once, keyed by
+# the id of the driver model along with what they were loaded from
+_loaded_drivers = {}  # type: Dict[int, Tuple[Tuple, drivers.Driver]]
+# every driver model, queried again only when the drivers have changed
+_driver_models = None  # type: Optional[List[models.Driver]]
+_driver_models_revision = None  # type: Optional[int]
+_drivers_lock = threading.RLock()
 
 
 def add_driver_path(path: str) -> None:
@@ -29,12 +40,91 @@ def get_class_type(fully_qualname: str) -> type:
     return class_type
 
 
+def _driver_key(driver_model: models.Driver) -> Tuple:
+    """What a loaded driver depends on, if any of it changes reload it"""
+
+    return (driver_model.name,
+            driver_model.fully_qualname,
+            json.dumps(driver_model.config, sort_keys=True))
+
+
+def _unload_driver(driver_id: int) -> None:
+    """Removes a loaded driver and tears it down"""
+
+    _, driver = _loaded_drivers.pop(driver_id)
+
+    try:
+        driver.teardown()
+    except Exception:  # pylint: disable=broad-except
+        logger.exception('Error tearing down {name}'.format(
+            name=driver.model.name))
+
+
+def unload_drivers() -> None:
+    """Tears down every loaded driver"""
+
+    # pylint: disable=global-statement
+    global _driver_models, _driver_models_revision
+
+    with _drivers_lock:
+        for driver_id in list(_loaded_drivers):
+            _unload_driver(driver_id)
+
+        _driver_models = None
+        _driver_models_revision = None
+
+
 def load_driver(driver_model: models.Driver) -> drivers.Driver:
-    """factory for configured driver objects"""
+    """
+    factory for configured driver objects, a driver is only created once
+    and reused until its model changes
+    """
+
+    key = _driver_key(driver_model)
+
+    with _drivers_lock:
+        if driver_model.id in _loaded_drivers:
+            loaded_key, driver = _loaded_drivers[driver_model.id]
+
+            if loaded_key == key:
+                driver.model = driver_model
+                return driver
+
+            _unload_driver(driver_model.id)
+
+        class_type = get_class_type(driver_model.fully_qualname)
+        driver = class_type(driver_model)
+
+        _loaded_drivers[driver_model.id] = (key, driver)
+
+    return driver
+
+
+def _get_driver_models() -> List[models.Driver]:
+    """
+    Every driver model, only queried when the drivers have changed since
+    the last time. Drivers which were removed are unloaded.
+    """
+
+    # pylint: disable=global-statement
+    global _driver_models, _driver_models_revision
+
+    # read the revision first, a change made right after it is then
+    # picked up by the next call
+    revision = models.Revision.get_revision(models.Driver)
+
+    with _drivers_lock:
+        if _driver_models is None or revision != _driver_models_revision:
+            _driver_models = list(models.Driver.select())
+            _driver_models_revision = revision
+
+            driver_ids = {driver_model.id for driver_model in _driver_models}
 
-    class_type = get_class_type(driver_model.fully_qualname)
+            for driver_id in list(_loaded_drivers):
+                if driver_id not in driver_ids:
+                    _unload_driver(driver_id)
 
-    return class_type(driver_model)
+        return _driver_models
 
 
 def load_active_drivers(
@@ -44,19 +134,19 @@ def load_active_drivers(
 ) -> List[drivers.Driver]:
     """Loads a list of Drivers by name that are not disabled"""
 
-    driver_models = models.Driver.select().where(
-        models.Driver.disabled == False
-    )
+    driver_models = [driver_model for driver_model in _get_driver_models()
+                     if not driver_model.disabled]
 
     if driver_type:
-        driver_models = driver_models.where(
-            models.Driver.type == driver_type
-        )
+        driver_models = [driver_model for driver_model in driver_models
+                         if driver_model.type == driver_type]
 
     if include:
-        driver_models = driver_models.where(models.Driver.name.in_(include))
+        driver_models = [driver_model for driver_model in driver_models
+                         if driver_model.name in include]
     elif exclude:
-        driver_models = driver_models.where(models.Driver.name.not_in(exclude))
+        driver_models = [driver_model for driver_model in driver_models
+                         if driver_model.name not in exclude]
 
     return [load_driver(driver_model) for driver_model in driver_models]
 
@@ -1,6 +1,7 @@
 import os
 import pathlib
-from typing import Any, Tuple
+import threading
+from typing import Any, Dict, List, Optional, Tuple
 
 from flask import Flask, redirect, render_template, request
 from flaskcommand import flask_command
@@ -8,10 +9,11 @@ from flask_wtf import FlaskForm, csrf
 from wtforms import Field, FileField, FloatField, IntegerField, TextAreaField
 from wtforms.validators import Optional as OptionalValidator
 
-from gardnr import constants, metrics, models, settings
+from gardnr import api, blobs, constants, metrics, models, settings
 
 app = Flask(__name__)
 app_csrf = csrf.CSRFProtect(app)
+app.register_blueprint(api.api)
 
 app.config.update(dict(
     SECRET_KEY='\xc1\x7f;\xbb:\xe6P\xbf0\xa1\x91\xd5X|\xfa\xd4"AZ\xe1/\xe1tt',
@@ -19,6 +21,8 @@ app.config.update(dict(
 ))
 
 models.initialize_db()
+# gunicorn handles SIGTERM itself and exits its workers gracefully
+metrics.setup_log_buffer(handle_sigterm=False)
 os.makedirs(settings.UPLOAD_PATH, exist_ok=True)
 
 FIELD_NAME_DELIMITER = ':'
@@ -26,43 +30,83 @@ FIELD_NAME_DELIMITER = ':'
 main = flask_command(app)
 
 
-@app.route('/', methods=('GET', 'POST'))
-def manual_logs():
-    class MetricForm(FlaskForm):
-        """
-        Anonymous Form class for constructing
-        personalizated forms based on sensors configured
-        """
-        pass
+# the form class for the manual metrics along with the metrics by name,
+# built again only when the revision of the metrics has changed
+CachedMetricForm = Tuple[int, type, Dict[str, models.Metric]]
+_metric_form = None  # type: Optional[CachedMetricForm]
+_metric_form_lock = threading.Lock()
+
+
+def invalidate_metric_form() -> None:
+    """Builds the form class again on the next request"""
+
+    # pylint: disable=global-statement
+    global _metric_form
+
+    with _metric_form_lock:
+        _metric_form = None
+
+
+def get_metric_form() -> Tuple[type, Dict[str, models.Metric]]:
+    """
+    Form class with a field for every enabled manual metric, and those
+    metrics by name
+    """
+
+    # pylint: disable=global-statement
+    global _metric_form
+
+    # read the revision first, a change made right after it is then
+    # picked up by the next request
+    revision = models.Revision.get_revision(models.Metric)
 
-    # pylint: disable=singleton-comparison
-    manual_metrics = models.Metric.select().where(
-        (models.Metric.manual == True) &  # noqa: E712
-        (models.Metric.disabled == False))
+    with _metric_form_lock:
+        if _metric_form is None or _metric_form[0] != revision:
+            # pylint: disable=singleton-comparison
+            manual_metrics = {
+                metric.name: metric
+                for metric in models.Metric.select().where(
+                    (models.Metric.manual == True) &  # noqa: E712
+                    (models.Metric.disabled == False))
+            }
 
-    for metric in manual_metrics:
-        metric_field = get_field(metric)
+            # anonymous form class personalized to the configured metrics
+            form_class = type('MetricForm', (FlaskForm,), {
+                name: get_field(metric)
+                for name, metric in manual_metrics.items()
+            })
 
-        setattr(MetricForm, metric.name, metric_field)
+            _metric_form = (revision, form_class, manual_metrics)
+
+        return _metric_form[1], _metric_form[2]
+
+
+@app.route('/', methods=('GET', 'POST'))
+def manual_logs():
+    form_class, manual_metrics = get_metric_form()
 
     # magically populates the form from the request :)
-    metric_form = MetricForm()
+    metric_form = form_class()
 
     # save form
     if metric_form.validate_on_submit():
+        submitted = []
+
         for field_name, field_value in metric_form.data.items():
             if field_name == 'csrf_token':
                 continue
             if not field_value:
                 continue
 
-            metric = models.Metric.get(models.Metric.name == field_name)
+            metric = manual_metrics[field_name]
 
             if(metric.type == constants.IMAGE and
                field_value.filename == ''):
                 continue
 
-            create_log(metric, field_value)
+            submitted.append((metric, field_value))
+
+        create_logs(submitted)
 
         return redirect('/')
 
@@ -88,15 +132,32 @@ def get_field(metric: models.Metric) -> Field:
         field_type=metric))
 
 
-def create_log(metric: models.Metric,
-               field_value: Any) -> models.MetricLog:
-
-    if metric.type == constants.IMAGE:
-        extension = pathlib.Path(field_value.filename).suffix
-        image_blob = field_value.read()
-        # type: ignore
-        return metrics.create_file_log(metric.name, image_blob, extension)
-
-    value = metrics.standardize_metric(metric.type, field_value)
-
-    return metrics.create_metric_log(metric.name, value)
+def create_logs(submitted: List[Tuple[models.Metric, Any]]) -> None:
+    """
+    Creates the logs of every submitted field in a single transaction.
+    Images are stored first, their references are dropped again when the
+    logs can not be created so garbage collection removes them.
+    """
+
+    entries = []
+    stored_paths = []  # type: List[str]
+
+    try:
+        for metric, field_value in submitted:
+            if metric.type == constants.IMAGE:
+                extension = pathlib.Path(field_value.filename).suffix
+                # streamed to disk rather than read into memory
+                blob = blobs.store(field_value.stream, extension)
+                stored_paths.append(blob.path)
+
+                entries.append((metric, blob.path, None))
+            else:
+                entries.append((metric,
+                                metrics.standardize_metric(metric.type,
+                                                           field_value),
+                                None))
+
+        metrics.create_metric_logs(entries)
+    except Exception:
+        blobs.release(stored_paths)
+        raise
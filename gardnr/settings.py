@@ -7,6 +7,40 @@ from gardnr import constants
 TEST_MODE = False
 
 LOCAL_DB = 'gardnr.db'
+
+# SQLite settings applied to every connection, pick one of DB_PROFILES.
+# See https://sqlite.org/pragma.html for what each pragma does.
+DB_PROFILE = 'balanced'
+DB_PROFILES = {
+    # a rollback journal and fsync on every commit, set explicitly since the
+    # journal mode of another profile is kept in the database file
+    'safe': [
+        ('journal_mode', 'delete'),
+        ('synchronous', 'full'),
+        ('busy_timeout', 5000),  # in milliseconds
+    ],
+    # readers do not block the writer, only the WAL is fsync'ed at
+    # checkpoints, a power loss can lose the last commits but never
+    # corrupts the database
+    'balanced': [
+        ('journal_mode', 'wal'),
+        ('synchronous', 'normal'),
+        ('cache_size', -8000),  # in KiB when negative
+        ('mmap_size', 67108864),  # in bytes
+        ('busy_timeout', 5000),
+        ('temp_store', 'memory'),
+    ],
+    # never waits on the disk, a power loss or crash of the OS can corrupt
+    # the database
+    'fast': [
+        ('journal_mode', 'wal'),
+        ('synchronous', 'off'),
+        ('cache_size', -32000),
+        ('mmap_size', 268435456),
+        ('busy_timeout', 5000),
+        ('temp_store', 'memory'),
+    ],
+}
 DRIVER_PATH = os.getcwd()
 
 # logging
@@ -17,12 +51,99 @@ LOG_FILE_COUNT = 1
 
 UPLOAD_PATH = 'uploaded'
 
+# buffer up to this many metric logs in memory and insert them together,
+# None inserts each log right away. Buffered logs are also inserted every
+# interval (in seconds), until then they are not visible to other processes
+METRIC_LOG_BUFFER_SIZE = None
+METRIC_LOG_BUFFER_INTERVAL = 5
+# while inserting buffered logs fails at most this many are kept, the
+# oldest ones past it are dropped
+METRIC_LOG_BUFFER_LIMIT = 10000
+
+# seconds a process may keep using cached metrics after they were changed
+# by another process, e.g. the CLI
+METRIC_CACHE_CHECK_INTERVAL = 10
+
+# triggers are checked as soon as a log is created by the automata, logs
+# created by other processes (e.g. MQTT or the server) are looked for every
+# interval (in seconds). BOUND_CHECK_FREQUENCY is only a fallback.
+TRIGGER_POLL_INTERVAL = 1
+# a trigger action is only reversed once the value is back within the bound
+# by this margin, in the unit of the metric
+TRIGGER_HYSTERESIS = 0
+# number of logs in a row a trigger condition has to hold for before acting
+TRIGGER_DEBOUNCE = 1
+
+# numeric metric logs are rolled up into buckets of these sizes as they are
+# created, an empty list turns off rollups. Existing logs are rolled up with
+# `gardnr rollup backfill`
+METRIC_ROLLUP_RESOLUTIONS = [constants.ROLLUP_MINUTE,
+                             constants.ROLLUP_HOUR,
+                             constants.ROLLUP_DAY]
+
+# number of export logs inserted per statement, SQLite limits the number
+# of variables in a statement so keep this under 999 / 2
+EXPORT_LOG_BATCH_SIZE = 400
+
+# read sensors concurrently in this many threads, None reads them one after
+# the other. The timeout (in seconds) is how long a read waits for each
+# concurrent sensor, None waits until they are all done
+READ_WORKERS = None
+READ_TIMEOUT = None
+
+# run exporters concurrently in this many threads, None runs them one after
+# the other. The timeout (in seconds) is how long a write waits for each
+# concurrent exporter, None waits until they are all done
+EXPORT_WORKERS = None
+EXPORT_TIMEOUT = None
+
 # l10n
 TEMPERATURE_UNIT = constants.CELSIUS
 
 GROW_RECIPE = None
 BOUND_CHECK_FREQUENCY = 5  # in minutes
 
+# days metric logs (constants.RETENTION_RAW) and each resolution of their
+# rollups are kept for, by (metric topic, metric type) with None matching
+# any. The most specific match applies, anything left out is kept forever.
+# Logs are only purged once every enabled exporter has exported them. e.g.
+# RETENTION_POLICIES = {
+#     (None, None): {constants.RETENTION_RAW: 30,
+#                    constants.ROLLUP_MINUTE: 90},
+#     (None, constants.IMAGE): {constants.RETENTION_RAW: 7},
+# }
+RETENTION_POLICIES = {}
+# in hours, blobs of uploaded files which are no longer referenced are
+# also removed this often
+RETENTION_FREQUENCY = 1
+# rows deleted per transaction, so the database is never locked for long
+RETENTION_BATCH_SIZE = 500
+
+# broker the MQTT subscriber (gardnr-mqtt) connects to
+MQTT_HOST = 'localhost'
+MQTT_PORT = 1883
+# messages waiting to be inserted, once full new messages are dropped
+MQTT_QUEUE_SIZE = 10000
+# messages are inserted in batches of up to this many, waiting at most
+# interval (in seconds) for a batch to fill up
+MQTT_BATCH_SIZE = 500
+MQTT_BATCH_INTERVAL = 1
+# seconds between logging the queue depth and message counts
+MQTT_STATS_INTERVAL = 60
+
+# number of logs or rollups per page of the JSON API, by default and at
+# most
+API_PAGE_SIZE = 1000
+API_MAX_PAGE_SIZE = 10000
+
+# the server's live stream looks for new logs every interval (in seconds),
+# once for all of its clients. A client is dropped once this many logs are
+# waiting to be sent to it, idle clients are sent a keepalive every
+# interval (in seconds)
+LIVE_POLL_INTERVAL = 1
+LIVE_BUFFER_SIZE = 100
+LIVE_KEEPALIVE_INTERVAL = 15
+
 # can be overwritten incase there are more verbose templates
 TEMPLATE_DIRECTORY = 'templates'
 SENSOR_DRIVER_TEMPLATE = 'sensor_driver.py'
@@ -1,3 +1,4 @@
 from gardnr.tasks.read import read
 from gardnr.tasks.write import write
 from gardnr.tasks.power import power_off, power_on
+from gardnr.tasks.purge import purge
@@ -0,0 +1,205 @@
+"""
+Purges metric logs, their uploaded files and rollups once they are past
+their retention
+"""
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+
+import peewee
+
+from gardnr import (blobs, constants, drivers, logger, models, reflection,
+                    settings)
+
+
+def get_retention_policy(metric: models.Metric) -> Dict[str, int]:
+    """The most specific retention policy matching the metric"""
+
+    for key in ((metric.topic, metric.type),
+                (None, metric.type),
+                (metric.topic, None),
+                (None, None)):
+        if key in settings.RETENTION_POLICIES:
+            return settings.RETENTION_POLICIES[key]
+
+    return {}
+
+
+def _is_exported(
+        exporter: drivers.Exporter,
+        metric: models.Metric
+) -> Optional[peewee.Expression]:
+    """
+    Filter for the logs of metric exported with the exporter, None when the
+    exporter does not export the logs of metric
+    """
+
+    if exporter.whitelist:
+        if metric.type not in exporter.whitelist:
+            return None
+    elif exporter.blacklist and metric.type in exporter.blacklist:
+        return None
+
+    if exporter.export_tracking == constants.EXPORT_WATERMARK:
+        watermark = models.ExportWatermark.get_or_none(
+            models.ExportWatermark.driver == exporter.model)
+
+        if watermark:
+            return models.METRIC_LOG_ROWID <= watermark.position
+
+    return peewee.fn.EXISTS(
+        models.ExportLog.select()
+        .where((models.ExportLog.metric_log == models.MetricLog.id) &
+               (models.ExportLog.driver == exporter.model)))
+
+
+def _delete_files(file_names: Iterable[str]) -> None:
+    """Deletes files uploaded by older versions, before the blob store"""
+
+    for file_name in file_names:
+        try:
+            os.remove(os.path.join(settings.UPLOAD_PATH, file_name))
+        except FileNotFoundError:
+            pass
+        except OSError:
+            logger.exception('Error deleting uploaded file {file_name}'
+                             .format(file_name=file_name))
+
+
+def purge_logs(
+        metric: models.Metric,
+        days: int,
+        exporters: List[drivers.Exporter]
+) -> int:
+    """
+    Deletes the logs of metric older than days which were exported with
+    every exporter, along with their uploaded files. Logs are deleted in
+    batches, each in its own short transaction. Returns the number of logs
+    deleted.
+    """
+
+    cutoff = datetime.utcnow() - timedelta(days=days)
+
+    # uses the (metric, timestamp) index
+    expired_logs = models.MetricLog\
+        .select(models.MetricLog.id, models.MetricLog.path)\
+        .where((models.MetricLog.metric == metric) &
+               (models.MetricLog.timestamp < cutoff))\
+        .limit(settings.RETENTION_BATCH_SIZE)
+
+    for exporter in exporters:
+        is_exported = _is_exported(exporter, metric)
+
+        if is_exported is not None:
+            expired_logs = expired_logs.where(is_exported)
+
+    purged = 0
+
+    while True:
+        # read outside of the transaction so it only holds the write lock
+        logs = list(expired_logs.tuples())
+
+        if not logs:
+            break
+
+        log_ids = [log_id for log_id, _ in logs]
+        not_blobs = []  # type: List[str]
+
+        with models.atomic():
+            models.ExportLog.delete()\
+                .where(models.ExportLog.metric_log.in_(log_ids))\
+                .execute()
+            models.MetricLog.delete()\
+                .where(models.MetricLog.id.in_(log_ids))\
+                .execute()
+
+            if metric.type in constants.FILE_METRICS:
+                not_blobs = blobs.release(path for _, path in logs if path)
+
+        # only once the logs are gone, so a log never points to no file.
+        # Blobs are removed by garbage collection once unreferenced.
+        _delete_files(not_blobs)
+
+        purged += len(logs)
+
+        if len(logs) < settings.RETENTION_BATCH_SIZE:
+            break
+
+    return purged
+
+
+def purge_rollups(metric: models.Metric, resolution: str, days: int) -> int:
+    """
+    Deletes the rollups of metric for buckets older than days, in batches.
+    Returns the number of rollups deleted.
+    """
+
+    cutoff = datetime.utcnow() - timedelta(days=days)
+
+    expired_rollups = models.MetricRollup\
+        .select(models.MetricRollup.id)\
+        .where((models.MetricRollup.metric == metric) &
+               (models.MetricRollup.resolution == resolution) &
+               (models.MetricRollup.bucket < cutoff))\
+        .limit(settings.RETENTION_BATCH_SIZE)
+
+    purged = 0
+
+    while True:
+        rollup_ids = [rollup_id for rollup_id, in expired_rollups.tuples()]
+
+        if not rollup_ids:
+            break
+
+        models.MetricRollup.delete()\
+            .where(models.MetricRollup.id.in_(rollup_ids))\
+            .execute()
+
+        purged += len(rollup_ids)
+
+        if len(rollup_ids) < settings.RETENTION_BATCH_SIZE:
+            break
+
+    return purged
+
+
+def purge() -> None:
+    """
+    Deletes what is past its retention in settings.RETENTION_POLICIES, then
+    the blobs which are no longer referenced
+    """
+
+    if settings.RETENTION_POLICIES:
+        _purge_expired()
+
+    removed = blobs.collect_garbage()
+
+    if removed:
+        logger.info('Removed {count} unreferenced blobs'.format(
+            count=removed))
+
+
+def _purge_expired() -> None:
+    # logs are kept until exported with every enabled exporter
+    exporters = reflection.load_active_drivers(constants.EXPORTER)
+
+    for metric in models.Metric.select():
+        policy = get_retention_policy(metric)
+
+        if policy.get(constants.RETENTION_RAW) is not None:
+            purged = purge_logs(metric, policy[constants.RETENTION_RAW],
+                                exporters)
+
+            if purged:
+                logger.info('Purged {count} logs of {name}'.format(
+                    count=purged, name=metric.name))
+
+        for resolution in constants.rollup_resolutions:
+            if policy.get(resolution) is not None:
+                purged = purge_rollups(metric, resolution, policy[resolution])
+
+                if purged:
+                    logger.info('Purged {count} {resolution} rollups of '
+                                '{name}'.format(count=purged,
+                                                resolution=resolution,
+                                                name=metric.name))
@@ -1,6 +1,56 @@
-from typing import List
+from collections import OrderedDict
+from functools import partial
+from typing import Dict, List, Optional
 
-from gardnr import drivers
+from gardnr import drivers, settings
+from gardnr.tasks import workers
+
+
+def _read_sensors(sensors: List[drivers.Sensor]) -> None:
+    for sensor in sensors:
+        # TODO: should be a better way to do this https://goo.gl/xrJdpv
+        sensor.read()  # type: ignore
+
+
+def _group_sensors(
+        sensors: List[drivers.Sensor]
+) -> Dict[str, List[drivers.Sensor]]:
+    """
+    Groups the sensors by the name of the job reading them. Sensors in the
+    same concurrency group share a job so they are read one at a time,
+    every other sensor gets its own job.
+    """
+
+    groups = OrderedDict()  # type: Dict[str, List[drivers.Sensor]]
+
+    for sensor in sensors:
+        if sensor.concurrency_group:
+            name = 'concurrency group {group}'.format(
+                group=sensor.concurrency_group)
+        else:
+            name = sensor.model.name
+
+        groups.setdefault(name, []).append(sensor)
+
+    return groups
+
+
+def _read_timeout(sensors: List[drivers.Sensor]) -> Optional[float]:
+    """Total time allowed to read the sensors, one after the other"""
+
+    total = 0.0
+
+    for sensor in sensors:
+        timeout = sensor.timeout
+        if timeout is None:
+            timeout = settings.READ_TIMEOUT
+
+        if timeout is None:
+            return None
+
+        total += float(timeout)
+
+    return total
 
 
 def read(sensors: List[drivers.Sensor]) -> None:
@@ -8,6 +58,14 @@ def read(sensors: List[drivers.Sensor]) -> None:
     Iterate over every sensor and read from it and create logs and store
     them in database.
     """
-    for sensor in sensors:
-        # TODO: should be a better way to do this https://goo.gl/xrJdpv
-        sensor.read()  # type: ignore
+
+    if settings.READ_WORKERS:
+        jobs = [workers.Job(name,
+                            partial(_read_sensors, group),
+                            _read_timeout(group))
+                for name, group in _group_sensors(sensors).items()]
+
+        workers.run(jobs, settings.READ_WORKERS)
+        return
+
+    _read_sensors(sensors)
@@ -0,0 +1,102 @@
+"""
+Runs driver tasks concurrently in a bounded number of worker threads
+"""
+import concurrent.futures
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List, Optional, Set, Tuple
+
+from gardnr import logger, models
+
+
+class Job:
+    """A function to run in a worker thread, identified by a unique name"""
+
+    def __init__(
+            self,
+            name: str,
+            func: Callable[[], None],
+            timeout: Optional[float] = None
+    ) -> None:
+        self.name = name
+        self.func = func
+        # driver configs are strings when set from the command line
+        self.timeout = float(timeout) if timeout is not None else None
+
+
+# names of the jobs running in a worker thread, a timed out job stays in
+# here until it finishes in the background
+_running_jobs = set()  # type: Set[str]
+_running_jobs_lock = threading.Lock()
+
+
+def _run_job(job: Job, future: Future, slots: threading.Semaphore) -> None:
+    """Runs a job in a worker thread, with its own database connection"""
+
+    with slots:
+        # cancelled when it timed out before a worker was free
+        if not future.set_running_or_notify_cancel():
+            return
+
+        try:
+            job.func()
+        except BaseException as ex:  # pylint: disable=broad-except
+            future.set_exception(ex)
+        else:
+            future.set_result(None)
+        finally:
+            models.close_db()
+
+            with _running_jobs_lock:
+                _running_jobs.discard(job.name)
+
+
+def run(jobs: List[Job], workers: int) -> None:
+    """
+    Runs the jobs in worker threads, at most workers at a time, and waits
+    for each of them up to its timeout, counted from the start of the run.
+    Jobs which time out are abandoned: they are left to finish in the
+    background and are skipped by later runs until they are done. Their
+    threads are daemon threads, so a hung job never holds up the exit of
+    the process.
+    """
+
+    slots = threading.Semaphore(workers)
+    futures = []  # type: List[Tuple[Future, Job]]
+
+    for job in jobs:
+        with _running_jobs_lock:
+            if job.name in _running_jobs:
+                logger.warning('{name} is still running from a previous '
+                               'run, skipping it'.format(name=job.name))
+                continue
+
+            _running_jobs.add(job.name)
+
+        future = Future()  # type: Future
+        # not joined on exit, unlike the threads of a ThreadPoolExecutor
+        threading.Thread(target=_run_job, args=(job, future, slots),
+                         daemon=True).start()
+
+        futures.append((future, job))
+
+    start = time.monotonic()
+
+    for future, job in futures:
+        timeout = job.timeout
+        if timeout is not None:
+            timeout = max(0, start + timeout - time.monotonic())
+
+        try:
+            future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            if future.cancel():
+                # never started, so it is not running in the background
+                with _running_jobs_lock:
+                    _running_jobs.discard(job.name)
+
+            logger.warning('{name} timed out, it will be retried on the '
+                           'next run'.format(name=job.name))
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Error running {name}'.format(name=job.name))
@@ -1,8 +1,10 @@
-from typing import List
+from functools import partial
+from typing import Iterator, List, Optional
 
 import peewee
 
-from gardnr import constants, drivers, logger, models
+from gardnr import constants, drivers, logger, models, settings
+from gardnr.tasks import workers
 
 
 def _exported_logs(driver_model: models.Driver) -> peewee.ModelSelect:
@@ -13,78 +15,261 @@ def _exported_logs(driver_model: models.Driver) -> peewee.ModelSelect:
         .where(models.ExportLog.driver == driver_model)
 
 
-def get_all_logs(driver_model: models.Driver) -> peewee.ModelSelect:
+def _not_exported(
+        driver_model: models.Driver,
+        watermark: Optional[models.ExportWatermark]
+) -> peewee.Expression:
+    """
+    Helper function to filter out the logs already exported with
+    driver_model, either from its ExportLog rows or past its watermark
+    """
+
+    if watermark:
+        return models.METRIC_LOG_ROWID > watermark.position
+
+    return models.MetricLog.id.not_in(_exported_logs(driver_model))
+
+
+def _select_logs() -> peewee.ModelSelect:
+    """Helper function to select logs in the order they were created"""
+
+    return models.MetricLog.select(
+        models.MetricLog,
+        models.METRIC_LOG_ROWID.alias('rowid')
+    ).order_by(models.METRIC_LOG_ROWID)
+
+
+def get_all_logs(
+        driver_model: models.Driver,
+        watermark: Optional[models.ExportWatermark] = None
+) -> peewee.ModelSelect:
     """All logs that have not been exported with driver_model"""
 
-    return models.MetricLog.select().where(
-        models.MetricLog.id.not_in(_exported_logs(driver_model))
-    )
+    return _select_logs().where(_not_exported(driver_model, watermark))
 
 
 def get_whitelisted_logs(
         driver_model: models.Driver,
-        whitelist: List[str]
+        whitelist: List[str],
+        watermark: Optional[models.ExportWatermark] = None
 ) -> peewee.ModelSelect:
     """
     Logs from whitelisted metrics that have not been exported with
     driver_model
     """
 
-    return models.MetricLog.select()\
+    return _select_logs()\
         .join(models.Metric)\
-        .where(models.MetricLog.id.not_in(_exported_logs(driver_model))
+        .where(_not_exported(driver_model, watermark)
                & models.MetricLog.metric.type.in_(whitelist))
 
 
 def get_not_blacklisted_logs(
         driver_model: models.Driver,
-        blacklist: List[str]
+        blacklist: List[str],
+        watermark: Optional[models.ExportWatermark] = None
 ) -> peewee.ModelSelect:
     """
     Logs from whitelisted metrics that have not been exported with
     driver_model
     """
 
-    return models.MetricLog.select()\
+    return _select_logs()\
         .join(models.Metric)\
-        .where(models.MetricLog.id.not_in(_exported_logs(driver_model))
+        .where(_not_exported(driver_model, watermark)
                & models.MetricLog.metric.type.not_in(blacklist))
 
 
-def write(exporters: List[drivers.Exporter]) -> None:
-    """Upload logs in local DB to web server."""
+def get_logs(
+        exporter: drivers.Exporter,
+        watermark: Optional[models.ExportWatermark] = None
+) -> peewee.ModelSelect:
+    """Logs that have not been exported, filtered for the exporter"""
 
-    for exporter in exporters:
+    if exporter.whitelist:
+        return get_whitelisted_logs(exporter.model, exporter.whitelist,
+                                    watermark)
+    elif exporter.blacklist:
+        return get_not_blacklisted_logs(exporter.model, exporter.blacklist,
+                                        watermark)
+
+    return get_all_logs(exporter.model, watermark)
+
+
+def get_watermark(exporter: drivers.Exporter) -> models.ExportWatermark:
+    """
+    Returns the watermark of the exporter. The first time, it is migrated
+    from the exporter's ExportLog rows by starting right before the earliest
+    log not exported yet, so a log may be exported again but never skipped.
+    """
+
+    watermark = models.ExportWatermark.get_or_none(
+        models.ExportWatermark.driver == exporter.model)
+
+    if watermark:
+        return watermark
+
+    first_pending = get_logs(exporter)\
+        .select(peewee.fn.MIN(models.METRIC_LOG_ROWID))\
+        .order_by()\
+        .scalar()
+
+    if first_pending is not None:
+        position = first_pending - 1
+    else:
+        position = models.MetricLog.select(
+            peewee.fn.MAX(models.METRIC_LOG_ROWID)).scalar() or 0
+
+    return models.ExportWatermark.create(driver=exporter.model,
+                                         position=position)
+
+
+def _advance_watermark(
+        watermark: models.ExportWatermark,
+        logs: List[models.MetricLog],
+        failed_logs: List[models.MetricLog]
+) -> None:
+    """
+    Moves the watermark past the exported logs, stopping before the first
+    failed log so it is exported again on the next run
+    """
+
+    failed_log_ids = {log.id for log in failed_logs}
+
+    for log in logs:
+        if log.id in failed_log_ids:
+            break
+
+        watermark.position = log.rowid
+
+    watermark.save()
+
+
+def _create_export_logs(
+        driver_model: models.Driver,
+        logs: List[models.MetricLog],
+        failed_logs: List[models.MetricLog]
+) -> None:
+    """
+    Records the logs which did not fail as exported with driver_model, in
+    batches inside of a single transaction
+    """
+
+    failed_log_ids = {log.id for log in failed_logs}
+
+    rows = ({'metric_log': log.id, 'driver': driver_model.id}
+            for log in logs if log.id not in failed_log_ids)
+
+    with models.atomic():
+        for batch in peewee.chunked(rows, settings.EXPORT_LOG_BATCH_SIZE):
+            models.ExportLog.insert_many(batch).execute()
+
+
+def _record_exports(
+        exporter: drivers.Exporter,
+        watermark: Optional[models.ExportWatermark],
+        logs: List[models.MetricLog],
+        failed_logs: List[models.MetricLog]
+) -> None:
+    """Records the logs which did not fail as exported with the exporter"""
+
+    if watermark:
+        _advance_watermark(watermark, logs, failed_logs)
+    else:
+        _create_export_logs(exporter.model, logs, failed_logs)
+
+
+def _export(
+        exporter: drivers.Exporter,
+        watermark: Optional[models.ExportWatermark],
+        logs: List[models.MetricLog]
+) -> bool:
+    """
+    Exports the logs and records the ones which were exported. Returns
+    whether every log was exported.
+    """
+
+    try:
+        exporter.export(logs)
+    except Exception as e:  # pylint: disable=broad-except
+        logger.exception('Error exporting')
+
+        # If the exporter sets the failed_logs field in the exception
+        # use it, otherwise assume all logs failed
+        failed_logs = getattr(e, 'failed_logs', [])
+
+        # If there are no failed logs specified, skip export logging
+        if failed_logs:
+            _record_exports(exporter, watermark, logs, failed_logs)
+
+        return False
+
+    _record_exports(exporter, watermark, logs, [])
 
-        if exporter.whitelist:
-            logs = get_whitelisted_logs(exporter.model, exporter.whitelist)
-        elif exporter.blacklist:
-            logs = get_not_blacklisted_logs(exporter.model, exporter.blacklist)
-        else:
-            logs = get_all_logs(exporter.model)
+    return True
 
-        # no new logs to export
-        if not logs:
-            continue
 
-        # store the failed logs during export
-        failed_log_ids = []  # type: List[UUID]
+def _chunk_logs(
+        logs: peewee.ModelSelect,
+        batch_size: int
+) -> Iterator[List[models.MetricLog]]:
+    """
+    Splits the logs into lists of at most batch_size logs. Each chunk is
+    queried from where the previous one ended, only when it is needed.
+    """
+
+    last_rowid = 0
+
+    while True:
+        chunk = list(logs.where(models.METRIC_LOG_ROWID > last_rowid)
+                     .limit(batch_size)
+                     .iterator())
+
+        if not chunk:
+            return
+
+        yield chunk
+
+        last_rowid = chunk[-1].rowid
+
+
+def _write_exporter(exporter: drivers.Exporter) -> None:
+    """Exports the logs which have not been exported with the exporter"""
 
-        try:
-            exporter.export([log for log in logs])  # type: ignore
-        except Exception as e:  # pylint: disable=broad-except
-            logger.exception('Error exporting')
+    watermark = None
+    if exporter.export_tracking == constants.EXPORT_WATERMARK:
+        watermark = get_watermark(exporter)
 
-            # If the exporter sets the failed_logs field in the exception
-            # use it, otherwise assume all logs failed
-            failed_logs = getattr(e, 'failed_logs', [])
+    logs = get_logs(exporter, watermark)
 
-            # If there are no failed logs specified, skip export logging
-            if not failed_logs:
-                continue
+    if exporter.batch_size:
+        # driver configs are strings when set from the command line
+        for chunk in _chunk_logs(logs, int(exporter.batch_size)):
+            # stop at the first failure, the rest is retried next run
+            if not _export(exporter, watermark, chunk):
+                break
 
-            failed_log_ids = [log.id for log in failed_logs]
+        return
 
-        for log in logs:
-            if log.id not in failed_log_ids:
-                models.ExportLog.create(metric_log=log, driver=exporter.model)
+    # no new logs to export
+    if not logs:
+        return
+
+    _export(exporter, watermark, list(logs))
+
+
+def write(exporters: List[drivers.Exporter]) -> None:
+    """Upload logs in local DB to web server."""
+
+    if settings.EXPORT_WORKERS:
+        jobs = [workers.Job(exporter.model.name,
+                            partial(_write_exporter, exporter),
+                            (exporter.timeout if exporter.timeout is not None
+                             else settings.EXPORT_TIMEOUT))
+                for exporter in exporters]
+
+        workers.run(jobs, settings.EXPORT_WORKERS)
+        return
+
+    for exporter in exporters:
+        _write_exporter(exporter)
@@ -1,6 +1,8 @@
+from unittest.mock import patch
+
 import pytest
 
-from gardnr import automata, models, server, settings
+from gardnr import automata, metrics, models, reflection, server, settings
 from tests import utils
 
 
@@ -12,6 +14,12 @@ def test_env():
     # reinitialized an empty database in memory
     models.initialize_db()
 
+    # drivers and metrics loaded from the previous database
+    reflection.unload_drivers()
+    metrics.invalidate_metric_cache()
+    server.invalidate_metric_form()
+    metrics.reset_latest_logs()
+
     # reset test exporter call count
     utils.MockExporter.call_count = 0
 
@@ -22,6 +30,19 @@ def test_env():
     automata.active_trigger_bounds = []
 
 
+@pytest.fixture
+def file_db(tmpdir):
+    """
+    Database stored in a temporary file, needed by tests running worker
+    threads since each thread gets its own connection
+    """
+
+    with patch.object(settings, 'TEST_MODE', False), \
+            patch.object(settings, 'LOCAL_DB', str(tmpdir.join('test.db'))):
+        models.initialize_db()
+        yield
+
+
 @pytest.fixture
 def web_client():
     # TODO: needs to be setup to use in-memory database
@@ -0,0 +1,155 @@
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from uuid import uuid4
+
+import pytest
+
+from gardnr import constants, metrics, models, settings, tasks
+from tests import utils
+
+OLD = datetime.utcnow() - timedelta(days=10)
+
+
+def _create_log(metric: models.Metric,
+                timestamp: datetime,
+                value=0) -> models.MetricLog:
+    return models.MetricLog.create(uuid=uuid4(), metric=metric, value=value,
+                                   timestamp=timestamp)
+
+
+@pytest.mark.usefixtures('test_env')
+def test_purge_exported_logs():
+    metric = utils.create_air_temperature_metric()
+    exporter = utils.create_and_load_exporter()
+
+    _create_log(metric, OLD)
+    tasks.write([exporter])
+
+    # not exported yet
+    old_log = _create_log(metric, OLD)
+    new_log = _create_log(metric, datetime.utcnow())
+
+    with patch.object(settings, 'RETENTION_POLICIES',
+                      {(None, None): {constants.RETENTION_RAW: 7}}):
+        tasks.purge()
+
+    assert {log.id for log in models.MetricLog.select()} == \
+        {old_log.id, new_log.id}
+    assert models.ExportLog.select().count() == 0
+
+
+@pytest.mark.usefixtures('test_env')
+def test_purge_watermark_and_filtered_exporters():
+    metric = utils.create_air_temperature_metric()
+
+    watermark_exporter = utils.create_and_load_exporter()
+    watermark_exporter.export_tracking = constants.EXPORT_WATERMARK
+
+    # never exports the metric, so it does not hold its logs back
+    other_exporter = utils.create_and_load_exporter('other-exporter')
+    other_exporter.whitelist = [constants.HUMIDITY]
+
+    _create_log(metric, OLD)
+    tasks.write([watermark_exporter])
+    _create_log(metric, OLD)
+
+    with patch.object(settings, 'RETENTION_POLICIES',
+                      {(None, None): {constants.RETENTION_RAW: 7}}), \
+            patch('gardnr.reflection.load_active_drivers',
+                  return_value=[watermark_exporter, other_exporter]):
+        tasks.purge()
+
+    assert models.MetricLog.select().count() == 1
+
+
+@pytest.mark.usefixtures('test_env')
+def test_purge_newest_logs():
+    metric = utils.create_air_temperature_metric()
+
+    exporter = utils.create_and_load_exporter()
+    exporter.export_tracking = constants.EXPORT_WATERMARK
+
+    _create_log(metric, OLD)
+    old_log = _create_log(metric, OLD)
+    tasks.write([exporter])
+
+    with patch.object(settings, 'RETENTION_POLICIES',
+                      {(None, None): {constants.RETENTION_RAW: 7}}), \
+            patch('gardnr.reflection.load_active_drivers',
+                  return_value=[exporter]):
+        tasks.purge()
+
+    assert models.MetricLog.select().count() == 0
+
+    # comes after the watermark, its rowid is not reused
+    new_log = _create_log(metric, datetime.utcnow())
+    assert new_log.id > old_log.id
+
+    tasks.write([exporter])
+    assert models.ExportWatermark.get().position == new_log.id
+
+
+@pytest.mark.usefixtures('test_env')
+def test_purge_most_specific_policy():
+    metric = utils.create_air_temperature_metric()
+    _create_log(metric, OLD)
+
+    with patch.object(settings, 'RETENTION_POLICIES', {
+            (None, None): {constants.RETENTION_RAW: 7},
+            (constants.AIR, constants.T9E): {constants.RETENTION_RAW: 30}
+    }):
+        tasks.purge()
+
+    assert models.MetricLog.select().count() == 1
+
+
+@pytest.mark.usefixtures('test_env')
+def test_purge_in_batches():
+    metric = utils.create_air_temperature_metric()
+
+    for _ in range(5):
+        _create_log(metric, OLD)
+
+    with patch.object(settings, 'RETENTION_POLICIES',
+                      {(None, None): {constants.RETENTION_RAW: 7}}), \
+            patch.object(settings, 'RETENTION_BATCH_SIZE', 2):
+        tasks.purge()
+
+    assert models.MetricLog.select().count() == 0
+
+
+@pytest.mark.usefixtures('test_env')
+def test_purge_image_files(tmpdir):
+    metric = models.Metric.create(id=uuid4(), name='test-image',
+                                  topic=constants.LIGHT,
+                                  type=constants.IMAGE)
+
+    with patch.object(settings, 'UPLOAD_PATH', str(tmpdir)):
+        old_log = metrics.create_file_log(metric, b'old', '.jpg')
+        old_log.timestamp = OLD
+        old_log.save()
+        new_log = metrics.create_file_log(metric, b'new', '.jpg')
+
+        with patch.object(settings, 'RETENTION_POLICIES',
+                          {(None, constants.IMAGE):
+                           {constants.RETENTION_RAW: 7}}):
+            tasks.purge()
+
+    assert not tmpdir.join(old_log.value).exists()
+    assert tmpdir.join(new_log.value).exists()
+    assert models.MetricLog.select().count() == 1
+
+
+@pytest.mark.usefixtures('test_env')
+def test_purge_rollups():
+    metric = utils.create_air_temperature_metric()
+
+    metrics.update_rollups([(metric.id, OLD, 1),
+                            (metric.id, datetime.utcnow(), 1)])
+
+    with patch.object(settings, 'RETENTION_POLICIES',
+                      {(None, None): {constants.ROLLUP_MINUTE: 7}}):
+        tasks.purge()
+
+    assert metrics.get_rollups(metric, constants.ROLLUP_MINUTE).count() == 1
+    assert metrics.get_rollups(metric, constants.ROLLUP_DAY).count() == 2
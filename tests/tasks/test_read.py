@@ -1,6 +1,10 @@
+import threading
+import time
+from unittest.mock import patch
+
 import pytest
 
-from gardnr import models, tasks
+from gardnr import models, settings, tasks
 from tests import utils
 
 
@@ -17,3 +21,66 @@ def test_read_sensor():
     assert logs.count() == 1
     assert logs[0].metric.name == utils.TEST_METRIC
     assert logs[0].value == utils.TEST_TEMPERATURE
+
+
+class ConcurrentSensor(utils.MockSensor):
+    """Only finishes reading when another sensor is read at the same time"""
+    barrier = threading.Barrier(2, timeout=5)
+
+    def read(self) -> None:
+        ConcurrentSensor.barrier.wait()
+        super().read()
+
+
+@pytest.mark.usefixtures('test_env', 'file_db')
+@patch.object(settings, 'READ_WORKERS', 2)
+def test_concurrent_read():
+
+    ConcurrentSensor.barrier.reset()
+
+    metric = utils.create_air_temperature_metric()
+
+    sensors = [utils.create_and_load_sensor(name, ConcurrentSensor,
+                                            metric.name)
+               for name in ('sensor1', 'sensor2')]
+
+    tasks.read(sensors)
+
+    assert models.MetricLog.select().count() == 2
+
+
+class BusSensor(utils.MockSensor):
+    """Keeps track of how many sensors on the bus are read at once"""
+    concurrency_group = 'bus'
+    active = 0
+    max_active = 0
+    lock = threading.Lock()
+
+    def read(self) -> None:
+        with BusSensor.lock:
+            BusSensor.active += 1
+            BusSensor.max_active = max(BusSensor.max_active,
+                                       BusSensor.active)
+
+        time.sleep(0.05)
+        super().read()
+
+        with BusSensor.lock:
+            BusSensor.active -= 1
+
+
+@pytest.mark.usefixtures('test_env', 'file_db')
+@patch.object(settings, 'READ_WORKERS', 3)
+def test_concurrent_read_group():
+
+    BusSensor.max_active = 0
+
+    metric = utils.create_air_temperature_metric()
+
+    sensors = [utils.create_and_load_sensor(name, BusSensor, metric.name)
+               for name in ('sensor1', 'sensor2', 'sensor3')]
+
+    tasks.read(sensors)
+
+    assert models.MetricLog.select().count() == 3
+    assert BusSensor.max_active == 1
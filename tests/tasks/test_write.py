@@ -1,9 +1,13 @@
-from typing import List
+import threading
+import time
+from typing import List, Optional
+from unittest.mock import patch
 from uuid import uuid4
 
 import pytest
 
-from gardnr import constants, drivers, models, tasks
+from gardnr import constants, drivers, models, settings, tasks
+from gardnr.tasks.write import get_all_logs, get_logs, get_watermark
 from tests import utils
 
 
@@ -105,6 +109,30 @@ def test_export_failed_specify():
     assert export_logs.count() == 1
 
 
+@pytest.mark.usefixtures('test_env')
+def test_export_failed_specify_batched():
+
+    sensor = utils.create_and_load_air_temperature_sensor()
+
+    for _ in range(5):
+        tasks.read([sensor])
+
+    exporter = utils.create_and_load_exporter(
+        driver_type=FailingExporterSpecify)
+
+    with patch.object(settings, 'EXPORT_LOG_BATCH_SIZE', 2):
+        tasks.write([exporter])
+
+    first_log = models.MetricLog.select()\
+        .order_by(models.METRIC_LOG_ROWID)\
+        .first()
+
+    export_logs = models.ExportLog.select()
+    assert export_logs.count() == 4
+    assert first_log.id not in \
+        {export_log.metric_log.id for export_log in export_logs}
+
+
 class FailingExporterAll(drivers.Exporter):
     def export(self, logs: List[models.MetricLog]) -> None:
         raise Exception()
@@ -133,13 +161,13 @@ class WhitelistExporter(utils.MockExporter):
 def test_whitelisted_write():
 
     temp_metric = utils.create_air_temperature_metric()
-    models.MetricLog.create(id=uuid4(), metric=temp_metric, value=0)
+    models.MetricLog.create(uuid=uuid4(), metric=temp_metric, value=0)
 
     humid_metric = models.Metric.create(id=uuid4(),
                                         name='test-humidity',
                                         topic=constants.AIR,
                                         type=constants.HUMIDITY)
-    whitelisted_log = models.MetricLog.create(id=uuid4(),
+    whitelisted_log = models.MetricLog.create(uuid=uuid4(),
                                               metric=humid_metric,
                                               value=0)
 
@@ -161,13 +189,13 @@ class BlacklistExporter(utils.MockExporter):
 def test_blacklisted_write():
 
     temp_metric = utils.create_air_temperature_metric()
-    models.MetricLog.create(id=uuid4(), metric=temp_metric, value=0)
+    models.MetricLog.create(uuid=uuid4(), metric=temp_metric, value=0)
 
     humid_metric = models.Metric.create(id=uuid4(),
                                         name='test-humidity',
                                         topic=constants.AIR,
                                         type=constants.HUMIDITY)
-    blacklisted_log = models.MetricLog.create(id=uuid4(),
+    blacklisted_log = models.MetricLog.create(uuid=uuid4(),
                                               metric=humid_metric,
                                               value=0)
 
@@ -179,3 +207,181 @@ def test_blacklisted_write():
     export_logs = models.ExportLog.select()
     assert export_logs.count() == 1
     assert export_logs[0].metric_log.id != blacklisted_log.id
+
+
+class WatermarkExporter(utils.MockExporter):
+    export_tracking = constants.EXPORT_WATERMARK
+
+
+@pytest.mark.usefixtures('test_env')
+def test_watermark_write():
+
+    sensor = utils.create_and_load_air_temperature_sensor()
+    exporter = utils.create_and_load_exporter(driver_type=WatermarkExporter)
+
+    tasks.read([sensor])
+    tasks.write([exporter])
+
+    assert utils.MockExporter.call_count == 1
+    assert models.ExportLog.select().count() == 0
+
+    tasks.write([exporter])
+    assert utils.MockExporter.call_count == 1
+
+    tasks.read([sensor])
+    tasks.write([exporter])
+    assert utils.MockExporter.call_count == 2
+
+    watermark = models.ExportWatermark.get(
+        models.ExportWatermark.driver == exporter.model)
+    assert watermark.position == get_all_logs(exporter.model)[-1].rowid
+
+
+class FailingWatermarkExporter(WatermarkExporter):
+    def export(self, logs: List[models.MetricLog]) -> None:
+        e = Exception()
+        e.failed_logs = [logs[1]]
+        raise e
+
+
+@pytest.mark.usefixtures('test_env')
+def test_watermark_failed_specify():
+
+    sensor = utils.create_and_load_air_temperature_sensor()
+
+    for _ in range(3):
+        tasks.read([sensor])
+
+    exporter = utils.create_and_load_exporter(
+        driver_type=FailingWatermarkExporter)
+
+    tasks.write([exporter])
+
+    # the logs from the failed one onward are still pending
+    pending_logs = get_logs(exporter, get_watermark(exporter))
+    assert pending_logs.count() == 2
+
+
+@pytest.mark.usefixtures('test_env')
+def test_watermark_migration():
+
+    sensor = utils.create_and_load_air_temperature_sensor()
+    exporter = utils.create_and_load_exporter()
+
+    tasks.read([sensor])
+    tasks.write([exporter])
+    tasks.read([sensor])
+
+    exporter.export_tracking = constants.EXPORT_WATERMARK
+
+    watermark = get_watermark(exporter)
+    pending_logs = get_logs(exporter, watermark)
+
+    assert pending_logs.count() == 1
+    assert pending_logs[0].id != models.ExportLog.get().metric_log.id
+
+
+class BatchExporter(utils.MockExporter):
+    batch_size = 2
+    batches = []  # type: List[int]
+
+    def export(self, logs: List[models.MetricLog]) -> None:
+        super().export(logs)
+        BatchExporter.batches.append(len(logs))
+
+
+@pytest.mark.usefixtures('test_env')
+def test_batch_write():
+
+    sensor = utils.create_and_load_air_temperature_sensor()
+
+    for _ in range(5):
+        tasks.read([sensor])
+
+    exporter = utils.create_and_load_exporter(driver_type=BatchExporter)
+    BatchExporter.batches = []
+
+    tasks.write([exporter])
+
+    assert BatchExporter.batches == [2, 2, 1]
+    assert models.ExportLog.select().count() == 5
+
+    tasks.write([exporter])
+    assert utils.MockExporter.call_count == 3
+
+
+class FailingBatchExporter(BatchExporter):
+    export_tracking = constants.EXPORT_WATERMARK
+
+    def export(self, logs: List[models.MetricLog]) -> None:
+        super().export(logs)
+
+        if len(BatchExporter.batches) == 2:
+            raise Exception()
+
+
+@pytest.mark.usefixtures('test_env')
+def test_batch_write_failed():
+
+    sensor = utils.create_and_load_air_temperature_sensor()
+
+    for _ in range(5):
+        tasks.read([sensor])
+
+    exporter = utils.create_and_load_exporter(
+        driver_type=FailingBatchExporter)
+    BatchExporter.batches = []
+
+    tasks.write([exporter])
+
+    # stops after the failed batch
+    assert BatchExporter.batches == [2, 2]
+
+    pending_logs = get_logs(exporter, get_watermark(exporter))
+    assert pending_logs.count() == 3
+
+
+class HungExporter(utils.MockExporter):
+    timeout = 0.1
+    released = threading.Event()
+    thread = None  # type: Optional[threading.Thread]
+
+    def export(self, logs: List[models.MetricLog]) -> None:
+        HungExporter.thread = threading.current_thread()
+        HungExporter.released.wait(5)
+        super().export(logs)
+
+
+@pytest.mark.usefixtures('test_env', 'file_db')
+@patch.object(settings, 'EXPORT_WORKERS', 2)
+def test_concurrent_write_timeout():
+
+    sensor = utils.create_and_load_air_temperature_sensor()
+    tasks.read([sensor])
+
+    HungExporter.released.clear()
+    hung_exporter = utils.create_and_load_exporter('hung-exporter',
+                                                   HungExporter)
+    exporter = utils.create_and_load_exporter()
+
+    tasks.write([hung_exporter, exporter])
+
+    export_logs = models.ExportLog.select()
+    assert export_logs.count() == 1
+    assert export_logs[0].driver.name == exporter.model.name
+
+    # still running in the background, so it is not started again
+    tasks.write([hung_exporter])
+    assert utils.MockExporter.call_count == 1
+
+    # abandoned, it does not hold up the exit of the process
+    assert HungExporter.thread.daemon
+
+    HungExporter.released.set()
+    for _ in range(50):
+        if models.ExportLog.select().count() == 2:
+            break
+        time.sleep(0.1)
+
+    assert models.ExportLog.select().count() == 2
+    assert utils.MockExporter.call_count == 2
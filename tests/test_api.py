@@ -0,0 +1,171 @@
+# pylint: disable=protected-access
+
+import base64
+import json
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+import pytest
+
+from gardnr import api, constants, metrics, models
+from tests import utils
+
+START = datetime(2019, 1, 1)
+
+
+def _create_logs(metric, count):
+    return metrics.create_metric_logs(
+        (metric, index, START + timedelta(seconds=index))
+        for index in range(count))
+
+
+@pytest.mark.usefixtures('test_env')
+def test_latest_logs(web_client):
+    metric = utils.create_air_temperature_metric()
+    models.Metric.create(id=uuid4(), name='humidity', topic=constants.AIR,
+                         type=constants.HUMIDITY)
+    _create_logs(metric, 3)
+
+    response = web_client.get('/api/metrics/latest')
+
+    assert response.status_code == 200
+    assert response.get_json() == {'metrics': [
+        {'metric': 'humidity', 'topic': constants.AIR,
+         'type': constants.HUMIDITY, 'timestamp': None, 'value': None},
+        {'metric': metric.name, 'topic': metric.topic, 'type': metric.type,
+         'timestamp': '2019-01-01T00:00:02', 'value': 2},
+    ]}
+
+
+@pytest.mark.usefixtures('test_env')
+def test_metric_logs_range(web_client):
+    metric = utils.create_air_temperature_metric()
+    _create_logs(metric, 5)
+
+    response = web_client.get(
+        '/api/metrics/{name}/logs?start=2019-01-01T00:00:01'
+        '&end=2019-01-01T00:00:03'.format(name=metric.name))
+
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert response.get_json() == {'logs': [
+        {'timestamp': '2019-01-01T00:00:01', 'value': 1},
+        {'timestamp': '2019-01-01T00:00:02', 'value': 2},
+    ], 'next': None}
+
+
+@pytest.mark.usefixtures('test_env')
+def test_metric_logs_pages(web_client):
+    metric = utils.create_air_temperature_metric()
+    _create_logs(metric, 5)
+    # same timestamp as another log, told apart by the cursor
+    metrics.create_metric_logs([(metric, 5, START)])
+
+    url = '/api/metrics/{name}/logs?limit=2'.format(name=metric.name)
+    pages = []
+
+    while url:
+        page = web_client.get(url).get_json()
+        pages.append([log['value'] for log in page['logs']])
+
+        url = page['next'] and \
+            '/api/metrics/{name}/logs?limit=2&cursor={cursor}'.format(
+                name=metric.name, cursor=page['next'])
+
+    assert pages == [[0, 5], [1, 2], [3, 4]]
+
+
+@pytest.mark.usefixtures('test_env')
+def test_metric_logs_rollups(web_client):
+    metric = utils.create_air_temperature_metric()
+    metrics.create_metric_logs([(metric, 1, START),
+                                (metric, 3, START + timedelta(seconds=1)),
+                                (metric, 5, START + timedelta(minutes=1))])
+
+    response = web_client.get(
+        '/api/metrics/{name}/logs?resolution={resolution}&limit=1'.format(
+            name=metric.name, resolution=constants.ROLLUP_MINUTE))
+    page = response.get_json()
+
+    assert page['rollups'] == [
+        {'timestamp': '2019-01-01T00:00:00', 'count': 2, 'mean': 2,
+         'min': 1, 'max': 3, 'last': 3}]
+
+    page = web_client.get(
+        '/api/metrics/{name}/logs?resolution={resolution}&cursor={cursor}'
+        .format(name=metric.name, resolution=constants.ROLLUP_MINUTE,
+                cursor=page['next'])).get_json()
+
+    assert [rollup['timestamp'] for rollup in page['rollups']] == \
+        ['2019-01-01T00:01:00']
+    assert page['next'] is None
+
+
+@pytest.mark.usefixtures('test_env')
+def test_metric_logs_errors(web_client):
+    metric = utils.create_air_temperature_metric()
+    url = '/api/metrics/{name}/logs'.format(name=metric.name)
+
+    assert web_client.get('/api/metrics/unknown/logs').status_code == 404
+    assert web_client.get(url + '?start=yesterday').status_code == 400
+    assert web_client.get(url + '?limit=0').status_code == 400
+    assert web_client.get(url + '?cursor=x').status_code == 400
+    assert web_client.get(url + '?resolution=week').status_code == 400
+
+    # well formed but not a (timestamp, id)
+    for position in ([1, 2], ['2019-01-01', 'x'], ['2019-01-01', None]):
+        cursor = base64.urlsafe_b64encode(
+            json.dumps(position).encode()).decode()
+
+        assert web_client.get(
+            url + '?cursor={cursor}'.format(cursor=cursor)).status_code == 400
+
+    cursor = base64.urlsafe_b64encode(b'[1, 2]').decode()
+    assert web_client.get(
+        url + '?resolution={resolution}&cursor={cursor}'.format(
+            resolution=constants.ROLLUP_MINUTE, cursor=cursor)
+    ).status_code == 400
+
+
+@pytest.mark.usefixtures('test_env')
+def test_get_logs_indexed():
+    metric = utils.create_air_temperature_metric()
+
+    query = api.get_logs(metric, START, START + timedelta(days=1),
+                         (START, 1)).limit(10)
+    sql, params = query.sql()
+
+    query_plan = models.execute_sql('EXPLAIN QUERY PLAN ' + sql, params)\
+        .fetchall()
+    details = [row[-1] for row in query_plan]
+
+    assert len(details) == 1
+    assert 'INDEX metriclog_metric_id_timestamp' in details[0]
+    assert 'timestamp>' in details[0]
+
+
+@pytest.mark.usefixtures('test_env', 'file_db')
+def test_live_logs(web_client):
+    metric = utils.create_air_temperature_metric()
+
+    response = web_client.get('/api/stream?metric={name}'.format(
+        name=metric.name), buffered=False)
+
+    try:
+        assert response.mimetype == 'text/event-stream'
+
+        events = response.iter_encoded()
+        assert next(events).startswith(b'retry: ')
+
+        metrics.create_metric_log(metric, 1)
+
+        event = next(events)
+        assert event.startswith(b'data: ')
+        assert json.loads(event[len(b'data: '):].decode())['value'] == 1
+
+        # the client disconnecting unsubscribes it
+        response.close()
+        assert not api.publisher._subscriptions
+    finally:
+        response.close()
+        api.publisher.stop()
@@ -1,15 +1,20 @@
 # pylint: disable=protected-access
+from datetime import timedelta, timezone
 from unittest.mock import patch
+from uuid import uuid4
 
 import pytest
-import grow_recipe
+from apscheduler.schedulers.background import BackgroundScheduler
 
-from gardnr import automata, grow, metrics, reflection
+from gardnr import automata, grow, metrics, models, reflection, settings
 from tests import utils
 
 
 @pytest.mark.usefixtures('test_env')
-def test_build_trigger_bounds() -> None:
+def test_build_trigger_bounds(tmpdir) -> None:
+    recipe_path = str(tmpdir.join('recipe.xml'))
+    utils.write_recipe(recipe_path, germination_max=0)
+
     trigger = utils.create_air_temperature_metric_trigger()
 
     grow.start()
@@ -17,16 +22,44 @@ def test_build_trigger_bounds() -> None:
 
     assert automata.trigger_bounds == []
 
-    test_max = 0
-    with patch('grow_recipe.get_metric',
-               return_value=
-               grow_recipe.query.find_metric_value.Metric(None, test_max)):
-
-        automata._build_trigger_bounds(active_grow, None)
+    with patch.object(settings, 'GROW_RECIPE', recipe_path):
+        automata._build_trigger_bounds(active_grow)
 
     assert len(automata.trigger_bounds) == 1
     assert automata.trigger_bounds[0].trigger.metric.id == trigger.metric.id
-    assert automata.trigger_bounds[0].bound == test_max
+    assert automata.trigger_bounds[0].bound == 0
+
+
+@pytest.mark.usefixtures('test_env')
+def test_refresh_trigger_bounds_new_stage(tmpdir) -> None:
+    recipe_path = str(tmpdir.join('recipe.xml'))
+    utils.write_recipe(recipe_path)
+
+    utils.create_air_temperature_metric_trigger()
+
+    grow.start()
+    active_grow = grow.get_active()
+    scheduler = BackgroundScheduler()
+
+    with patch.object(settings, 'GROW_RECIPE', recipe_path):
+        automata._build_trigger_bounds(active_grow)
+        tb = automata.trigger_bounds[0]
+        assert tb.bound == 25
+
+        automata.refresh_trigger_bounds(scheduler, active_grow)
+        assert automata.trigger_bounds[0].bound == 25
+
+        # the germination stage lasts an hour, then the default applies
+        active_grow.start -= timedelta(hours=1)
+        automata.refresh_trigger_bounds(scheduler, active_grow)
+
+    assert automata.trigger_bounds == [tb]
+    assert tb.bound == 18
+
+    # scheduled for when the vegetative stage ends
+    stage_change = scheduler.get_job(automata.STAGE_CHANGE_JOB_ID)
+    assert stage_change.trigger.run_date == (
+        active_grow.start + timedelta(hours=3)).replace(tzinfo=timezone.utc)
 
 
 @pytest.mark.usefixtures('test_env')
@@ -68,3 +101,128 @@ def test_active_bound_checker():
     assert utils.MockPower.on_count == 0
     automata.bound_checker()
     assert utils.MockPower.on_count == 1
+
+
+@pytest.mark.usefixtures('test_env')
+def test_bound_checker_no_log_queries():
+    test_min_bound = 0
+
+    trigger = utils.create_air_temperature_metric_trigger(
+        trigger_upper_bound=False, power_on=False)
+
+    power_driver = reflection.load_driver(trigger.power_driver)
+
+    automata.trigger_bounds.append(
+        automata.TriggerBound(trigger, test_min_bound, power_driver))
+
+    metrics.load_latest_logs()
+    metrics.create_metric_log(trigger.metric, test_min_bound-1)
+
+    with patch.object(models.Metric, 'get_latest_log') as get_latest_log:
+        automata.bound_checker()
+        assert not get_latest_log.called
+
+    assert utils.MockPower.off_count == 1
+
+
+def _add_min_trigger_bound(bound: float) -> automata.TriggerBound:
+    trigger = utils.create_air_temperature_metric_trigger(
+        trigger_upper_bound=False, power_on=False)
+
+    tb = automata.TriggerBound(
+        trigger, bound, reflection.load_driver(trigger.power_driver))
+    automata.trigger_bounds.append(tb)
+
+    return tb
+
+
+@pytest.mark.usefixtures('test_env')
+def test_trigger_listener():
+    tb = _add_min_trigger_bound(0)
+
+    metrics.add_log_listener(automata.trigger_listener)
+    try:
+        metrics.create_metric_log(tb.trigger.metric, -1)
+        assert utils.MockPower.off_count == 1
+
+        # the bound checker does not act on the same log again
+        automata.bound_checker()
+        assert utils.MockPower.off_count == 1
+
+        metrics.create_metric_log(tb.trigger.metric, 1)
+        assert utils.MockPower.on_count == 1
+    finally:
+        metrics.remove_log_listener(automata.trigger_listener)
+
+
+@pytest.mark.usefixtures('test_env')
+def test_trigger_listener_other_process():
+    tb = _add_min_trigger_bound(0)
+
+    metrics.load_latest_logs()
+    metrics.add_log_listener(automata.trigger_listener)
+    try:
+        # inserted directly, like another process would
+        models.MetricLog.create(uuid=uuid4(), metric=tb.trigger.metric,
+                                value=-1)
+        assert utils.MockPower.off_count == 0
+
+        metrics.load_latest_logs()
+        assert utils.MockPower.off_count == 1
+    finally:
+        metrics.remove_log_listener(automata.trigger_listener)
+
+
+@pytest.mark.usefixtures('test_env')
+def test_trigger_listener_after_delete():
+    tb = _add_min_trigger_bound(0)
+
+    newest_log = models.MetricLog.create(uuid=uuid4(),
+                                         metric=tb.trigger.metric, value=1)
+
+    metrics.load_latest_logs()
+    metrics.add_log_listener(automata.trigger_listener)
+    try:
+        # the newest log deleted by another process, e.g. a purge
+        newest_log.delete_instance()
+
+        models.MetricLog.create(uuid=uuid4(), metric=tb.trigger.metric,
+                                value=-1)
+
+        metrics.load_latest_logs()
+        assert utils.MockPower.off_count == 1
+    finally:
+        metrics.remove_log_listener(automata.trigger_listener)
+
+
+@pytest.mark.usefixtures('test_env')
+def test_trigger_hysteresis():
+    tb = _add_min_trigger_bound(0)
+
+    with patch.object(settings, 'TRIGGER_HYSTERESIS', 2):
+        automata.check_trigger_bound(
+            tb, metrics.create_metric_log(tb.trigger.metric, -1))
+        assert utils.MockPower.off_count == 1
+
+        automata.check_trigger_bound(
+            tb, metrics.create_metric_log(tb.trigger.metric, 1))
+        assert utils.MockPower.on_count == 0
+
+        automata.check_trigger_bound(
+            tb, metrics.create_metric_log(tb.trigger.metric, 2))
+        assert utils.MockPower.on_count == 1
+
+
+@pytest.mark.usefixtures('test_env')
+def test_trigger_debounce():
+    tb = _add_min_trigger_bound(0)
+
+    with patch.object(settings, 'TRIGGER_DEBOUNCE', 2):
+        for value in (-1, 1, -1):
+            automata.check_trigger_bound(
+                tb, metrics.create_metric_log(tb.trigger.metric, value))
+        assert utils.MockPower.off_count == 0
+
+        automata.check_trigger_bound(
+            tb, metrics.create_metric_log(tb.trigger.metric, -1))
+        assert utils.MockPower.off_count == 1
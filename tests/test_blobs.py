@@ -0,0 +1,127 @@
+# pylint: disable=protected-access
+
+import hashlib
+import io
+import os
+import stat
+from unittest.mock import Mock, patch
+from uuid import uuid4
+
+import pytest
+
+from gardnr import blobs, cli, constants, metrics, models, settings, tasks
+
+
+def _create_image_metric():
+    return models.Metric.create(id=uuid4(), name='camera',
+                                topic=constants.LIGHT, type=constants.IMAGE)
+
+
+def _stored_files(tmpdir):
+    return sorted(path.relto(tmpdir) for path in tmpdir.visit()
+                  if path.isfile())
+
+
+@pytest.mark.usefixtures('test_env')
+def test_store(tmpdir):
+    contents = b'image'
+    digest = hashlib.sha256(contents).hexdigest()
+
+    with patch.object(settings, 'UPLOAD_PATH', str(tmpdir)):
+        blob = blobs.store(io.BytesIO(contents), '.jpg')
+
+    assert blob.hash == digest
+    assert blob.path == os.path.join(digest[:2], digest[2:4],
+                                     digest + '.jpg')
+    assert blob.size == len(contents)
+    assert blob.refs == 1
+    assert _stored_files(tmpdir) == [blob.path]
+    assert tmpdir.join(blob.path).read_binary() == contents
+    assert stat.S_IMODE(os.stat(str(tmpdir.join(blob.path))).st_mode) == \
+        0o666 & ~blobs._UMASK
+
+
+@pytest.mark.usefixtures('test_env')
+def test_store_deduplicated(tmpdir):
+    with patch.object(settings, 'UPLOAD_PATH', str(tmpdir)):
+        blob = blobs.store(io.BytesIO(b'image'), '.jpg')
+        same_blob = blobs.store(io.BytesIO(b'image'), '.png')
+
+    assert same_blob.id == blob.id
+    assert same_blob.path == blob.path
+    assert same_blob.refs == 2
+    assert _stored_files(tmpdir) == [blob.path]
+
+
+@pytest.mark.usefixtures('test_env')
+def test_store_failed(tmpdir):
+    file = io.BytesIO(b'image')
+    file.read = Mock(side_effect=OSError)
+
+    with patch.object(settings, 'UPLOAD_PATH', str(tmpdir)):
+        with pytest.raises(OSError):
+            blobs.store(file, '.jpg')
+
+    # the partial upload is removed
+    assert not tmpdir.listdir()
+    assert not models.Blob.select().count()
+
+
+@pytest.mark.usefixtures('test_env')
+def test_collect_garbage(tmpdir):
+    with patch.object(settings, 'UPLOAD_PATH', str(tmpdir)):
+        blob = blobs.store(io.BytesIO(b'image'), '.jpg')
+        blobs.store(io.BytesIO(b'image'), '.jpg')
+        other_blob = blobs.store(io.BytesIO(b'other'), '.jpg')
+
+        assert blobs.release([blob.path, other_blob.path, 'old.jpg']) == \
+            ['old.jpg']
+        assert blobs.collect_garbage() == 1
+
+    assert _stored_files(tmpdir) == [blob.path]
+    assert models.Blob.get_by_id(blob.id).refs == 1
+
+
+@pytest.mark.usefixtures('test_env')
+def test_purge_shared_blob(tmpdir):
+    metric = _create_image_metric()
+
+    with patch.object(settings, 'UPLOAD_PATH', str(tmpdir)):
+        old_log = metrics.create_file_log(metric, b'frame', '.jpg')
+        old_log.timestamp = old_log.timestamp.replace(year=2000)
+        old_log.save()
+        new_log = metrics.create_file_log(metric, b'frame', '.jpg')
+
+        with patch.object(settings, 'RETENTION_POLICIES',
+                          {(None, constants.IMAGE):
+                           {constants.RETENTION_RAW: 7}}):
+            tasks.purge()
+
+        # still referenced by the new log
+        assert tmpdir.join(new_log.path).exists()
+
+        new_log.timestamp = old_log.timestamp
+        new_log.save()
+
+        with patch.object(settings, 'RETENTION_POLICIES',
+                          {(None, constants.IMAGE):
+                           {constants.RETENTION_RAW: 7}}):
+            tasks.purge()
+
+    assert not _stored_files(tmpdir)
+    assert not models.Blob.select().count()
+
+
+@pytest.mark.usefixtures('test_env')
+def test_remove_metric_releases_blobs(tmpdir):
+    metric = _create_image_metric()
+
+    with patch.object(settings, 'UPLOAD_PATH', str(tmpdir)):
+        metrics.create_file_log(metric, b'frame', '.jpg')
+
+        _, args = cli.create_and_run_parser(['remove', 'metric',
+                                             metric.name])
+        args.func(args)
+        tasks.purge()
+
+    assert not _stored_files(tmpdir)
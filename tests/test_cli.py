@@ -1,10 +1,11 @@
 # pylint: disable=protected-access
 
 from unittest.mock import patch
+from uuid import uuid4
 
 import pytest
 
-from gardnr import cli, models, tasks, reflection
+from gardnr import cli, constants, models, tasks, reflection
 from tests import utils
 
 
@@ -68,7 +69,7 @@ def test_add_driver_with_multiple_config() -> None:
 
     log = models.MetricLog.select()[0]
 
-    assert log.value == b'1'
+    assert log.value == 1
     assert log.metric.name == 'foo'
 
 
@@ -173,6 +174,7 @@ def test_remove_metric() -> None:
 
     assert models.MetricLog.select().count() == 1
     assert models.ExportLog.select().count() == 1
+    assert models.MetricRollup.select().count() == 3
 
     _, args = cli.create_and_run_parser(['remove', 'metric', metric.name])
     args.func(args)
@@ -180,9 +182,40 @@ def test_remove_metric() -> None:
     assert models.Metric.select().count() == 0
     assert models.MetricLog.select().count() == 0
     assert models.ExportLog.select().count() == 0
+    assert models.MetricRollup.select().count() == 0
 
     #TODO: handle image metrics
 
+
+@pytest.mark.usefixtures('test_env')
+def test_remove_metric_keeps_watermark() -> None:
+
+    sensor = utils.create_and_load_air_temperature_sensor()
+    exporter = utils.create_and_load_exporter()
+    exporter.export_tracking = constants.EXPORT_WATERMARK
+
+    tasks.read([sensor])
+    tasks.write([exporter])
+
+    watermark1 = models.ExportWatermark.get()
+    assert watermark1.position > 0
+
+    _, args = cli.create_and_run_parser(
+        ['remove', 'metric', utils.TEST_METRIC])
+    args.func(args)
+
+    # the rowids of the removed logs are not reused, so new logs still come
+    # after the watermark
+    metric = utils.create_air_temperature_metric()
+    log = models.MetricLog.create(metric=metric, value=0)
+    assert log.id > watermark1.position
+
+    tasks.write([exporter])
+
+    watermark2 = models.ExportWatermark.get()
+    assert watermark2.position == log.id
+
+
 @pytest.mark.usefixtures('test_env')
 def test_remove_driver() -> None:
 
@@ -564,3 +597,14 @@ def test_power_off() -> None:
 
     assert len(called_power_devices) == 1
     assert called_power_devices[0].model.name == power_device.model.name
+
+
+@pytest.mark.usefixtures('test_env')
+def test_rollup_backfill() -> None:
+    metric = utils.create_air_temperature_metric()
+    models.MetricLog.create(uuid=uuid4(), metric=metric, value=1)
+
+    _, args = cli.create_and_run_parser(['rollup', 'backfill'])
+    args.func(args)
+
+    assert models.MetricRollup.select().count() == 3
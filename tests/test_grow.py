@@ -1,6 +1,11 @@
+import os
+from datetime import timedelta
+from unittest.mock import patch
+
 import pytest
 
-from gardnr import grow, models
+from gardnr import constants, grow, models, settings
+from tests import utils
 
 
 @pytest.mark.usefixtures('test_env')
@@ -63,3 +68,67 @@ def test_new_grow():
     assert models.Grow.select().count() == 2
 
     assert grow1.id != grow2.id
+
+
+@pytest.fixture
+def recipe_path(tmpdir):
+    path = str(tmpdir.join('recipe.xml'))
+    utils.write_recipe(path)
+
+    with patch.object(settings, 'GROW_RECIPE', path):
+        yield path
+
+
+@pytest.mark.usefixtures('test_env')
+def test_compiled_recipe_timeline(recipe_path):
+    recipe = grow.get_compiled_recipe()
+
+    assert recipe.get_stage(0) == constants.GERMINATION
+    assert recipe.get_stage(3600) == constants.VEGETATIVE
+    assert recipe.get_stage(3600 + 7200) is None
+
+    germination_bound = recipe.get_metric_bound(constants.AIR,
+                                                constants.T9E, 0)
+    assert (germination_bound.min, germination_bound.max) == (20, 25)
+
+    # falls back on the default stage
+    vegetative_bound = recipe.get_metric_bound(constants.AIR,
+                                               constants.T9E, 3600)
+    assert (vegetative_bound.min, vegetative_bound.max) == (16, 18)
+
+    assert recipe.get_metric_bound(constants.WATER, constants.PH, 0) is None
+    assert recipe.get_metric_bound(constants.WATER, constants.PH, 3600).min\
+        == 5.5
+
+    assert recipe.get_next_stage_start(10) == 3600
+    assert recipe.get_next_stage_start(3600 + 7200) is None
+
+
+@pytest.mark.usefixtures('test_env')
+def test_compiled_recipe_cached_by_mtime(recipe_path):
+    recipe = grow.get_compiled_recipe()
+    assert grow.get_compiled_recipe() is recipe
+
+    utils.write_recipe(recipe_path, germination_max=30)
+    stat = os.stat(recipe_path)
+    os.utime(recipe_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    recompiled_recipe = grow.get_compiled_recipe()
+    assert recompiled_recipe is not recipe
+    assert recompiled_recipe.get_metric_bound(constants.AIR, constants.T9E,
+                                              0).max == 30
+
+
+@pytest.mark.usefixtures('test_env')
+def test_grow_stage(recipe_path):
+    grow.start()
+    active_grow = grow.get_active()
+
+    assert grow.get_current_stage(active_grow) == constants.GERMINATION
+    assert grow.get_current_stage(
+        active_grow,
+        active_grow.start + timedelta(hours=2)
+    ) == constants.VEGETATIVE
+
+    assert grow.get_next_stage_change(active_grow) == \
+        active_grow.start + timedelta(hours=1)
@@ -0,0 +1,340 @@
+import io
+import os
+import time
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from uuid import uuid4
+
+import pytest
+
+from gardnr import blobs, constants, metrics, models, settings
+from tests import utils
+
+
+@pytest.mark.usefixtures('test_env')
+def test_create_metric_log_by_metric():
+    metric = utils.create_air_temperature_metric()
+
+    log1 = metrics.create_metric_log(metric, 1)
+    log2 = metrics.create_metric_log(metric.id, 2)
+
+    assert log1.metric.id == metric.id
+    assert models.MetricLog.get(models.MetricLog.id == log2.id)\
+        .metric.id == metric.id
+
+
+@pytest.mark.usefixtures('test_env')
+def test_find_metric_cached():
+    metric = utils.create_air_temperature_metric()
+
+    assert metrics.find_metric(metric.name).id == metric.id
+
+    with patch.object(models.Metric, 'get_or_none') as get_or_none:
+        metrics.create_metric_log(metric.name, 0)
+        assert not get_or_none.called
+
+
+@pytest.mark.usefixtures('test_env')
+def test_find_metric_renamed():
+    metric = utils.create_air_temperature_metric()
+
+    assert metrics.find_metric(metric.name)
+
+    old_name = metric.name
+    metric.name = 'renamed'
+    metric.save()
+
+    assert not metrics.find_metric(old_name)
+    assert metrics.find_metric('renamed').id == metric.id
+
+
+@pytest.mark.usefixtures('test_env')
+def test_find_metric_changed_by_other_process():
+    metric = utils.create_air_temperature_metric()
+
+    assert metrics.find_metric(metric.name)
+
+    # another process removing the metric only bumps the revision in the DB
+    models.Metric.delete().execute()
+    models.Revision.update(revision=models.Revision.revision + 1)\
+        .execute()
+
+    assert metrics.find_metric(metric.name)
+
+    with patch.object(settings, 'METRIC_CACHE_CHECK_INTERVAL', 0):
+        assert not metrics.find_metric(metric.name)
+
+
+@pytest.fixture
+def log_buffer_settings():
+    with patch.object(settings, 'METRIC_LOG_BUFFER_SIZE', 2), \
+            patch.object(settings, 'METRIC_LOG_BUFFER_INTERVAL', 60):
+        yield
+
+        metrics.close_log_buffer()
+
+
+@pytest.mark.usefixtures('test_env', 'log_buffer_settings')
+def test_log_buffer_size():
+    metric = utils.create_air_temperature_metric()
+
+    log = metrics.create_metric_log(metric, 0)
+    assert models.MetricLog.select().count() == 0
+
+    metrics.create_metric_log(metric, 1)
+    assert models.MetricLog.select().count() == 2
+
+    # the log only gets its id once inserted
+    assert log.id is None
+    assert models.MetricLog.get(models.MetricLog.uuid == log.uuid).value == 0
+
+
+@pytest.mark.usefixtures('test_env', 'log_buffer_settings')
+def test_log_buffer_close():
+    metric = utils.create_air_temperature_metric()
+
+    metrics.create_metric_log(metric, 0)
+    assert models.MetricLog.select().count() == 0
+
+    metrics.close_log_buffer()
+    assert models.MetricLog.select().count() == 1
+
+
+@pytest.mark.usefixtures('test_env', 'log_buffer_settings')
+@patch.object(settings, 'METRIC_LOG_BUFFER_LIMIT', 3)
+def test_log_buffer_insert_failing():
+    metric = utils.create_air_temperature_metric()
+
+    with patch('gardnr.metrics._insert_rows', side_effect=RuntimeError):
+        # buffered, so not raised even though inserting them fails
+        for value in range(5):
+            metrics.create_metric_log(metric, value)
+
+    metrics.close_log_buffer()
+
+    # only the newest logs up to the limit are kept
+    values = [log.value for log in
+              models.MetricLog.select().order_by(models.MetricLog.id)]
+    assert values == [2, 3, 4]
+
+
+@pytest.mark.usefixtures('test_env', 'log_buffer_settings')
+def test_log_buffer_file_and_numeric_logs(tmpdir):
+    metric = utils.create_air_temperature_metric()
+    image_metric = models.Metric.create(id=uuid4(), name='camera',
+                                        topic=constants.AIR,
+                                        type=constants.IMAGE)
+
+    with patch.object(settings, 'UPLOAD_PATH', str(tmpdir)):
+        # the file log first, its row has to hold every column too
+        file_log = metrics.create_file_log(image_metric, b'image', '.jpg')
+        metrics.create_metric_log(metric, 1)
+
+    logs = models.MetricLog.select(models.MetricLog.number,
+                                   models.MetricLog.path)\
+        .order_by(models.MetricLog.id).tuples()
+
+    assert list(logs) == [(None, file_log.path), (1, None)]
+    assert metrics.get_rollups(metric, constants.ROLLUP_MINUTE)[0].count == 1
+
+
+@pytest.mark.usefixtures('test_env', 'file_db', 'log_buffer_settings')
+@patch.object(settings, 'METRIC_LOG_BUFFER_INTERVAL', 0.01)
+def test_log_buffer_interval():
+    metric = utils.create_air_temperature_metric()
+
+    metrics.create_metric_log(metric, 0)
+
+    for _ in range(100):
+        if models.MetricLog.select().count() == 1:
+            break
+        time.sleep(0.01)
+
+    assert models.MetricLog.select().count() == 1
+
+
+@pytest.mark.usefixtures('test_env')
+def test_get_latest_log():
+    metric = utils.create_air_temperature_metric()
+
+    metrics.load_latest_logs()
+    assert not metrics.get_latest_log(metric.id)
+
+    log = metrics.create_metric_log(metric, 0)
+    assert metrics.get_latest_log(metric.id).id == log.id
+
+    # created by another process
+    other_log = models.MetricLog.create(uuid=uuid4(), metric=metric, value=1)
+    assert metrics.get_latest_log(metric.id).id == log.id
+
+    metrics.load_latest_logs()
+    assert metrics.get_latest_log(metric.id).id == other_log.id
+
+
+@pytest.mark.usefixtures('test_env')
+def test_load_latest_logs():
+    metric = utils.create_air_temperature_metric()
+
+    log = models.MetricLog.create(uuid=uuid4(),
+                                  timestamp=datetime(1988, 5, 5),
+                                  metric=metric,
+                                  value=0)
+    models.MetricLog.create(uuid=uuid4(),
+                            timestamp=datetime(1970, 1, 1),
+                            metric=metric,
+                            value=0)
+
+    metrics.load_latest_logs()
+
+    assert metrics.get_latest_log(metric.id).id == log.id
+    assert not metrics.get_latest_log(metric.id, timedelta(minutes=1))
+
+
+@pytest.mark.usefixtures('test_env')
+def test_load_latest_logs_after_delete():
+    metric = utils.create_air_temperature_metric()
+    other_metric = models.Metric.create(id=uuid4(),
+                                        name='test-humidity',
+                                        topic=constants.AIR,
+                                        type=constants.HUMIDITY)
+
+    models.MetricLog.create(uuid=uuid4(), metric=metric, value=0)
+    models.MetricLog.create(uuid=uuid4(), metric=other_metric, value=0)
+
+    metrics.load_latest_logs()
+
+    # the newest logs deleted by another process, e.g. by removing a metric
+    models.MetricLog.delete()\
+        .where(models.MetricLog.metric == other_metric)\
+        .execute()
+
+    log = models.MetricLog.create(uuid=uuid4(), metric=metric, value=1)
+
+    metrics.load_latest_logs()
+    assert metrics.get_latest_log(metric.id).id == log.id
+
+
+@pytest.mark.usefixtures('test_env')
+def test_rollups():
+    metric = utils.create_air_temperature_metric()
+
+    timestamp = datetime(2019, 1, 1, 12, 30, 10)
+    for seconds, value in ((0, 2), (20, 6), (90, 1)):
+        log = models.MetricLog(uuid=uuid4(), metric=metric, value=value,
+                               timestamp=timestamp + timedelta(
+                                   seconds=seconds))
+        metrics._save_log(log)
+
+    # not numeric
+    metrics.create_metric_log(metric, 'note')
+
+    minutes = list(metrics.get_rollups(metric, constants.ROLLUP_MINUTE,
+                                       end=datetime(2019, 1, 2)))
+    assert [(rollup.count, rollup.min, rollup.max, rollup.last)
+            for rollup in minutes] == [(2, 2, 6, 6), (1, 1, 1, 1)]
+    assert minutes[0].bucket == datetime(2019, 1, 1, 12, 30)
+
+    hour = metrics.get_rollups(metric, constants.ROLLUP_HOUR).get()
+    assert hour.bucket == datetime(2019, 1, 1, 12)
+    assert (hour.count, hour.mean, hour.last) == (3, 3, 1)
+
+    day = metrics.get_rollups(metric, constants.ROLLUP_DAY).get()
+    assert day.bucket == datetime(2019, 1, 1)
+    assert day.count == 3
+
+
+@pytest.mark.usefixtures('test_env')
+def test_rollups_out_of_order():
+    metric = utils.create_air_temperature_metric()
+
+    timestamp = datetime(2019, 1, 1)
+    metrics.update_rollups([(metric.id, timestamp + timedelta(seconds=1), 5)])
+    metrics.update_rollups([(metric.id, timestamp, 7)])
+
+    rollup = metrics.get_rollups(metric, constants.ROLLUP_MINUTE).get()
+    assert (rollup.count, rollup.min, rollup.max, rollup.last) == \
+        (2, 5, 7, 5)
+
+
+@pytest.mark.usefixtures('test_env')
+def test_backfill_rollups():
+    metric = utils.create_air_temperature_metric()
+
+    for value in range(5):
+        models.MetricLog.create(uuid=uuid4(), metric=metric, value=value)
+
+    assert not models.MetricRollup.select().exists()
+
+    metrics.backfill_rollups(batch_size=2)
+    day = metrics.get_rollups(metric, constants.ROLLUP_DAY).get()
+    assert (day.count, day.total, day.last) == (5, 10, 4)
+
+    # rebuilt instead of added to
+    metrics.backfill_rollups()
+    day = metrics.get_rollups(metric, constants.ROLLUP_DAY).get()
+    assert day.count == 5
+
+
+@pytest.mark.usefixtures('test_env')
+def test_buffered_logs_rolled_up():
+    metric = utils.create_air_temperature_metric()
+
+    with patch.object(settings, 'METRIC_LOG_BUFFER_SIZE', 10):
+        try:
+            metrics.create_metric_log(metric, 1)
+            assert not models.MetricRollup.select().exists()
+        finally:
+            metrics.close_log_buffer()
+
+    assert metrics.get_rollups(metric, constants.ROLLUP_HOUR).get().count == 1
+
+
+@pytest.mark.usefixtures('test_env')
+def test_typed_values():
+    metric = utils.create_air_temperature_metric()
+    notes = models.Metric.create(id=uuid4(), name='test-notes',
+                                 topic=constants.AIR, type=constants.NOTES)
+
+    # e.g. a MQTT payload
+    log = metrics.create_metric_log(metric, b'21.5')
+    log = models.MetricLog.get(models.MetricLog.id == log.id)
+    assert (log.number, log.text, log.value) == (21.5, None, 21.5)
+
+    log = metrics.create_metric_log(notes, b'10')
+    log = models.MetricLog.get(models.MetricLog.id == log.id)
+    assert (log.number, log.text) == (None, '10')
+
+    # not a number, kept as text
+    log = metrics.create_metric_log(metric, 'n/a')
+    assert (log.number, log.text) == (None, 'n/a')
+
+    assert models.MetricLog.select()\
+        .where(models.MetricLog.number > 20).count() == 1
+
+
+@pytest.mark.usefixtures('test_env')
+def test_create_metric_logs():
+    metric = utils.create_air_temperature_metric()
+    timestamp = datetime.utcnow() - timedelta(minutes=1)
+
+    logs = metrics.create_metric_logs([(metric, 1, timestamp),
+                                       (metric.name, 2, None)])
+
+    assert [log.value for log in logs] == [1, 2]
+    assert models.MetricLog.select().count() == 2
+    assert models.MetricLog.get(models.MetricLog.uuid == logs[0].uuid)\
+        .timestamp == timestamp
+    assert metric.get_latest_log().uuid == logs[1].uuid
+
+
+@pytest.mark.usefixtures('test_env')
+def test_create_file_log_from_file(tmpdir):
+    metric = models.Metric.create(id=uuid4(), name='camera',
+                                  topic=constants.AIR, type=constants.IMAGE)
+    blob = os.urandom(blobs.CHUNK_SIZE * 2 + 1)
+
+    with patch.object(settings, 'UPLOAD_PATH', str(tmpdir)):
+        log = metrics.create_file_log(metric, io.BytesIO(blob), '.jpg')
+
+    assert log.path.endswith('.jpg')
+    assert tmpdir.join(log.path).read_binary() == blob
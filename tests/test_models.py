@@ -1,9 +1,10 @@
 from datetime import datetime, timedelta
+from unittest.mock import patch
 from uuid import uuid4
 
 import pytest
 
-from gardnr import models
+from gardnr import constants, models, settings
 from tests import utils
 
 
@@ -14,12 +15,12 @@ def test_get_latest_log():
     assert not metric.get_latest_log()
     assert not metric.get_latest_log(timedelta(minutes=1))
 
-    models.MetricLog.create(id=uuid4(),
+    models.MetricLog.create(uuid=uuid4(),
                             timestamp=datetime(1970, 1, 1),
                             metric=metric,
                             value=0)
 
-    log = models.MetricLog.create(id=uuid4(),
+    log = models.MetricLog.create(uuid=uuid4(),
                                   timestamp=datetime(1988, 5, 5),
                                   metric=metric,
                                   value=0)
@@ -29,3 +30,207 @@ def test_get_latest_log():
     assert latest_log1.id == log.id
 
     assert not metric.get_latest_log(timedelta(minutes=1))
+
+
+@pytest.mark.usefixtures('test_env', 'file_db')
+def test_db_profile():
+    # pylint: disable=protected-access
+    database = models.BaseModel._meta.database
+
+    journal_mode = database.execute_sql('PRAGMA journal_mode').fetchone()
+    assert journal_mode[0] == 'wal'
+
+    busy_timeout = database.execute_sql('PRAGMA busy_timeout').fetchone()
+    assert busy_timeout[0] == 5000
+
+
+@pytest.mark.usefixtures('test_env', 'file_db')
+def test_db_profile_safe_after_wal():
+    # pylint: disable=protected-access
+    database = models.BaseModel._meta.database
+
+    # the database was created in WAL mode by the balanced profile
+    with patch.object(settings, 'DB_PROFILE', 'safe'):
+        models.initialize_db()
+
+    journal_mode = database.execute_sql('PRAGMA journal_mode').fetchone()
+    assert journal_mode[0] == 'delete'
+
+    synchronous = database.execute_sql('PRAGMA synchronous').fetchone()
+    # FULL
+    assert synchronous[0] == 2
+
+
+@pytest.mark.usefixtures('test_env')
+def test_get_latest_log_indexed():
+    metric = utils.create_air_temperature_metric()
+
+    # pylint: disable=protected-access
+    database = models.BaseModel._meta.database
+
+    for cutoff in (None, timedelta(minutes=1)):
+        sql, params = metric.select_latest_log(cutoff).sql()
+
+        query_plan = database.execute_sql('EXPLAIN QUERY PLAN ' + sql,
+                                          params).fetchall()
+
+        # a single search of the index, without sorting
+        assert len(query_plan) == 1
+        assert 'metriclog_metric_id_timestamp' in query_plan[0][-1]
+
+
+@pytest.mark.usefixtures('test_env', 'file_db')
+def test_migrate_metric_log_index():
+    # pylint: disable=protected-access
+    database = models.BaseModel._meta.database
+
+    # as created by older versions
+    database.execute_sql('DROP INDEX metriclog_metric_id_timestamp')
+    database.execute_sql('CREATE INDEX metriclog_metric_id '
+                         'ON metriclog (metric_id)')
+
+    models.initialize_db()
+
+    indexes = {index.name for index in database.get_indexes('metriclog')}
+    assert 'metriclog_metric_id_timestamp' in indexes
+    assert 'metriclog_metric_id' not in indexes
+
+
+@pytest.mark.usefixtures('test_env', 'file_db')
+def test_migrate_metric_log_values():
+    # pylint: disable=protected-access
+    database = models.BaseModel._meta.database
+
+    metric = utils.create_air_temperature_metric()
+    notes = models.Metric.create(id=uuid4(), name='test-notes',
+                                 topic=constants.AIR, type=constants.NOTES)
+
+    # as created by older versions
+    database.execute_sql('DROP TABLE metriclog')
+    database.execute_sql(
+        'CREATE TABLE metriclog (id VARCHAR(40) NOT NULL PRIMARY KEY, '
+        'timestamp DATETIME NOT NULL, longitude REAL, latitude REAL, '
+        'elevation REAL, value BLOB NOT NULL, metric_id VARCHAR(40) NOT NULL)')
+
+    # with gaps in the rowids, as left by deleted logs
+    for rowid, log_metric, value in ((1, metric, b'21.5'), (5, metric, 3),
+                                     (9, notes, b'watered')):
+        database.execute_sql(
+            'INSERT INTO metriclog (rowid, id, timestamp, value, metric_id) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (rowid, uuid4().hex, datetime.utcnow(), value,
+             log_metric.id.hex))
+
+    models.initialize_db()
+
+    columns = {column.name for column in database.get_columns('metriclog')}
+    assert 'value' not in columns
+
+    # every log keeps its rowid, which watermarks point at
+    logs = models.MetricLog.select().order_by(models.METRIC_LOG_ROWID)
+    assert [(log.id, log.number, log.text) for log in logs] == \
+        [(1, 21.5, None), (5, 3, None), (9, None, 'watered')]
+
+
+@pytest.mark.usefixtures('test_env', 'file_db')
+def test_migrate_metric_log_keys():
+    # pylint: disable=protected-access
+    database = models.BaseModel._meta.database
+
+    metric = utils.create_air_temperature_metric()
+    exporter = utils.create_exporter()
+
+    # as created by older versions
+    database.execute_sql('DROP TABLE exportlog')
+    database.execute_sql('DROP TABLE metriclog')
+    database.execute_sql(
+        'CREATE TABLE metriclog (id VARCHAR(40) NOT NULL PRIMARY KEY, '
+        'timestamp DATETIME NOT NULL, longitude REAL, latitude REAL, '
+        'elevation REAL, number REAL, text TEXT, path TEXT, '
+        'metric_id VARCHAR(40) NOT NULL)')
+    database.execute_sql(
+        'CREATE TABLE exportlog (id INTEGER NOT NULL PRIMARY KEY, '
+        'metric_log_id VARCHAR(40) NOT NULL, driver_id INTEGER NOT NULL)')
+    database.execute_sql('CREATE INDEX exportlog_metric_log_id '
+                         'ON exportlog (metric_log_id)')
+
+    log_uuids = [uuid4(), uuid4()]
+    for number, log_uuid in enumerate(log_uuids):
+        database.execute_sql(
+            'INSERT INTO metriclog (id, timestamp, number, metric_id) '
+            'VALUES (?, ?, ?, ?)',
+            (log_uuid.hex, datetime.utcnow(), number, metric.id.hex))
+
+    database.execute_sql(
+        'INSERT INTO exportlog (metric_log_id, driver_id) VALUES (?, ?)',
+        (log_uuids[1].hex, exporter.id))
+
+    models.initialize_db()
+
+    logs = list(models.MetricLog.select().order_by(models.MetricLog.id))
+    assert [(log.id, log.uuid, log.number) for log in logs] == \
+        [(1, log_uuids[0], 0), (2, log_uuids[1], 1)]
+
+    assert models.ExportLog.get().metric_log.uuid == log_uuids[1]
+
+
+@pytest.mark.usefixtures('test_env', 'file_db')
+def test_migrate_metric_log_autoincrement():
+    # pylint: disable=protected-access
+    database = models.BaseModel._meta.database
+
+    metric = utils.create_air_temperature_metric()
+    exporter = utils.create_exporter()
+
+    # as created by older versions, keyed by an integer without
+    # AUTOINCREMENT
+    database.execute_sql('DROP TABLE exportlog')
+    database.execute_sql('DROP TABLE metriclog')
+    database.execute_sql(
+        'CREATE TABLE metriclog (id INTEGER NOT NULL PRIMARY KEY, '
+        'uuid VARCHAR(40) NOT NULL, timestamp DATETIME NOT NULL, '
+        'longitude REAL, latitude REAL, elevation REAL, number REAL, '
+        'text TEXT, path TEXT, metric_id VARCHAR(40) NOT NULL)')
+    database.execute_sql(
+        'CREATE TABLE exportlog (id INTEGER NOT NULL PRIMARY KEY, '
+        'metric_log_id INTEGER NOT NULL, driver_id INTEGER NOT NULL)')
+
+    log_uuids = [uuid4(), uuid4()]
+    for rowid, log_uuid in zip((3, 7), log_uuids):
+        database.execute_sql(
+            'INSERT INTO metriclog (id, uuid, timestamp, number, metric_id) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (rowid, log_uuid.hex, datetime.utcnow(), rowid, metric.id.hex))
+
+    database.execute_sql(
+        'INSERT INTO exportlog (metric_log_id, driver_id) VALUES (?, ?)',
+        (7, exporter.id))
+
+    models.initialize_db()
+
+    logs = list(models.MetricLog.select().order_by(models.MetricLog.id))
+    assert [(log.id, log.uuid) for log in logs] == \
+        [(3, log_uuids[0]), (7, log_uuids[1])]
+    assert models.ExportLog.get().metric_log.uuid == log_uuids[1]
+
+    # the rowid of the deleted newest log is not reused
+    models.ExportLog.delete().execute()
+    logs[1].delete_instance()
+    log = models.MetricLog.create(metric=metric, value=0)
+    assert log.id == 8
+
+
+@pytest.mark.usefixtures('test_env')
+def test_metric_log_ids_not_reused():
+    metric = utils.create_air_temperature_metric()
+
+    logs = [models.MetricLog.create(metric=metric, value=value)
+            for value in range(3)]
+
+    # the newest logs, e.g. purged or of a removed metric
+    models.MetricLog.delete()\
+        .where(models.MetricLog.id >= logs[1].id)\
+        .execute()
+
+    log = models.MetricLog.create(metric=metric, value=3)
+    assert log.id == logs[2].id + 1
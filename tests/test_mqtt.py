@@ -0,0 +1,275 @@
+import json
+import struct
+from datetime import datetime
+from types import SimpleNamespace
+from unittest.mock import patch
+from uuid import uuid4
+
+import pytest
+
+from gardnr import constants, models, mqtt, settings
+from tests import utils
+
+
+class MockClient:
+    """Stands in for the paho client, records subscriptions"""
+
+    def __init__(self):
+        self.topics = set()
+
+    def subscribe(self, topics):
+        self.topics.update(topic for topic, _ in topics)
+
+    def unsubscribe(self, topics):
+        self.topics.difference_update(topics)
+
+
+def _message(topic, payload):
+    return SimpleNamespace(topic=topic, payload=payload)
+
+
+@pytest.mark.usefixtures('test_env')
+def test_consumer_subscribes_to_enabled_metrics():
+    metric = utils.create_air_temperature_metric()
+    models.Metric.create(id=uuid4(), name='disabled', topic=constants.AIR,
+                         type=constants.HUMIDITY, disabled=True)
+
+    consumer = mqtt.MQTTConsumer(10, 10, 0)
+    consumer.load_metrics()
+
+    client = MockClient()
+    consumer.on_connect(client, None, {}, 0)
+
+    assert client.topics == {metric.name}
+
+
+@pytest.mark.usefixtures('test_env')
+def test_consumer_updates_subscriptions():
+    metric = utils.create_air_temperature_metric()
+
+    consumer = mqtt.MQTTConsumer(10, 10, 0)
+    consumer.load_metrics()
+
+    client = MockClient()
+    consumer.on_connect(client, None, {}, 0)
+
+    other_metric = models.Metric.create(id=uuid4(), name='other',
+                                        topic=constants.AIR,
+                                        type=constants.HUMIDITY)
+    consumer.load_metrics()
+    assert client.topics == {metric.name, other_metric.name}
+
+    metric.disabled = True
+    metric.save()
+    consumer.load_metrics()
+    assert client.topics == {other_metric.name}
+
+
+@pytest.mark.usefixtures('test_env')
+def test_consumer_not_connected():
+    utils.create_air_temperature_metric()
+
+    consumer = mqtt.MQTTConsumer(10, 10, 0)
+    consumer.load_metrics()
+
+    client = MockClient()
+    consumer.on_connect(client, None, {}, 5)
+
+    assert not client.topics
+
+
+@pytest.mark.usefixtures('test_env')
+def test_consumer_writes_batches():
+    metric = utils.create_air_temperature_metric()
+
+    consumer = mqtt.MQTTConsumer(10, 2, 0)
+    consumer.load_metrics()
+
+    for value in (b'1', b'2', b'3'):
+        consumer.on_message(MockClient(), None,
+                            _message(metric.name, value))
+
+    assert not models.MetricLog.select().count()
+
+    assert consumer.write_batch(0) == 2
+    assert consumer.write_batch(0) == 1
+    assert not consumer.write_batch(0)
+
+    values = [log.value for log in
+              models.MetricLog.select().order_by(models.MetricLog.id)]
+    assert values == [1, 2, 3]
+
+    stats = consumer.get_stats()
+    assert stats['received'] == 3
+    assert stats['written'] == 3
+    assert stats['queue_depth'] == 0
+
+
+@pytest.mark.usefixtures('test_env')
+def test_consumer_failed_batch():
+    metric = utils.create_air_temperature_metric()
+
+    consumer = mqtt.MQTTConsumer(10, 10, 0)
+    consumer.load_metrics()
+
+    for payload in (b'1', b'2', b'one'):
+        consumer.on_message(MockClient(), None, _message(metric.name,
+                                                         payload))
+
+    with patch('gardnr.metrics.create_metric_logs',
+               side_effect=RuntimeError), \
+            pytest.raises(RuntimeError):
+        consumer.write_batch(0)
+
+    assert not models.MetricLog.select().count()
+
+    stats = consumer.get_stats()
+    assert stats['invalid'] == 1
+    assert stats['failed'] == 2
+    assert stats['written'] == 0
+    assert stats['queue_depth'] == 0
+
+
+@pytest.mark.usefixtures('test_env')
+def test_consumer_unknown_metric():
+    consumer = mqtt.MQTTConsumer(10, 10, 0)
+    consumer.load_metrics()
+
+    for _ in range(3):
+        consumer.on_message(MockClient(), None, _message('unknown', b'1'))
+
+    assert consumer.get_stats()['unknown'] == 3
+    assert not consumer.write_batch(0)
+
+    assert consumer.pop_unknown_topics() == {'unknown': 3}
+    assert not consumer.pop_unknown_topics()
+
+
+@pytest.mark.usefixtures('test_env')
+def test_consumer_drops_when_full():
+    metric = utils.create_air_temperature_metric()
+
+    consumer = mqtt.MQTTConsumer(2, 10, 0)
+    consumer.load_metrics()
+
+    for _ in range(3):
+        consumer.on_message(MockClient(), None, _message(metric.name, b'1'))
+
+    stats = consumer.get_stats()
+    assert stats['dropped'] == 1
+    assert stats['queue_depth'] == 2
+
+
+@pytest.mark.usefixtures('test_env')
+def test_consumer_reloads_changed_metrics():
+    consumer = mqtt.MQTTConsumer(10, 10, 0)
+    consumer.load_metrics()
+
+    metric = utils.create_air_temperature_metric()
+    consumer.on_message(MockClient(), None, _message(metric.name, b'1'))
+    assert consumer.get_stats()['unknown'] == 1
+
+    consumer.load_metrics()
+    consumer.on_message(MockClient(), None, _message(metric.name, b'1'))
+    assert consumer.get_stats()['queue_depth'] == 1
+
+
+@pytest.mark.usefixtures('test_env', 'file_db')
+def test_consumer_stop_writes_queued():
+    metric = utils.create_air_temperature_metric()
+
+    # never fills up a batch on its own
+    consumer = mqtt.MQTTConsumer(10, 10, 60)
+    consumer.start()
+
+    for _ in range(3):
+        consumer.on_message(MockClient(), None, _message(metric.name, b'1'))
+
+    consumer.stop()
+
+    assert models.MetricLog.select().count() == 3
+
+
+def test_decode_payload_number():
+    assert mqtt.decode_payload(b'21.5') == (21.5, None)
+    assert mqtt.decode_payload(b' 3 ') == (3.0, None)
+
+
+def test_decode_payload_json():
+    payload = json.dumps({'value': 21.5, 'timestamp': 0}).encode()
+
+    assert mqtt.decode_payload(payload) == (21.5, datetime(1970, 1, 1))
+    assert mqtt.decode_payload(b'{"value": "1"}') == (1.0, None)
+
+    with pytest.raises(ValueError):
+        mqtt.decode_payload(b'{"timestamp": 0}')
+    with pytest.raises(ValueError):
+        mqtt.decode_payload(b'{"value": [1]}')
+    with pytest.raises(ValueError):
+        mqtt.decode_payload(b'{"value": 1')
+
+
+def test_decode_payload_binary():
+    assert mqtt.decode_payload(mqtt.BINARY_MARKER +
+                               struct.pack('<d', 21.5)) == (21.5, None)
+    assert mqtt.decode_payload(mqtt.BINARY_MARKER +
+                               struct.pack('<dd', 21.5, 0)) == \
+        (21.5, datetime(1970, 1, 1))
+
+    with pytest.raises(ValueError):
+        mqtt.decode_payload(mqtt.BINARY_MARKER + b'\x01')
+
+
+def test_decode_payload_text():
+    assert mqtt.decode_payload(b'watered', numeric=False) == \
+        ('watered', None)
+    assert mqtt.decode_payload(b'10', numeric=False) == ('10', None)
+    assert mqtt.decode_payload(b'{"value": "watered"}', numeric=False) == \
+        ('watered', None)
+
+
+@pytest.mark.usefixtures('test_env')
+def test_decode_messages():
+    temperature = utils.create_air_temperature_metric()
+    humidity = models.Metric.create(id=uuid4(), name='humidity',
+                                    topic=constants.AIR,
+                                    type=constants.HUMIDITY)
+    notes = models.Metric.create(id=uuid4(), name='notes',
+                                 topic=constants.AIR,
+                                 type=constants.NOTES)
+    received = datetime.utcnow()
+
+    with patch.object(settings, 'TEMPERATURE_UNIT', constants.FAHRENHEIT):
+        entries, invalid = mqtt.decode_messages([
+            (temperature, b'212', received),
+            (humidity, b'0.5', received),
+            # out of range
+            (humidity, b'50', received),
+            (temperature, b'nan', received),
+            (temperature, b'hot', received),
+            (notes, b'10', received),
+        ])
+
+    assert invalid == 3
+    assert [(metric.id, value) for metric, value, _ in entries] == [
+        (temperature.id, 100), (humidity.id, 0.5), (notes.id, '10')]
+    assert all(timestamp == received for _, _, timestamp in entries)
+
+
+@pytest.mark.usefixtures('test_env')
+def test_consumer_drops_invalid():
+    metric = utils.create_air_temperature_metric()
+
+    consumer = mqtt.MQTTConsumer(10, 10, 0)
+    consumer.load_metrics()
+
+    for payload in (b'1', b'one', b'{"value": 2, "timestamp": 0}'):
+        consumer.on_message(MockClient(), None, _message(metric.name,
+                                                         payload))
+
+    assert consumer.write_batch(0) == 3
+
+    logs = list(models.MetricLog.select().order_by(models.MetricLog.id))
+    assert [log.number for log in logs] == [1, 2]
+    assert logs[1].timestamp == datetime(1970, 1, 1)
+    assert consumer.get_stats()['invalid'] == 1
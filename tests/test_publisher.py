@@ -0,0 +1,99 @@
+import json
+from uuid import uuid4
+
+import pytest
+
+from gardnr import metrics, models
+from gardnr.publisher import LogPublisher
+from tests import utils
+
+
+def _data(event):
+    assert event.startswith('data: ')
+    return json.loads(event[len('data: '):])
+
+
+@pytest.fixture
+def publisher():
+    publisher = LogPublisher(2, 0.01)
+    yield publisher
+    publisher.stop()
+
+
+@pytest.mark.usefixtures('test_env', 'file_db')
+def test_publish_created_logs(publisher):
+    metric = utils.create_air_temperature_metric()
+    subscription = publisher.subscribe()
+
+    metrics.create_metric_log(metric, 1)
+
+    assert _data(subscription.get(5)) == {
+        'metric': metric.name,
+        'timestamp': metric.get_latest_log().timestamp.isoformat(),
+        'value': 1,
+    }
+
+
+@pytest.mark.usefixtures('test_env', 'file_db')
+def test_publish_logs_of_other_processes(publisher):
+    metric = utils.create_air_temperature_metric()
+    metrics.load_latest_logs()
+
+    subscription = publisher.subscribe()
+
+    # inserted directly, like another process would
+    models.MetricLog.create(uuid=uuid4(), metric=metric, number=2)
+
+    assert _data(subscription.get(5))['value'] == 2
+
+
+@pytest.mark.usefixtures('test_env', 'file_db')
+def test_publish_logs_after_delete(publisher):
+    metric = utils.create_air_temperature_metric()
+    models.MetricLog.create(uuid=uuid4(), metric=metric, number=1)
+    newest_log = models.MetricLog.create(uuid=uuid4(), metric=metric,
+                                         number=2)
+    metrics.load_latest_logs()
+
+    subscription = publisher.subscribe()
+
+    # the newest log deleted and a new one inserted by other processes
+    newest_log.delete_instance()
+    models.MetricLog.create(uuid=uuid4(), metric=metric, number=3)
+
+    assert _data(subscription.get(5))['value'] == 3
+    assert subscription.get(0) is None
+
+
+@pytest.mark.usefixtures('test_env', 'file_db')
+def test_publish_filtered_by_metric(publisher):
+    metric = utils.create_air_temperature_metric()
+    other_metric = models.Metric.create(id=uuid4(), name='other',
+                                        topic=metric.topic,
+                                        type=metric.type)
+
+    subscription = publisher.subscribe({other_metric.id})
+
+    metrics.create_metric_log(metric, 1)
+    metrics.create_metric_log(other_metric, 2)
+
+    assert _data(subscription.get(5))['metric'] == other_metric.name
+    assert subscription.get(0) is None
+
+
+@pytest.mark.usefixtures('test_env', 'file_db')
+def test_slow_subscription_dropped(publisher):
+    metric = utils.create_air_temperature_metric()
+
+    slow_subscription = publisher.subscribe()
+    subscription = publisher.subscribe()
+
+    for value in range(3):
+        metrics.create_metric_log(metric, value)
+        subscription.get(0)
+
+    assert slow_subscription.closed
+    assert not subscription.closed
+
+    # what was buffered is still sent
+    assert _data(slow_subscription.get(0))['value'] == 0
@@ -0,0 +1,83 @@
+import pytest
+
+from gardnr import constants, reflection
+from tests import utils
+
+
+class CountingSensor(utils.MockSensor):
+    """Keeps track of how many times it is setup and torn down"""
+    setup_count = 0
+    teardown_count = 0
+
+    def setup(self) -> None:
+        CountingSensor.setup_count += 1
+
+    def teardown(self) -> None:
+        CountingSensor.teardown_count += 1
+
+
+@pytest.fixture
+def counting_sensor():
+    CountingSensor.setup_count = 0
+    CountingSensor.teardown_count = 0
+
+    return utils.create_sensor(driver_type=CountingSensor)
+
+
+@pytest.mark.usefixtures('test_env')
+def test_load_active_drivers_reused(counting_sensor):
+
+    sensors1 = reflection.load_active_drivers(constants.SENSOR)
+    sensors2 = reflection.load_active_drivers(constants.SENSOR)
+
+    assert len(sensors1) == 1
+    assert sensors1[0] is sensors2[0]
+    assert CountingSensor.setup_count == 1
+
+
+@pytest.mark.usefixtures('test_env')
+def test_load_active_drivers_changed(counting_sensor):
+
+    sensor1 = reflection.load_active_drivers(constants.SENSOR)[0]
+
+    counting_sensor.config = dict(counting_sensor.config,
+                                  sample_temperature=0)
+    counting_sensor.save()
+
+    sensor2 = reflection.load_active_drivers(constants.SENSOR)[0]
+
+    assert sensor1 is not sensor2
+    assert sensor2.sample_temperature == 0
+    assert CountingSensor.setup_count == 2
+    assert CountingSensor.teardown_count == 1
+
+
+@pytest.mark.usefixtures('test_env')
+def test_load_active_drivers_disabled(counting_sensor):
+
+    assert reflection.load_active_drivers(constants.SENSOR)
+
+    counting_sensor.disabled = True
+    counting_sensor.save()
+
+    assert not reflection.load_active_drivers(constants.SENSOR)
+
+
+@pytest.mark.usefixtures('test_env')
+def test_load_active_drivers_removed(counting_sensor):
+
+    reflection.load_active_drivers(constants.SENSOR)
+
+    counting_sensor.delete_instance()
+
+    assert not reflection.load_active_drivers(constants.SENSOR)
+    assert CountingSensor.teardown_count == 1
+
+
+@pytest.mark.usefixtures('test_env')
+def test_unload_drivers(counting_sensor):
+
+    reflection.load_active_drivers(constants.SENSOR)
+    reflection.unload_drivers()
+
+    assert CountingSensor.teardown_count == 1
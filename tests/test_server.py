@@ -1,8 +1,94 @@
+import io
+from types import SimpleNamespace
+from unittest.mock import patch
+from uuid import uuid4
+
 import pytest
 
+from gardnr import constants, models, server, settings, tasks
+from tests import utils
+
 
 @pytest.mark.skip('Not setup to work yet')
 @pytest.mark.usefixture('test_env')
 def test_manual_metric(web_client):
     rv = web_client.get('/')
     print(rv.data)
+
+
+def _create_manual_metric(name, metric_type=constants.T9E):
+    return models.Metric.create(id=uuid4(), name=name, topic=constants.AIR,
+                                type=metric_type, manual=True)
+
+
+@pytest.mark.usefixtures('test_env')
+def test_metric_form_cached():
+    metric = _create_manual_metric('manual-temperature')
+    # not a manual metric
+    utils.create_air_temperature_metric()
+
+    form_class, manual_metrics = server.get_metric_form()
+
+    assert list(manual_metrics) == [metric.name]
+    assert hasattr(form_class, metric.name)
+
+    with patch.object(models.Metric, 'select') as select:
+        assert server.get_metric_form()[0] is form_class
+        assert not select.called
+
+
+@pytest.mark.usefixtures('test_env')
+def test_metric_form_rebuilt_when_metrics_change():
+    metric = _create_manual_metric('manual-temperature')
+
+    form_class, _ = server.get_metric_form()
+
+    metric.disabled = True
+    metric.save()
+
+    new_form_class, manual_metrics = server.get_metric_form()
+
+    assert new_form_class is not form_class
+    assert not manual_metrics
+
+
+@pytest.mark.usefixtures('test_env')
+def test_create_logs_in_one_transaction():
+    temperature = _create_manual_metric('manual-temperature')
+    notes = _create_manual_metric('manual-notes', constants.NOTES)
+
+    with patch.object(models.Metric, 'get') as get:
+        server.create_logs([(temperature, 21.5), (notes, 'watered')])
+        assert not get.called
+
+    assert temperature.get_latest_log().value == 21.5
+    assert notes.get_latest_log().value == 'watered'
+
+
+@pytest.mark.usefixtures('test_env')
+def test_create_logs_rolled_back():
+    temperature = _create_manual_metric('manual-temperature')
+    notes = _create_manual_metric('manual-notes', constants.NOTES)
+
+    with patch('gardnr.metrics.update_rollups', side_effect=ValueError):
+        with pytest.raises(ValueError):
+            server.create_logs([(temperature, 21.5), (notes, 'watered')])
+
+    assert not models.MetricLog.select().count()
+
+
+@pytest.mark.usefixtures('test_env')
+def test_create_logs_failed_removes_images(tmpdir):
+    temperature = _create_manual_metric('manual-temperature')
+    camera = _create_manual_metric('manual-camera', constants.IMAGE)
+    image = SimpleNamespace(filename='plant.jpg', stream=io.BytesIO(b'img'))
+
+    with patch.object(settings, 'UPLOAD_PATH', str(tmpdir)):
+        with patch('gardnr.metrics.update_rollups', side_effect=ValueError):
+            with pytest.raises(ValueError):
+                server.create_logs([(camera, image), (temperature, 21.5)])
+
+        tasks.purge()
+
+    assert not models.MetricLog.select().count()
+    assert not [path for path in tmpdir.visit() if path.isfile()]
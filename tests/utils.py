@@ -138,6 +138,37 @@ def create_and_load_air_temperature_sensor(
     return reflection.load_driver(sensor_model)
 
 
+def create_sensor(
+        name: str = TEST_SENSOR,
+        driver_type: type = MockSensor,
+        metric_name: str = TEST_METRIC,
+        sample_temperature: float = TEST_TEMPERATURE,
+        disabled: bool = False
+) -> models.Driver:
+    fully_qualname = reflection.get_fully_qualname(driver_type)
+    config = dict(sample_temperature=sample_temperature,
+                  temperature_metric=metric_name)
+
+    return models.Driver.create(name=name,
+                                type=constants.SENSOR,
+                                fully_qualname=fully_qualname,
+                                config=config,
+                                disabled=disabled)
+
+
+def create_and_load_sensor(
+        name: str = TEST_SENSOR,
+        driver_type: type = MockSensor,
+        metric_name: str = TEST_METRIC,
+        sample_temperature: float = TEST_TEMPERATURE,
+        disabled: bool = False
+) -> drivers.Driver:
+    sensor_model = create_sensor(name, driver_type, metric_name,
+                                 sample_temperature, disabled)
+
+    return reflection.load_driver(sensor_model)
+
+
 def create_air_temperature_sensor_with_schedule(
         metric_id: Optional[UUID] = None,
         metric_name: str = TEST_METRIC,
@@ -231,3 +262,29 @@ def create_air_temperature_metric_trigger(
                                  power_driver=power_driver,
                                  power_on=power_on,
                                  disabled=trigger_disabled)
+
+
+TEST_RECIPE = """<?xml version="1.0" encoding="UTF-8"?>
+<recipe>
+  <default>
+    <air>
+      <temperature min="16" max="18" />
+    </air>
+  </default>
+  <germination duration="3600">
+    <air>
+      <temperature min="20" max="{germination_max}" />
+    </air>
+  </germination>
+  <vegetative duration="7200">
+    <water>
+      <ph min="5.5" max="6.5" />
+    </water>
+  </vegetative>
+</recipe>
+"""
+
+
+def write_recipe(path: str, germination_max: float = 25) -> None:
+    with open(path, 'w') as recipe:
+        recipe.write(TEST_RECIPE.format(germination_max=germination_max))